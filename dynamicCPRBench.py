@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the micro-benchmarks of the hot kernels of the part:
+the tick of the groups (the engine alone, then with GroupDYNCPR.apply_tick
+and the remote calls it builds), the infinite payoff, the update of the
+remotes, the to_dict serializers and the packing of the curves at the end of
+the part.
+
+Each kernel is timed for a whole part at each scale (groups, players,
+duration, tick), with inputs given by dynamicCPRSimulation so that they are
+the same from one run to the other.
+
+Usage (from the directory of the part):
+    python dynamicCPRBench.py
+    python dynamicCPRBench.py --groups 1 20 --players 2 --duration 3600 \
+--save bench.json
+    python dynamicCPRBench.py --groups 1 20 --players 2 --duration 3600 \
+--compare bench.json --threshold 0.2
+With --compare the results are compared with a previous run (--compare alone
+uses dynamicCPRBench.json, the reference of the default scales committed
+with the part) and the exit status is 1 if a kernel is slower than the
+reference by more than the threshold. The timings depend on the machine, so
+a reference is only meaningful on the machine that made it: run
+    python dynamicCPRBench.py --save dynamicCPRBench.json
+on the server of the lab, with le2m in the path, to make its reference. The
+kernels without reference are listed.
+
+The kernels that need le2m (server or client side) are skipped when le2m
+is not in the path.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+import numpy as np
+
+import dynamicCPRParams as pms
+from dynamicCPREngine import TickEngine
+from dynamicCPRSimulation import Simulation
+import dynamicCPRWire as wire
+
+
+logger = logging.getLogger("le2m")
+
+BENCHMARKS = OrderedDict()
+# the reference results, for the default scales
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "dynamicCPRBench.json")
+
+
+class Scale(namedtuple("Scale", "groups players duration tick")):
+    """
+    groups and players: the size of the session
+    duration: the duration of the part, in seconds
+    tick: the time between two updates (TIMER_UPDATE), in seconds
+    """
+
+    @property
+    def key(self):
+        return "groups={} players={} duration={:g} tick={:g}".format(*self)
+
+    @property
+    def ticks(self):
+        return int(self.duration / self.tick)
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The function receives the scale and the data of
+    the simulation, and returns the function to time (without argument)
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def simulate(scale, seed=0):
+    """
+    A part with random extractions, the resource is never exhausted
+    :param scale: Scale
+    :param seed: seed of the random generator
+    :return: the Simulation, already run
+    """
+    rng = np.random.RandomState(seed)
+    maximum = 2 * pms.RESOURCE_GROWTH / scale.players
+
+    def strategy(state, group, player):
+        if state.tick == 0 or rng.random_sample() < 0.1:
+            return rng.uniform(pms.DECISION_MIN, maximum)
+        return None
+
+    sim = Simulation([strategy] * scale.players, groups=scale.groups, params={
+        "DYNAMIC_TYPE": pms.CONTINUOUS, "TAILLE_GROUPES": scale.players,
+        "CONTINUOUS_TIME_DURATION": timedelta(seconds=scale.duration),
+        "TIMER_UPDATE": timedelta(seconds=scale.tick)})
+    sim.run()
+    return sim
+
+
+# ==============================================================================
+# KERNELS
+# ==============================================================================
+
+
+class _BenchGroup(object):
+    """
+    Take the place of GroupDYNCPR for the TickEngine
+    """
+
+    def __init__(self, players):
+        self.players = range(players)
+        self.current_resource = pms.RESOURCE_INITIAL_STOCK
+        self.last_tick = None
+
+    def attach_engine(self, engine, index):
+        pass
+
+    def apply_tick(self, the_time, forced, group_extraction, benefits, costs,
+                   payoffs, resource):
+        self.current_resource = resource
+        self.last_tick = (the_time, forced, group_extraction, benefits, costs,
+                          payoffs)
+
+
+class _BenchClient(object):
+    """
+    Take the place of the le2m client for the remote
+    """
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def __str__(self):
+        return self.uid
+
+
+class _BenchServer(object):
+    """
+    Take the place of le2mserv for GroupDYNCPR
+    """
+
+    class gestionnaire_base(object):
+        class session(object):
+            id = 0
+
+    class gestionnaire_graphique(object):
+        @staticmethod
+        def infoserv(*args, **kwargs):
+            pass
+
+
+class _BenchPlayer(object):
+    """
+    Take the place of the le2m player on the server
+    """
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.group = None
+        self.part = None
+
+    def get_part(self, name):
+        return self.part
+
+    def info(self, txt):
+        pass
+
+    def __str__(self):
+        return self.uid
+
+
+class _BenchRemote(object):
+    """
+    Take the place of the pb.RemoteReference of a player: the updates are
+    acknowledged at once
+    """
+
+    def __init__(self, part):
+        self.part = part
+
+    def callRemote(self, method, *args):
+        from twisted.internet import defer
+        encoder = self.part.joueur.group.delta_encoders.get(self.part.protocol)
+        return defer.succeed(None if encoder is None else encoder.seq)
+
+
+@benchmark("engine_tick")
+def bench_engine_tick(scale, sim):
+    extractions = sim.extraction
+
+    def run():
+        engine = TickEngine([_BenchGroup(scale.players)
+                             for _ in range(scale.groups)])
+        for k in range(sim.ticks + 1):
+            engine.extractions[:] = extractions[k]
+            engine.update_data(sim.time[k])
+    return run
+
+
+def _create_groups(scale, sim, protocol):
+    """
+    The groups of the session, as the server creates them, with remotes that
+    use protocol
+    :return: the TickEngine of the groups
+    """
+    from dynamicCPRGroup import GroupDYNCPR
+    from dynamicCPRPart import PartieDYNCPR, RepetitionsDYNCPR, \
+        ExtractionRecord
+    from dynamicCPRStore import WriteBehind
+    server = _BenchServer()
+    writer = WriteBehind()
+    groups = []
+    for g in range(scale.groups):
+        players = [_BenchPlayer("bench_{}_{}".format(g, p))
+                   for p in range(scale.players)]
+        for j in players:
+            j.part = PartieDYNCPR(server, j)
+            j.part.remote = _BenchRemote(j.part)
+            j.part.protocol = protocol
+            j.part.currentperiod = RepetitionsDYNCPR(1)
+        group = GroupDYNCPR(server, "bench_g_{}".format(g), players, 1,
+                            writer)
+        group.current_period = 1
+        for p, j in enumerate(players):
+            j.group = group
+            j.part.current_extraction = ExtractionRecord(
+                j.part.currentperiod, float(sim.extraction[0, g, p]), 0)
+            group.current_players_extractions[j.uid] = \
+                j.part.current_extraction
+        groups.append(group)
+    return TickEngine(groups, sim.ticks + 1)
+
+
+def _bench_group_tick(scale, sim, protocol):
+    extractions = sim.extraction
+    _create_groups(scale, sim, protocol)  # ImportError without le2m
+
+    def run():
+        engine = _create_groups(scale, sim, protocol)
+        for k in range(sim.ticks + 1):
+            engine.extractions[:] = extractions[k]
+            engine.update_data(sim.time[k])
+    return run
+
+
+@benchmark("group_tick")
+def bench_group_tick(scale, sim):
+    # the engine, GroupDYNCPR.apply_tick and the remote calls it builds
+    return _bench_group_tick(scale, sim, wire.PROTOCOL)
+
+
+@benchmark("group_tick_dict")
+def bench_group_tick_dict(scale, sim):
+    # the same with the remotes of the first version (full to_dict)
+    return _bench_group_tick(scale, sim, wire.PROTOCOL_DICT)
+
+
+@benchmark("infinite_payoff")
+def bench_infinite_payoff(scale, sim):
+    # the arguments of every call of the part, as python floats
+    calls = list(zip(
+        np.repeat(sim.time, scale.groups * scale.players).tolist(),
+        np.repeat(sim.resource, scale.players, axis=1).ravel().tolist(),
+        sim.extraction.ravel().tolist(),
+        np.repeat(sim.group_extraction, scale.players, axis=1).ravel().tolist()
+    ))
+
+    def run():
+        for args in calls:
+            pms.get_infinite_payoff(*args)
+    return run
+
+
+@benchmark("infinite_payoff_array")
+def bench_infinite_payoff_array(scale, sim):
+    # one call per tick for all the players of the session
+    resources = sim.resource[:, :, np.newaxis]
+    group_extractions = sim.group_extraction[:, :, np.newaxis]
+
+    def run():
+        for k in range(sim.ticks + 1):
+            pms.get_infinite_payoff_array(
+                sim.time[k], resources[k], sim.extraction[k],
+                group_extractions[k])
+    return run
+
+
+def _create_remote(scale, sim, group=0):
+    """
+    A remote of the first player of the group, configured as the server does
+    """
+    from dynamicCPRRemote import RemoteDYNCPR
+    members = ["bench_{}".format(p) for p in range(scale.players)]
+    remote = RemoteDYNCPR(_BenchClient(members[0]))
+    remote.remote_configure({}, None, members)
+    remote.remote_newperiod(1)
+    # the arguments of remote_update_data, as sent by GroupDYNCPR
+    updates = []
+    for k in range(sim.ticks + 1):
+        updates.append((
+            {uid: {"DYNCPR_extraction": float(sim.extraction[k, group, p]),
+                   "DYNCPR_cost": float(sim.cost[k, group, p]),
+                   "DYNCPR_payoff": float(sim.payoff[k, group, p])}
+             for p, uid in enumerate(members)},
+            {"DYNCPR_group_extraction": float(sim.group_extraction[k, group]),
+             "DYNCPR_resource_stock": float(sim.resource[k, group])},
+            float(sim.time[k])))
+    return remote, updates
+
+
+@benchmark("remote_update_data")
+def bench_remote_update_data(scale, sim):
+    # one remote: every remote of the session does the same job
+    remote, updates = _create_remote(scale, sim)
+
+    def run():
+        remote.remote_configure({}, None, remote.group_members)
+        remote.remote_newperiod(1)
+        for members, group, the_time in updates:
+            remote.remote_update_data(members, group, the_time)
+    return run
+
+
+@benchmark("get_curves")
+def bench_get_curves(scale, sim):
+    remote, updates = _create_remote(scale, sim)
+    for members, group, the_time in updates:
+        remote.remote_update_data(members, group, the_time)
+    remote.protocol = wire.PROTOCOL
+
+    def run():
+        remote.get_curves()
+    return run
+
+
+@benchmark("to_dict")
+def bench_to_dict(scale, sim):
+    # the ORM rows of every player and group, serialized at each tick
+    from dynamicCPRPart import ExtractionsDYNCPR
+    from dynamicCPRGroup import GroupExtractionDYNCPR
+
+    rows = []
+    for g in range(scale.groups):
+        for p in range(scale.players):
+            r = ExtractionsDYNCPR(float(sim.extraction[-1, g, p]),
+                                  float(sim.time[-1]))
+            r.DYNCPR_resource = float(sim.resource[-1, g])
+            r.DYNCPR_benefice = float(sim.benefit[-1, g, p])
+            r.DYNCPR_cost = float(sim.cost[-1, g, p])
+            r.DYNCPR_payoff = float(sim.payoff[-1, g, p])
+            rows.append(r)
+        rows.append(GroupExtractionDYNCPR(
+            1, float(sim.time[-1]), float(sim.group_extraction[-1, g]),
+            float(sim.resource[-1, g])))
+
+    def run():
+        for _ in range(sim.ticks + 1):
+            for r in rows:
+                r.to_dict()
+    return run
+
+
+@benchmark("record_to_dict")
+def bench_record_to_dict(scale, sim):
+    # the records used during the game (see dynamicCPRStore.Record)
+    from dynamicCPRPart import ExtractionRecord
+    from dynamicCPRGroup import GroupExtractionRecord
+
+    class Parent(object):
+        id = 1
+        uid = "bench"
+
+    parent = Parent()
+    records = []
+    for g in range(scale.groups):
+        for p in range(scale.players):
+            r = ExtractionRecord(parent, float(sim.extraction[-1, g, p]),
+                                 float(sim.time[-1]))
+            r.DYNCPR_resource = float(sim.resource[-1, g])
+            r.DYNCPR_benefice = float(sim.benefit[-1, g, p])
+            r.DYNCPR_cost = float(sim.cost[-1, g, p])
+            r.DYNCPR_payoff = float(sim.payoff[-1, g, p])
+            records.append(r)
+        records.append(GroupExtractionRecord(
+            parent, 1, float(sim.time[-1]),
+            float(sim.group_extraction[-1, g]), float(sim.resource[-1, g])))
+
+    def run():
+        for _ in range(sim.ticks + 1):
+            for r in records:
+                r.to_dict()
+    return run
+
+
+# ==============================================================================
+# RUN AND COMPARE
+# ==============================================================================
+
+
+def run_benchmarks(scales, names=None, repeat=5):
+    """
+    :param scales: list of Scale
+    :param names: the benchmarks to run, all by default
+    :param repeat: each benchmark is timed repeat times, the best time is kept
+    :return: dict {scale key: {benchmark: seconds or None if skipped}}
+    """
+    results = OrderedDict()
+    for scale in scales:
+        sim = simulate(scale)
+        results[scale.key] = OrderedDict()
+        for name, bench in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            # the kernels use the parameters of the scale
+            with sim.use_params():
+                try:
+                    func = bench(scale, sim)
+                except ImportError as e:
+                    logger.warning("Benchmark {} skipped: {}".format(name, e))
+                    results[scale.key][name] = None
+                    continue
+                results[scale.key][name] = min(
+                    timeit.repeat(func, number=1, repeat=repeat))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: see run_benchmarks
+    :param baseline: results of a previous run
+    :param threshold: the maximal accepted slowdown (0.2 for 20%)
+    :return: list of (scale key, benchmark, seconds, baseline seconds)
+    """
+    regressions = []
+    for key, benches in results.items():
+        if key not in baseline:
+            continue
+        for name, seconds in benches.items():
+            reference = baseline[key].get(name)
+            if seconds is None:
+                continue
+            if reference is None:
+                logger.warning("{} {}: no reference".format(key, name))
+                continue
+            if seconds > reference * (1 + threshold):
+                regressions.append((key, name, seconds, reference))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--groups", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--players", type=int, nargs="+",
+                        default=[pms.TAILLE_GROUPES])
+    parser.add_argument("--duration", type=float, nargs="+", default=[600],
+                        help="seconds")
+    parser.add_argument("--tick", type=float, nargs="+", default=[
+        pms.TIMER_UPDATE.total_seconds()], help="seconds")
+    parser.add_argument("--bench", nargs="+", choices=list(BENCHMARKS),
+                        help="the benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="write the results in this json file")
+    parser.add_argument("--compare", nargs="?", const=BASELINE,
+                        help="compare with this json file, the reference "
+                             "results of the part if no file is given")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    scales = [Scale(g, p, d, t) for g in args.groups for p in args.players
+              for d in args.duration for t in args.tick]
+    results = run_benchmarks(scales, args.bench, args.repeat)
+    for key, benches in results.items():
+        print(key)
+        for name, seconds in benches.items():
+            print("    {:<20} {}".format(
+                name, "skipped" if seconds is None else
+                "{:.6f} s".format(seconds)))
+
+    # read before the save, the baseline can be the saved file
+    baseline = None
+    if args.compare and os.path.isfile(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    elif args.compare:
+        logger.warning("No baseline {}".format(args.compare))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if not any(key in baseline for key in results):
+            logger.warning("No scale of {} in the baseline {}".format(
+                list(results), args.compare))
+        for key, name, seconds, reference in regressions:
+            print("REGRESSION {} {}: {:.6f} s instead of {:.6f} s "
+                  "(+{:.0%})".format(key, name, seconds, reference,
+                                     seconds / reference - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the tick engine of the part.
+The state of every group of the session (resource stock, individual
+extractions, benefit, cost and payoff) is kept in numpy arrays (one line per
+group, one column per player) and all the groups are moved forward in one
+vectorized step.
+It also contains the numerical helpers of the remotes: the discounted payoffs
+(DiscountedAccumulator) and the decimation of the long curves (decimate).
+This module doesn't depend on Qt, twisted or le2m.
+"""
+
+import logging
+import numpy as np
+
+import dynamicCPRParams as pms
+
+
+logger = logging.getLogger("le2m")
+
+
+def compute_tick(extractions, resources):
+    """
+    Compute one step of the dynamics for several groups at once
+    :param extractions: array (groups x players) with the current extractions
+    :param resources: array (groups) with the resource stock before the step
+    :return: a tuple (forced, group_extractions, benefits, costs, payoffs,
+    new_resources). forced is True for the groups whose extraction was greater
+    than the available resource: the extractions of these groups are set to 0.
+    """
+    group_extractions = np.sum(extractions, axis=1)
+
+    # if the group extracts more than the resource the extractions are set to 0
+    forced = group_extractions > resources
+    if forced.any():
+        extractions = np.where(forced[:, np.newaxis], 0., extractions)
+        group_extractions = np.sum(extractions, axis=1)
+
+    benefits = pms.param_a * extractions - (pms.param_b / 2) * \
+        extractions ** 2
+    costs = extractions * (
+        pms.param_c0 - pms.param_c1 * resources[:, np.newaxis])
+    costs = np.where(costs < 0, 0., costs)
+    payoffs = benefits - costs
+
+    new_resources = resources + pms.RESOURCE_GROWTH
+    new_resources -= group_extractions
+
+    return forced, group_extractions, benefits, costs, payoffs, new_resources
+
+
+class TickEngine(object):
+    """
+    Keep the state of all the groups in struct-of-arrays buffers and make them
+    move forward together.
+    The groups must have a method apply_tick, that receives the results of the
+    step for their own line (see GroupDYNCPR.apply_tick)
+    The results of the steps are also kept in the history buffers (one line
+    per step of each group), from which the server computes the payoffs and
+    the curves of the part (see compute_payoffs).
+    """
+
+    HISTORY = ("history_time", "history_extractions", "history_costs",
+               "history_payoffs", "history_group_extractions",
+               "history_resources")
+
+    def __init__(self, groups, history=0):
+        """
+
+        :param groups: the groups of the session
+        :param history: the expected number of steps of the part (the
+        history grows if needed)
+        """
+        self.groups = list(groups)
+        size = max([len(g.players) for g in self.groups] or [0])
+        self.extractions = np.zeros((len(self.groups), size))
+        self.resources = np.array([g.current_resource for g in self.groups],
+                                  dtype=float)
+        self.benefits = np.zeros_like(self.extractions)
+        self.costs = np.zeros_like(self.extractions)
+        self.payoffs = np.zeros_like(self.extractions)
+        self.history_count = np.zeros(len(self.groups), dtype=int)
+        self.history_time = np.zeros((history, len(self.groups)))
+        self.history_extractions = np.zeros((history, ) +
+                                            self.extractions.shape)
+        self.history_costs = np.zeros_like(self.history_extractions)
+        self.history_payoffs = np.zeros_like(self.history_extractions)
+        self.history_group_extractions = np.zeros_like(self.history_time)
+        self.history_resources = np.zeros_like(self.history_time)
+        for index, g in enumerate(self.groups):
+            g.attach_engine(self, index)
+
+    def _grow_history(self):
+        size = max(2 * len(self.history_time), 1)
+        for name in self.HISTORY:
+            old = getattr(self, name)
+            new = np.zeros((size, ) + old.shape[1:])
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def set_extraction(self, group_index, player_index, value):
+        self.extractions[group_index, player_index] = value
+
+    def update_data(self, the_time=0, rows=None):
+        """
+        Make a step for the groups in rows (all the groups by default) and send
+        the results to each group
+        :param the_time: the time of the step (given by the scheduler)
+        :param rows: list of the group indexes to update
+        :return:
+        """
+        if rows is None:
+            rows = np.arange(len(self.groups))
+        else:
+            rows = np.asarray(rows, dtype=int)
+
+        forced, group_extractions, benefits, costs, payoffs, new_resources = \
+            compute_tick(self.extractions[rows], self.resources[rows])
+
+        self.extractions[rows[forced]] = 0
+        self.benefits[rows] = benefits
+        self.costs[rows] = costs
+        self.payoffs[rows] = payoffs
+        self.resources[rows] = new_resources
+
+        steps = self.history_count[rows]
+        while len(steps) and steps.max() >= len(self.history_time):
+            self._grow_history()
+        self.history_time[steps, rows] = the_time
+        self.history_extractions[steps, rows] = self.extractions[rows]
+        self.history_costs[steps, rows] = costs
+        self.history_payoffs[steps, rows] = payoffs
+        self.history_group_extractions[steps, rows] = group_extractions
+        self.history_resources[steps, rows] = new_resources
+        self.history_count[rows] += 1
+
+        forced = forced.tolist()
+        group_extractions = group_extractions.tolist()
+        benefits = benefits.tolist()
+        costs = costs.tolist()
+        payoffs = payoffs.tolist()
+        new_resources = new_resources.tolist()
+        for i, row in enumerate(rows.tolist()):
+            # a failure of one group doesn't prevent the others from
+            # receiving their step
+            try:
+                self.groups[row].apply_tick(
+                    the_time, forced[i], group_extractions[i], benefits[i],
+                    costs[i], payoffs[i], new_resources[i])
+            except Exception:
+                logger.exception("{} apply_tick at {} failed".format(
+                    self.groups[row], the_time))
+
+    def compute_payoffs(self, interval=None, ticks=0):
+        """
+        The payoffs of every player for the whole part, computed in one pass
+        from the history as the remotes do step by step (see
+        RemoteDYNCPR.remote_update_data)
+        :param interval: the time between two ticks (TIMER_UPDATE), in
+        seconds, for the table of the discount factors
+        :param ticks: the number of ticks of the part
+        :return: dict of arrays (steps x groups x players): time (the x of
+        the remotes' curves), extraction, cost, discounted, cumulative,
+        part_payoff. The steps after history_count[group] are not used
+        """
+        steps = int(self.history_count.max()) if len(self.groups) else 0
+        extractions = self.history_extractions[:steps]
+        payoffs = self.history_payoffs[:steps]
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            times = self.history_time[:steps]
+            factors = DiscountedAccumulator(
+                interval=interval, ticks=ticks).get_factors(times)
+            discounted = factors[:, :, np.newaxis] * payoffs
+            cumulative = np.cumsum(discounted, axis=0)
+        else:  # the remotes use the period, no discounted payoff
+            times = np.repeat(np.arange(steps, dtype=float)[:, np.newaxis],
+                              len(self.groups), axis=1)
+            discounted = np.zeros_like(payoffs)
+            cumulative = np.zeros_like(payoffs)
+        infinite = pms.get_infinite_payoff_array(
+            times[:, :, np.newaxis],
+            self.history_resources[:steps, :, np.newaxis], extractions,
+            self.history_group_extractions[:steps, :, np.newaxis])
+        return {"time": times, "extraction": extractions,
+                "cost": self.history_costs[:steps], "discounted": discounted,
+                "cumulative": cumulative, "part_payoff": cumulative + infinite}
+
+
+class DiscountedAccumulator(object):
+    """
+    Running sum of the discounted payoffs exp(-r * t) * payoff, for one player
+    (shape ()) or several at once (e.g. groups x players).
+    The discount factors of the ticks (t = tick * interval) are computed once
+    at creation, the other times use the closed form.
+    Used by the remotes (cumulative and part payoff) and by the simulation.
+    """
+
+    def __init__(self, shape=(), interval=None, ticks=0):
+        """
+
+        :param shape: the shape of the payoffs
+        :param interval: the time between two ticks (TIMER_UPDATE), in
+        seconds. None for no table
+        :param ticks: the number of ticks of the part
+        """
+        self.interval = interval
+        if interval:
+            self.factors = np.exp(
+                - pms.param_r * (interval * np.arange(ticks + 1)))
+        else:
+            self.factors = np.empty(0)
+        self._cumulative = np.zeros(shape)
+        self.count = 0
+
+    @property
+    def cumulative(self):
+        """
+        the sum of the discounted payoffs so far (numpy float for shape ())
+        """
+        return self._cumulative[()]
+
+    def factor(self, the_time):
+        """
+        :param the_time: in seconds
+        :return: exp(-r * the_time)
+        """
+        if self.interval:
+            tick = int(round(the_time / self.interval))
+            if 0 <= tick < len(self.factors) and \
+                    tick * self.interval == the_time:
+                return self.factors[tick]
+        return np.exp(- pms.param_r * the_time)
+
+    def get_factors(self, times):
+        """
+        Array version of factor
+        :param times: numpy array, in seconds
+        :return: exp(-r * times)
+        """
+        times = np.asarray(times, dtype=float)
+        factors = np.exp(- pms.param_r * times)
+        if self.interval:
+            ticks = np.rint(times / self.interval).astype(int)
+            table = (ticks >= 0) & (ticks < len(self.factors)) & \
+                (ticks * self.interval == times)
+            factors[table] = self.factors[ticks[table]]
+        return factors
+
+    def add(self, the_time, payoffs):
+        """
+        Add the payoffs received at the_time
+        :param the_time: in seconds
+        :param payoffs: float or array of the shape of the accumulator
+        :return: the discounted payoffs
+        """
+        discounted = self.factor(the_time) * payoffs
+        self._cumulative += discounted
+        self.count += 1
+        return discounted
+
+
+def decimate(xdata, ydata, buckets):
+    """
+    Min/max decimation: the values are split into buckets of consecutive
+    points and only the min and the max of each bucket are kept (in their
+    order), with the first and the last point. The shape of the curve, its
+    peaks included, is the same at the resolution of the screen.
+    :param xdata: numpy array
+    :param ydata: numpy array, same size as xdata
+    :param buckets: the number of buckets (for example the width in pixels)
+    :return: xdata, ydata with at most 2 * buckets + 2 points
+    """
+    size = len(ydata)
+    buckets = max(int(buckets), 1)
+    if size <= 2 * buckets + 2:
+        return xdata, ydata
+    width = -(-size // buckets)  # ceil
+    # the last bucket is padded with the last value
+    padded = np.empty(buckets * width)
+    padded[:size] = ydata
+    padded[size:] = ydata[-1]
+    padded = padded.reshape(buckets, width)
+    offsets = np.arange(buckets) * width
+    indexes = np.concatenate((
+        [0], offsets + np.argmin(padded, axis=1),
+        offsets + np.argmax(padded, axis=1), [size - 1]))
+    indexes = np.unique(np.minimum(indexes, size - 1))
+    return xdata[indexes], ydata[indexes]
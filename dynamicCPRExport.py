@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the exporter of the tables of the part to columnar
+files, for the analysis (pandas, R, polars...) without going through the
+database.
+The files are partitioned by session and sequence:
+    <directory>/session_<id>/sequence_<n>/<table>.parquet
+Parquet is used when pyarrow is installed, otherwise each table is a
+directory with one .npy file per column, that can be memory-mapped:
+    <directory>/session_<id>/sequence_<n>/<table>/<column>.npy
+The exported tables are the groups, the group extractions, the parts, the
+repetitions, the extractions and the curves (one row per point, read from
+the blobs or from the point rows of the older databases).
+
+The exporter is incremental: the last exported session is kept in
+<directory>/watermark.json and a new run only exports the sessions added
+since then (--full exports everything again). A session is exported once,
+so the exporter must be run after the end of the sessions.
+
+Usage (from the directory of the part):
+    python dynamicCPRExport.py sqlite:///path/to/the/database.sqlite export
+This module only depends on sqlalchemy (the 0.9 - 1.x API used by le2m) and
+numpy, the tables are read by reflection.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import create_engine, MetaData, Table, select, \
+    Boolean, DateTime, Float, Integer, LargeBinary
+from sqlalchemy.exc import NoSuchTableError
+
+from dynamicCPRStore import load_curve, load_point_curves
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+
+logger = logging.getLogger("le2m")
+
+FORMAT_PARQUET = "parquet"
+FORMAT_NPY = "npy"
+WATERMARK = "watermark.json"
+
+
+# ==============================================================================
+# COLUMNS
+# ==============================================================================
+
+
+def to_array(values, sql_type):
+    """
+    Convert the values of a column into a numpy array, the missing values
+    (None) are NaN for the numbers and NaT for the dates (an integer column
+    with missing values becomes a float column)
+    :param values: list of the values of the column
+    :param sql_type: the SQLAlchemy type of the column
+    :return: numpy array
+    """
+    try:
+        return _to_typed_array(values, sql_type)
+    except (TypeError, ValueError):
+        # sqlite doesn't check the types: partie_dynamicCPR.DYNCPR_group is
+        # an Integer column that contains the uid of the group
+        return _to_string_array(values)
+
+
+def _to_typed_array(values, sql_type):
+    if isinstance(sql_type, Boolean):
+        return np.array([bool(v) for v in values], dtype=bool)
+    if isinstance(sql_type, Integer):
+        if any(v is None for v in values):
+            return np.array([np.nan if v is None else v for v in values],
+                            dtype=float)
+        return np.array(values, dtype=np.int64)
+    if isinstance(sql_type, Float):
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=float)
+    if isinstance(sql_type, DateTime):
+        return np.array(["NaT" if v is None else v for v in values],
+                        dtype="datetime64[us]")
+    return _to_string_array(values)
+
+
+def _to_string_array(values):
+    # fixed width unicode, so that the npy files can be mapped
+    return np.array([u"" if v is None else u"{}".format(v) for v in values],
+                    dtype="U")
+
+
+def to_columns(rows, columns):
+    """
+    :param rows: the rows of a select
+    :param columns: the selected columns (SQLAlchemy columns)
+    :return: OrderedDict {column name: numpy array}
+    """
+    data = OrderedDict()
+    for i, c in enumerate(columns):
+        data[c.name] = to_array([r[i] for r in rows], c.type)
+    return data
+
+
+def write_table(path, data, file_format):
+    """
+    :param path: the path of the table, without extension
+    :param data: OrderedDict {column name: numpy array}
+    :param file_format: FORMAT_PARQUET or FORMAT_NPY
+    :return: the path of the file (or directory) written
+    """
+    if file_format == FORMAT_PARQUET:
+        path += ".parquet"
+        parquet.write_table(pyarrow.table(
+            OrderedDict((k, pyarrow.array(v)) for k, v in data.items())),
+            path)
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, values in data.items():
+            np.save(os.path.join(path, "{}.npy".format(name)), values)
+    return path
+
+
+def read_table(path, mmap=True):
+    """
+    Read a table written by write_table
+    :param path: the path of the table, without extension
+    :param mmap: if True the npy files are memory-mapped
+    :return: OrderedDict {column name: numpy array}
+    """
+    if os.path.isfile(path + ".parquet"):
+        table = parquet.read_table(path + ".parquet")
+        return OrderedDict((name, table.column(name).to_numpy())
+                           for name in table.column_names)
+    data = OrderedDict()
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".npy"):
+            data[name[:-4]] = np.load(os.path.join(path, name),
+                                      mmap_mode="r" if mmap else None)
+    return data
+
+
+# ==============================================================================
+# EXPORTER
+# ==============================================================================
+
+
+class Exporter(object):
+    TABLES = ("groups", "group_extractions", "parts", "repetitions",
+              "extractions", "curves")
+
+    def __init__(self, url, directory, file_format=None):
+        """
+
+        :param url: the url of the database
+        :param directory: the directory of the export
+        :param file_format: FORMAT_PARQUET or FORMAT_NPY, parquet if pyarrow
+        is installed by default
+        """
+        if file_format is None:
+            file_format = FORMAT_NPY if parquet is None else FORMAT_PARQUET
+        if file_format == FORMAT_PARQUET and parquet is None:
+            raise ValueError("pyarrow is needed for the parquet format")
+        self.engine = create_engine(url)
+        self.directory = directory
+        self.file_format = file_format
+        self._metadata = MetaData()
+        self._tables = dict()
+
+    def _table(self, name):
+        """
+        :param name: the name of the table in the database
+        :return: the reflected table, None if the database doesn't have it
+        """
+        if name not in self._tables:
+            try:
+                self._tables[name] = Table(name, self._metadata,
+                                           autoload_with=self.engine)
+            except NoSuchTableError:
+                self._tables[name] = None
+        return self._tables[name]
+
+    # --------------------------------------------------------------------------
+    # WATERMARK
+    # --------------------------------------------------------------------------
+
+    def get_watermark(self):
+        """
+        :return: the id of the last exported session, None if nothing has been
+        exported yet
+        """
+        try:
+            with open(os.path.join(self.directory, WATERMARK)) as f:
+                return json.load(f)["session_id"]
+        except IOError:
+            return None
+
+    def set_watermark(self, session_id):
+        with open(os.path.join(self.directory, WATERMARK), "w") as f:
+            json.dump({"session_id": session_id,
+                       "format": self.file_format}, f)
+
+    # --------------------------------------------------------------------------
+    # QUERIES
+    # --------------------------------------------------------------------------
+
+    def get_partitions(self, after=None):
+        """
+        :param after: only the sessions with a greater id
+        :return: OrderedDict {session id: [sequences]}
+        """
+        groups = self._table("group_dynamicCPR")
+        query = select([groups.c.session_id, groups.c.DYNCPR_sequence]).\
+            distinct().order_by(groups.c.session_id, groups.c.DYNCPR_sequence)
+        if after is not None:
+            query = query.where(groups.c.session_id > after)
+        partitions = OrderedDict()
+        with self.engine.connect() as connection:
+            for session_id, sequence in connection.execute(query):
+                partitions.setdefault(session_id, []).append(sequence)
+        return partitions
+
+    def _select(self, connection, name, session_id, sequence):
+        """
+        The rows of the table of the partition, with their session and
+        sequence.
+        :return: OrderedDict {column name: numpy array}, None if the table
+        isn't in the database
+        """
+        groups = self._table("group_dynamicCPR")
+        parts = self._table("partie_dynamicCPR")
+        repetitions = self._table("partie_dynamicCPR_repetitions")
+        partition = [groups.c.session_id, groups.c.DYNCPR_sequence]
+
+        if name == "groups":
+            table, join = groups, groups
+            partition = []
+        elif name == "group_extractions":
+            table = self._table("group_dynamicCPR_extractions")
+            join = table.join(groups, table.c.group_uid == groups.c.uid)
+        elif name == "parts":
+            table = parts
+            join = table.join(groups, table.c.DYNCPR_group == groups.c.uid)
+        elif name == "repetitions":
+            table = repetitions
+            join = table.join(
+                parts, table.c.partie_partie_id == parts.c.partie_id).join(
+                groups, parts.c.DYNCPR_group == groups.c.uid)
+        elif name == "extractions":
+            table = self._table("partie_dynamicCPR_extractions")
+            join = table.join(
+                repetitions, table.c.repetitions_id == repetitions.c.id).join(
+                parts, repetitions.c.partie_partie_id == parts.c.partie_id).\
+                join(groups, parts.c.DYNCPR_group == groups.c.uid)
+            partition.insert(0, repetitions.c.partie_partie_id)
+        else:
+            raise ValueError("Unknown table {}".format(name))
+        if table is None:
+            return None
+
+        columns = [c for c in table.columns
+                   if not isinstance(c.type, LargeBinary)]
+        columns += [c for c in partition if c.name not in
+                    [k.name for k in columns]]
+        query = select(columns).select_from(join).where(
+            groups.c.session_id == session_id).where(
+            groups.c.DYNCPR_sequence == sequence).order_by(
+            *table.primary_key.columns)
+        return to_columns(connection.execute(query).fetchall(), columns)
+
+    def _select_curves(self, connection, session_id, sequence):
+        """
+        The curves of the parts of the partition, one row per point
+        :return: OrderedDict {column name: numpy array}
+        """
+        groups = self._table("group_dynamicCPR")
+        parts = self._table("partie_dynamicCPR")
+        blobs = self._table("partie_dynamicCPR_curves_blob")
+        points = self._table("partie_dynamicCPR_curves")
+        partie_ids = [r[0] for r in connection.execute(
+            select([parts.c.partie_id]).select_from(parts.join(
+                groups, parts.c.DYNCPR_group == groups.c.uid)).where(
+                groups.c.session_id == session_id).where(
+                groups.c.DYNCPR_sequence == sequence).order_by(
+                parts.c.partie_id))]
+
+        ids, types, xdata, ydata = [], [], [], []
+        for partie_id in partie_ids:
+            curves = dict()
+            if blobs is not None:
+                curves = {r.DYNCPR_curve_type: load_curve(r) for r in
+                          connection.execute(select([blobs]).where(
+                              blobs.c.partie_id == partie_id))}
+            if not curves and points is not None:
+                curves = load_point_curves(connection.execute(
+                    select([points]).where(points.c.partie_id == partie_id)))
+            for c_type, (x, y) in sorted(curves.items()):
+                ids.append(np.repeat(partie_id, len(x)))
+                types.append(np.repeat(c_type, len(x)))
+                xdata.append(x)
+                ydata.append(y)
+
+        def concatenate(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else \
+                np.empty(0, dtype=dtype)
+
+        return OrderedDict([
+            ("partie_id", concatenate(ids, np.int64)),
+            ("DYNCPR_curve_type", concatenate(types, np.int64)),
+            ("DYNCPR_curve_x", concatenate(xdata, float)),
+            ("DYNCPR_curve_y", concatenate(ydata, float)),
+            ("session_id", np.repeat(np.int64(session_id),
+                                     sum(len(x) for x in xdata))),
+            ("DYNCPR_sequence", np.repeat(np.int64(sequence),
+                                          sum(len(x) for x in xdata)))])
+
+    # --------------------------------------------------------------------------
+    # EXPORT
+    # --------------------------------------------------------------------------
+
+    def export_partition(self, session_id, sequence):
+        """
+        Write every table of the partition
+        :return: the paths written
+        """
+        directory = os.path.join(self.directory, "session_{}".format(
+            session_id), "sequence_{}".format(sequence))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        with self.engine.connect() as connection:
+            for name in self.TABLES:
+                if name == "curves":
+                    data = self._select_curves(connection, session_id,
+                                               sequence)
+                else:
+                    data = self._select(connection, name, session_id,
+                                        sequence)
+                if data is None:
+                    continue
+                paths.append(write_table(os.path.join(directory, name), data,
+                                         self.file_format))
+        return paths
+
+    def export(self, full=False):
+        """
+        Export the sessions added since the last export (all the sessions if
+        full). The watermark is moved after each session, so an interrupted
+        export starts again from the first session not completely written.
+        :param full: if True the watermark is ignored
+        :return: the ids of the exported sessions
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        watermark = None if full else self.get_watermark()
+        partitions = self.get_partitions(after=watermark)
+        for session_id, sequences in partitions.items():
+            for sequence in sequences:
+                self.export_partition(session_id, sequence)
+            self.set_watermark(session_id)
+            logger.info("Export: session {} ({} sequences)".format(
+                session_id, len(sequences)))
+        return list(partitions)
+
+
+def load(directory, name, mmap=True):
+    """
+    Read a table of every exported partition
+    :param directory: the directory of the export
+    :param name: the name of the table (see Exporter.TABLES)
+    :param mmap: see read_table
+    :return: OrderedDict {column name: numpy array}, the partitions are
+    concatenated in the order of the sessions and sequences
+    """
+    def index(prefix, entry):
+        return int(entry[len(prefix):])
+
+    parts = []
+    for session in sorted([e for e in os.listdir(directory) if
+                           e.startswith("session_")],
+                          key=lambda e: index("session_", e)):
+        for sequence in sorted(os.listdir(os.path.join(directory, session)),
+                               key=lambda e: index("sequence_", e)):
+            path = os.path.join(directory, session, sequence, name)
+            if os.path.exists(path) or os.path.exists(path + ".parquet"):
+                parts.append(read_table(path, mmap))
+    if not parts:
+        return OrderedDict()
+    return OrderedDict((k, np.concatenate([p[k] for p in parts]))
+                       for k in parts[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("url", help="url of the database")
+    parser.add_argument("directory", help="directory of the export")
+    parser.add_argument("--format", choices=[FORMAT_PARQUET, FORMAT_NPY],
+                        help="parquet if pyarrow is installed by default")
+    parser.add_argument("--full", action="store_true",
+                        help="export every session, not only the new ones")
+    args = parser.parse_args(argv)
+
+    exporter = Exporter(args.url, args.directory, args.format)
+    sessions = exporter.export(args.full)
+    print("{} sessions exported in {} ({})".format(
+        len(sessions), args.directory, exporter.file_format))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
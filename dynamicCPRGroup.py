@@ -1,22 +1,28 @@
 # -*- coding: utf-8 -*-
 
 # built-in
+from datetime import datetime
+from twisted.internet import defer
 from server.servbase import Base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, Float, String, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, Float, String, ForeignKey, Boolean, \
+    Index
 import logging
-from PyQt4.QtCore import QTimer
-from datetime import datetime
 
 # dynamicCPR
 import dynamicCPRParams as pms
-from dynamicCPRPart import ExtractionsDYNCPR
+from dynamicCPRPart import ExtractionRecord
+from dynamicCPRScheduler import call_remote
+from dynamicCPRStore import Record
+import dynamicCPRWire as wire
 
 logger = logging.getLogger("le2m")
 
 
 class GroupDYNCPR(Base):
     __tablename__ = "group_dynamicCPR"
+    __table_args__ = (Index("ix_group_dynamicCPR_session_sequence",
+                            "session_id", "DYNCPR_sequence"), )
     uid = Column(String(30), primary_key=True)
     session_id = Column(Integer)
     DYNCPR_dynamic_type = Column(Integer)
@@ -25,9 +31,10 @@ class GroupDYNCPR(Base):
     DYNCPR_treatment = Column(Integer)
     extractions = relationship("GroupExtractionDYNCPR")
 
-    def __init__(self, le2mserv, group_id, player_list, sequence):
+    def __init__(self, le2mserv, group_id, player_list, sequence, writer):
 
         self.le2mserv = le2mserv
+        self.writer = writer  # WriteBehind shared by the groups of the part
 
         # ----------------------------------------------------------------------
         # fields of the table
@@ -39,6 +46,7 @@ class GroupDYNCPR(Base):
         self.DYNCPR_treatment = pms.TREATMENT
         self.DYNCPR_trial = pms.PARTIE_ESSAI
         self.__players = player_list
+        self.large_group = wire.is_large_group(len(player_list))
 
         # ----------------------------------------------------------------------
         # instantiations
@@ -48,12 +56,15 @@ class GroupDYNCPR(Base):
         self.current_period = 0
         self.current_players_extractions = dict()
         self.current_extraction = None
+        # in STORAGE_CHANGE_POINTS mode, the stored row that is still open
+        self.change_points = pms.DYNAMIC_TYPE == pms.CONTINUOUS and \
+            pms.STORAGE_MODE == pms.STORAGE_CHANGE_POINTS
+        self.__open_extraction = None
         self.current_resource = pms.RESOURCE_INITIAL_STOCK
-        self.time_start = None
-        self.timer_update = QTimer()
-        self.timer_update.setInterval(
-            int(pms.TIMER_UPDATE.total_seconds())*1000)
-        self.timer_update.timeout.connect(self.update_data)
+        self.engine = None  # set by the TickEngine (see attach_engine)
+        self.engine_index = None
+        self.delta_encoders = dict()  # protocol: encoder
+        self.broadcaster = wire.Broadcaster()
 
     # --------------------------------------------------------------------------
     # PROPERTIES
@@ -94,64 +105,141 @@ class GroupDYNCPR(Base):
     # METHODS
     # --------------------------------------------------------------------------
 
-    def update_data(self):
-        # after the initial extraction but before the game starts
-        # self.time_start is None
-        try:
-            the_time = int((datetime.now() - self.time_start).total_seconds())
-        except TypeError:
-            the_time = 0
+    def attach_engine(self, engine, index):
+        """
+        Called by the tick engine: the state of the group is stored in the
+        line index of the engine's buffers
+        :param engine: the TickEngine of the session
+        :param index: the line of the group in the engine's buffers
+        :return:
+        """
+        self.engine = engine
+        self.engine_index = index
+        self.__players_index = {uid: i for i, uid in
+                                enumerate(self.players_uid)}
 
-        # ----------------------------------------------------------------------
-        # compute the group extraction
-        # ----------------------------------------------------------------------
-        group_extrac = sum(
-            [e.DYNCPR_extraction for e in self.current_players_extractions.values()])
+    def update_data(self, the_time=0):
+        """
+        Make a step for this group only. When all the groups have to be
+        updated prefer the engine's update_data
+        :param the_time: the time of the step
+        :return:
+        """
+        self.engine.update_data(the_time, [self.engine_index])
+
+    @defer.inlineCallbacks
+    def play_period(self, period):
+        """
+        Discrete treatment: the new period, the decisions of the members and
+        the step of the group, without waiting for the other groups (see
+        dynamicCPRScheduler.PeriodScheduler)
+        :param period: the period
+        :return:
+        """
+        players_part = self.players_part
+        yield (self._call_members(players_part, "newperiod", period))
+        self.writer.commit_parents()
+        self.current_period = period
+        time_start = datetime.now()
+        yield (self._call_members(players_part, "display_decision",
+                                  time_start))
+        self.update_data()
+        self.end_period()
+        self.writer.flush()
+        logger.info("{} period {} over".format(self, period))
+
+    def _call_members(self, players_part, method, *args):
+        """
+        Call the method on the part of each member. The failure of a member
+        (a remote disconnected at once for example) is logged and doesn't
+        prevent the others from going on
+        :param players_part: the parts of the members
+        :param method: the name of the method of the part
+        :param args: the arguments of the method
+        :return: Deferred fired when all the members are over
+        """
+        def failed(failure, j):
+            logger.error("{} {} {}: {}".format(
+                self, j.joueur, method, failure.getTraceback()))
+
+        return defer.gatherResults(
+            [defer.maybeDeferred(getattr(j, method), *args).addErrback(
+                failed, j) for j in players_part])
+
+    def end_period(self):
+        """
+        Discrete treatment: the group has made the step of the period, so the
+        extractions of its members will not change anymore. They are sealed
+        so that the next flush of the writer stores them
+        :return:
+        """
+        for j in self.players_part:
+            current = getattr(j, "current_extraction", None)
+            if current is not None:
+                current.sealed = True
+
+    def apply_tick(self, the_time, forced, group_extrac, benefits, costs,
+                   payoffs, resource):
+        """
+        Called by the tick engine with the results of the step for this group
+        :param the_time: the time of the step, given by the session scheduler
+        (0 before the game starts)
+        :param forced: True if the extractions have been set to 0
+        :param group_extrac: the group extraction
+        :param benefits: the benefit of each player (in the players order)
+        :param costs: the cost of each player
+        :param payoffs: the payoff of each player
+        :param resource: the new available resource
+        :return:
+        """
+        players_part = self.players_part
 
         # ----------------------------------------------------------------------
-        # check extractions
+        # the extractions have been set to 0 by the engine
         # ----------------------------------------------------------------------
-        if group_extrac > self.current_resource:
-            for j in self.players_part:
-                j.current_extraction = ExtractionsDYNCPR(0, the_time)
-                self.le2mserv.gestionnaire_base.ajouter(j.current_extraction)
-                j.currentperiod.extractions.append(j.current_extraction)
+        if forced:
+            for j in players_part:
+                if self.change_points and \
+                        j.current_extraction.DYNCPR_extraction == 0:
+                    continue
+                j.current_extraction.sealed = True
+                j.current_extraction = ExtractionRecord(
+                    j.currentperiod, 0, the_time)
+                self.writer.add(j.current_extraction)
                 self.current_players_extractions[j.joueur.uid] = \
                     j.current_extraction
-            group_extrac = sum([e.DYNCPR_extraction for e in
-                                self.current_players_extractions.values()])
 
         # ----------------------------------------------------------------------
-        # compute individual payoffs (at instant t)
+        # individual payoffs (at instant t) and new available resource
         # ----------------------------------------------------------------------
-        for j in self.players_part:
-            j_extrac = j.current_extraction.DYNCPR_extraction
-            j.current_extraction.DYNCPR_benefice = \
-                pms.param_a * j_extrac - (pms.param_b / 2) * \
-                pow(j_extrac, 2)
-            cost = j_extrac * (pms.param_c0 - pms.param_c1 * self.current_resource)
-            if cost < 0 :
-                cost = 0
-            j.current_extraction.DYNCPR_cost = cost
-            j.current_extraction.DYNCPR_payoff = \
-                j.current_extraction.DYNCPR_benefice - \
-                j.current_extraction.DYNCPR_cost
-
-        # ----------------------------------------------------------------------
-        # compute the new available resource
-        # ----------------------------------------------------------------------
-        self.current_resource += pms.RESOURCE_GROWTH
-        self.current_resource -= group_extrac
-        for j in self.players_part:
+        self.current_resource = resource
+        for i, j in enumerate(players_part):
+            j.current_extraction.DYNCPR_benefice = benefits[i]
+            j.current_extraction.DYNCPR_cost = costs[i]
+            j.current_extraction.DYNCPR_payoff = payoffs[i]
             j.current_extraction.DYNCPR_resource = self.current_resource
+            j.current_extraction.DYNCPR_extraction_time_end = the_time
 
         # ----------------------------------------------------------------------
         # save the group extraction with the resource stock
+        # in STORAGE_CHANGE_POINTS mode only if the group extraction changed,
+        # otherwise the validity of the open row is extended
         # ----------------------------------------------------------------------
-        self.current_extraction = GroupExtractionDYNCPR(
-            self.current_period, the_time, group_extrac, self.current_resource)
-        self.le2mserv.gestionnaire_base.ajouter(self.current_extraction)
-        self.extractions.append(self.current_extraction)
+        self.current_extraction = GroupExtractionRecord(
+            self, self.current_period, the_time, group_extrac,
+            self.current_resource)
+        opened = self.__open_extraction
+        if opened is not None and \
+                opened.DYNCPR_period == self.current_period and \
+                opened.DYNCPR_group_extraction == group_extrac:
+            opened.DYNCPR_time_end = the_time
+        else:
+            if opened is not None:
+                opened.sealed = True
+            if self.change_points:
+                self.current_extraction.sealed = False
+                self.__open_extraction = self.current_extraction
+            self.writer.add(self.current_extraction)
         logger.debug(
             "{} update_data extraction {:.2f} - resource {:.2f}".format(
                 self, self.current_extraction.DYNCPR_group_extraction,
@@ -160,23 +248,116 @@ class GroupDYNCPR(Base):
         # ----------------------------------------------------------------------
         # update the remote
         # ----------------------------------------------------------------------
-        cur_player_extrac_dict = {k: v.to_dict() for k, v in
-                                  self.current_players_extractions.items()}
-
-        for j in self.players_part:
-            j.remote.callRemote(
-                "update_data", cur_player_extrac_dict,
-                self.current_extraction.to_dict(), the_time)
-
-    def add_extraction(self, player, extraction):
+        cur_player_extrac_dict, delta = None, dict()
+        large, packed = [], []
+        for j in players_part:
+            if self.large_group and j.protocol >= wire.PROTOCOL_LARGE_GROUP:
+                large.append(j)
+            elif j.protocol >= wire.PROTOCOL_PACKED:
+                packed.append(j)
+        if large:
+            self._send_large_group_update(large, players_part, the_time)
+        if packed:
+            self._broadcast_update(packed, the_time)
+        for j in players_part:
+            if j in large or j in packed:
+                continue
+            elif j.protocol >= wire.PROTOCOL_DELTA:
+                delta.setdefault(j.protocol, []).append(j)
+            else:
+                if cur_player_extrac_dict is None:
+                    cur_player_extrac_dict = {
+                        k: v.to_dict() for k, v in
+                        self.current_players_extractions.items()}
+                call_remote(j.remote, "update_data", (
+                    cur_player_extrac_dict, self.current_extraction.to_dict(),
+                    the_time))
+        for protocol, recipients in delta.items():
+            update = self._encode_update(protocol, recipients)
+            for j in recipients:
+                defer.maybeDeferred(
+                    j.remote.callRemote, "update_data_delta", update,
+                    the_time).addCallbacks(
+                    self.delta_encoders[protocol].acknowledge,
+                    self._delta_failed,
+                    callbackArgs=(j.joueur.uid, ),
+                    errbackArgs=(j.joueur.uid, protocol))
+
+    def _send_large_group_update(self, players_part, all_players_part,
+                                 the_time):
+        """
+        Large-group mode: each member receives its own extraction and the
+        aggregates of the group. The part common to every member is
+        serialized once
+        :param players_part: the parts of the members in large-group mode
+        :param all_players_part: the parts of all the members
+        :param the_time: the time of the update
+        :return:
+        """
+        aggregates = wire.aggregate(
+            [j.current_extraction.DYNCPR_extraction for j in all_players_part],
+            pms.LARGE_GROUP_HISTOGRAM_BINS)
+        shared = wire.pack(
+            wire.group_values(self.current_extraction), aggregates)
+        for j in players_part:
+            call_remote(j.remote, "update_data_large", (
+                shared, wire.member_values(j.current_extraction), the_time))
+
+    def _broadcast_update(self, players_part, the_time):
+        """
+        The update is serialized once for all the members that use
+        PROTOCOL_PACKED
+        :param players_part: the parts of these members
+        :param the_time: the time of the update
+        :return:
+        """
+        protocol = wire.PROTOCOL_PACKED
+        update = self._encode_update(protocol, players_part)
+        encoder = self.delta_encoders[protocol]
+        deferreds = self.broadcaster.broadcast(
+            [j.remote for j in players_part], "update_data_packed", update,
+            the_time)
+        for j, d in zip(players_part, deferreds):
+            d.addCallbacks(encoder.acknowledge, self._delta_failed,
+                           callbackArgs=(j.joueur.uid, ),
+                           errbackArgs=(j.joueur.uid, protocol))
+
+    def _encode_update(self, protocol, recipients):
+        """
+        :param protocol: the protocol of the update
+        :param recipients: the parts of the members that receive it, they are
+        the members of the encoder of the protocol
+        :return: the update
+        """
+        if protocol not in self.delta_encoders:
+            self.delta_encoders[protocol] = wire.DeltaEncoder(
+                [j.joueur.uid for j in recipients],
+                pms.DELTA_KEYFRAME_INTERVAL,
+                self.players_uid if protocol >= wire.PROTOCOL_COMPACT else
+                None)
+        return self.delta_encoders[protocol].encode(
+            self.current_players_extractions, self.current_extraction)
+
+    def _delta_failed(self, failure, uid, protocol):
+        logger.warning("{} update_data_delta {}: {}".format(
+            self, uid, failure.getErrorMessage()))
+        self.delta_encoders[protocol].reject(uid)
+
+    def add_extraction(self, player, extraction, log=True):
         """
 
         :param player: the player at the origin of the extraction
         :param extraction: the amount extracted (Float)
-        :param period: the period number
+        :param log: if False the group extraction is not displayed on the
+        server screen
         :return:
         """
         self.current_players_extractions[player.uid] = extraction
+        self.engine.set_extraction(
+            self.engine_index, self.__players_index[player.uid],
+            extraction.DYNCPR_extraction)
+        if not log:
+            return
         group_extrac = sum(
             [e.DYNCPR_extraction for e in self.current_players_extractions.values()])
 
@@ -191,22 +372,62 @@ class GroupDYNCPR(Base):
 
 class GroupExtractionDYNCPR(Base):
     __tablename__ = "group_dynamicCPR_extractions"
+    __table_args__ = (
+        Index("ix_group_dynamicCPR_extractions_group_period_time",
+              "group_uid", "DYNCPR_period", "DYNCPR_time"), )
     id = Column(Integer, primary_key=True, autoincrement=True)
     group_uid = Column(String, ForeignKey("group_dynamicCPR.uid"))
 
     DYNCPR_period = Column(Integer, default=None)
     DYNCPR_time = Column(Integer)
+    DYNCPR_time_end = Column(Integer)  # last instant the row is valid
     DYNCPR_group_extraction = Column(Float, default=0)
     DYNCPR_resource_stock = Column(Float)
 
     def __init__(self, period, time, value, resource):
         self.DYNCPR_period = period
         self.DYNCPR_time = time
+        self.DYNCPR_time_end = time
         self.DYNCPR_group_extraction = value
         self.DYNCPR_resource_stock = resource
 
     def to_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {c: getattr(self, c) for c in self.COLUMNS}
+
+    def __repr__(self):
+        return "{}".format(self.DYNCPR_group_extraction)
+
+
+# the layout of to_dict is computed once
+GroupExtractionDYNCPR.COLUMNS = tuple(
+    c.name for c in GroupExtractionDYNCPR.__table__.columns)
+
+
+class GroupExtractionRecord(Record):
+    """
+    Lightweight version of GroupExtractionDYNCPR used during the game, written
+    by the WriteBehind of the group
+    """
+    __slots__ = ("DYNCPR_period", "DYNCPR_time", "DYNCPR_time_end",
+                 "DYNCPR_group_extraction", "DYNCPR_resource_stock")
+    table = GroupExtractionDYNCPR.__table__
+
+    def __init__(self, group, period, time, value, resource):
+        self.parent = group
+        self.sealed = True  # open only in STORAGE_CHANGE_POINTS mode
+        self.DYNCPR_period = period
+        self.DYNCPR_time = time
+        self.DYNCPR_time_end = time
+        self.DYNCPR_group_extraction = value
+        self.DYNCPR_resource_stock = resource
 
     def __repr__(self):
-        return "{}".format(self.DYNCPR_group_extraction)
\ No newline at end of file
+        return "{}".format(self.DYNCPR_group_extraction)
+
+    def to_row(self):
+        return {"group_uid": self.parent.uid,
+                "DYNCPR_period": self.DYNCPR_period,
+                "DYNCPR_time": self.DYNCPR_time,
+                "DYNCPR_time_end": self.DYNCPR_time_end,
+                "DYNCPR_group_extraction": self.DYNCPR_group_extraction,
+                "DYNCPR_resource_stock": self.DYNCPR_resource_stock}
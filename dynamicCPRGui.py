@@ -18,7 +18,7 @@ from PyQt4.QtCore import Qt, QTimer, QTime
 import random
 from datetime import timedelta
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from twisted.internet.defer import AlreadyCalledError
 import numpy as np
 
@@ -86,24 +86,134 @@ class MySlider(QWidget):
         return self.slider.value() / int(1 / pms.DECISION_STEP)
 
 
-class PlotExtraction(QWidget):
+class PartFigure(QWidget):
     """
-    This widget plot the individual extractions
+    The graphs of the part (extractions, payoff and resource) in one
+    matplotlib Figure. The figure is not registered in pyplot: it is created
+    once per part by the remote (see RemoteDYNCPR.get_figure), displayed by
+    the decision screen then by the summary screen, and freed by release at
+    the end of the part.
+    The curves are animated artists: the static part of the figure (axes,
+    ticks, grid, legend) is rendered by a full draw and cached, then
+    update_plot only draws the curves on the cached background. Each full
+    draw (first display, resize) rebuilds the cache.
     """
-    def __init__(self, cltuid, extractions_indiv, extraction_group):
+    def __init__(self, remote):
         QWidget.__init__(self)
 
-        self.extractions_indiv = extractions_indiv
-        self.extraction_group = extraction_group
-
         layout = QVBoxLayout()
         self.setLayout(layout)
 
-        self.fig = plt.figure()
+        self.fig = Figure()
         self.canvas = FigureCanvas(self.fig)
         layout.addWidget(self.canvas)
 
-        self.graph = self.fig.add_subplot(111, position=[0.15, 0.15, 0.75, 0.75])
+        self.curves = []
+        self.curves_data = []
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+        self.fig.subplots_adjust(left=0.08, right=0.97, bottom=0.08,
+                                 top=0.95, hspace=0.35, wspace=0.2)
+        self.plot_extraction = PlotExtraction(
+            self, self.fig.add_subplot(2, 1, 1), remote.le2mclt.uid,
+            remote.extractions_indiv, remote.extraction_group,
+            remote.extraction_aggregates)
+        self.plot_payoff = PlotPayoff(
+            self, self.fig.add_subplot(2, 2, 3), remote.payoff_part)
+        self.plot_resource = PlotResource(
+            self, self.fig.add_subplot(2, 2, 4), remote.resource)
+        self.plot_data = [remote.extraction_group, remote.payoff_part,
+                          remote.resource] + \
+            list(remote.extractions_indiv.values()) + \
+            list(remote.extraction_aggregates or [])
+
+    def add_curve(self, graph, plot_data, *args, **kwargs):
+        """
+        Create the curve of plot_data in graph
+        :param graph: the Axes
+        :param plot_data: PlotData
+        :param args, kwargs: for Axes.plot
+        :return:
+        """
+        plot_data.curve, = graph.plot(
+            plot_data.xdata, plot_data.ydata, *args, animated=True, **kwargs)
+        self.curves.append(plot_data.curve)
+        self.curves_data.append(plot_data)
+
+    def _draw_curves(self):
+        for curve in self.curves:
+            curve.axes.draw_artist(curve)
+
+    def _set_max_points(self):
+        """
+        Each curve keeps at most 2 points (min and max) per pixel of its
+        graph, see PlotData.update_curve
+        """
+        for plot_data in self.curves_data:
+            max_points = 2 * max(int(plot_data.curve.axes.bbox.width), 1)
+            if max_points != plot_data.max_points:
+                plot_data.max_points = max_points
+                plot_data.update_curve()
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._set_max_points()
+        self._draw_curves()
+
+    def update_plot(self):
+        """
+        Redraw the curves, the whole figure if there is no background yet
+        :return:
+        """
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_curves()
+        self.canvas.blit(self.fig.bbox)
+
+    def release(self):
+        """
+        Free the figure, the PlotData don't keep their curve
+        :return:
+        """
+        for plot_data in self.plot_data:
+            plot_data.curve = None
+            plot_data.max_points = None
+        del self.curves[:]
+        del self.curves_data[:]
+        self.background = None
+        self.fig.clear()
+        self.setParent(None)
+        self.deleteLater()
+
+
+class PartGraph(object):
+    """
+    Base class of the graphs of the PartFigure
+    """
+    def __init__(self, part_figure, graph):
+        self.part_figure = part_figure
+        self.graph = graph
+
+    def add_curve(self, plot_data, *args, **kwargs):
+        self.part_figure.add_curve(self.graph, plot_data, *args, **kwargs)
+
+
+class PlotExtraction(PartGraph):
+    """
+    This widget plot the individual extractions
+    In large-group mode aggregates contains the PlotData of the mean, min and
+    max extraction of the group
+    """
+    def __init__(self, part_figure, graph, cltuid, extractions_indiv,
+                 extraction_group, aggregates=None):
+        PartGraph.__init__(self, part_figure, graph)
+
+        self.extractions_indiv = extractions_indiv
+        self.extraction_group = extraction_group
+        self.aggregates = aggregates
 
         if pms.DYNAMIC_TYPE == pms.DISCRETE:
             self.graph.set_xlim(-1, pms.NOMBRE_PERIODES + 1)
@@ -120,20 +230,24 @@ class PlotExtraction(QWidget):
             curve_marker = ""
 
         # curves
-        if self.extraction_group.curve is None:
-            self.extraction_group.curve, = self.graph.plot(
-                self.extraction_group.xdata, self.extraction_group.ydata,
-                "-k", marker=curve_marker, color="black",
-                label=trans_DYNCPR(u"Pair extraction"))
+        self.add_curve(self.extraction_group, "-k", marker=curve_marker,
+                       color="black", label=trans_DYNCPR(u"Pair extraction"))
 
         for k, v in self.extractions_indiv.items():
             lab = trans_DYNCPR(u"Your extraction") if k == cltuid else \
                 trans_DYNCPR(u"Other player's extraction")
             col = "green" if k == cltuid else "blue"
-            if v.curve is None:
-                v.curve, = self.graph.plot(
-                    v.xdata, v.ydata, ls="-", marker=curve_marker, color=col,
-                    label=lab)
+            self.add_curve(v, ls="-", marker=curve_marker, color=col,
+                           label=lab)
+
+        if self.aggregates is not None:
+            labels = [trans_DYNCPR(u"Mean extraction of the group"),
+                      trans_DYNCPR(u"Min extraction of the group"),
+                      trans_DYNCPR(u"Max extraction of the group")]
+            styles = ["-", ":", ":"]
+            for v, lab, style in zip(self.aggregates, labels, styles):
+                self.add_curve(v, ls=style, marker=curve_marker,
+                               color="blue", label=lab)
 
         self.graph.set_ylim(-0.1, pms.DECISION_MAX+0.1)
         self.graph.set_yticks(
@@ -143,28 +257,18 @@ class PlotExtraction(QWidget):
         self.graph.grid()
         self.graph.legend(loc="upper left", ncol=pms.TAILLE_GROUPES+1,
                           fontsize=9)
-        self.canvas.draw()
 
 
-class PlotResource(QWidget):
+class PlotResource(PartGraph):
     """
     Display the curves with the total extraction of the group and the curve of
     the stock of resource
     """
-    def __init__(self, resource):
-        QWidget.__init__(self)
+    def __init__(self, part_figure, graph, resource):
+        PartGraph.__init__(self, part_figure, graph)
 
         self.resource = resource
 
-        layout = QVBoxLayout()
-        self.setLayout(layout)
-
-        self.fig = plt.figure()
-        self.canvas = FigureCanvas(self.fig)
-        layout.addWidget(self.canvas)
-
-        self.graph = self.fig.add_subplot(111, position=[0.15, 0.15, 0.75, 0.75])
-
         if pms.DYNAMIC_TYPE == pms.DISCRETE:
             self.graph.set_xlim(-1, pms.NOMBRE_PERIODES + 1)
             self.graph.set_xlabel(trans_DYNCPR(u"Periods"))
@@ -179,34 +283,21 @@ class PlotResource(QWidget):
             self.graph.set_xlabel(trans_DYNCPR(u"Time (seconds)"))
             curve_marker = ""
 
-        if self.resource.curve is None:
-            self.resource.curve, = self.graph.plot(
-                self.resource.xdata, self.resource.ydata,
-                "-k", marker=curve_marker)
+        self.add_curve(self.resource, "-k", marker=curve_marker)
 
         self.graph.set_ylim(0, pms.RESOURCE_INITIAL_STOCK * 3)
         self.graph.set_yticks(range(0, pms.RESOURCE_INITIAL_STOCK * 3 + 1, 5))
         self.graph.set_ylabel("")
         self.graph.set_title(trans_DYNCPR(u"Available resource"))
         self.graph.grid()
-        self.canvas.draw()
 
 
-class PlotPayoff(QWidget):
-    def __init__(self, payoffs):
-        super(PlotPayoff, self).__init__()
+class PlotPayoff(PartGraph):
+    def __init__(self, part_figure, graph, payoffs):
+        super(PlotPayoff, self).__init__(part_figure, graph)
 
         self.payoffs = payoffs
 
-        layout = QVBoxLayout()
-        self.setLayout(layout)
-
-        self.fig = plt.figure()
-        self.canvas = FigureCanvas(self.fig)
-        layout.addWidget(self.canvas)
-
-        self.graph = self.fig.add_subplot(111, position=[0.15, 0.15, 0.75, 0.75])
-
         if pms.DYNAMIC_TYPE == pms.DISCRETE:
             self.graph.set_xlim(-1, pms.NOMBRE_PERIODES + 1)
             self.graph.set_xlabel(trans_DYNCPR(u"Periods"))
@@ -221,17 +312,43 @@ class PlotPayoff(QWidget):
             self.graph.set_xlabel(trans_DYNCPR(u"Time (seconds)"))
             curve_marker = ""
 
-        if self.payoffs.curve is None:
-            self.payoffs.curve, = self.graph.plot(
-                self.payoffs.xdata, self.payoffs.ydata,
-                "-k", marker=curve_marker)
+        self.add_curve(self.payoffs, "-k", marker=curve_marker)
 
         self.graph.set_ylim(0, 250)
         self.graph.set_yticks(range(0, 271, 20))
         self.graph.set_ylabel("")
         self.graph.set_title(trans_DYNCPR(u"Part payoff"))
         self.graph.grid()
-        self.canvas.draw()
+
+
+class InfosTable(QTableWidget):
+    """
+    Display the last updates (see RemoteDYNCPR.infos), the newest on the
+    first line. Only the rows added since the previous call of update_rows are
+    created, the table keeps at most size rows.
+    """
+    def __init__(self, head, size):
+        QTableWidget.__init__(self, 0, len(head))
+        self.size = size
+        self.count = 0  # the number of rows of the remote already displayed
+        self.setHorizontalHeaderLabels(head)
+        self.verticalHeader().setVisible(False)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+
+    def update_rows(self, infos, count):
+        """
+        :param infos: the rows, the newest first
+        :param count: the number of rows added to infos since the beginning
+        :return:
+        """
+        for i in reversed(range(min(count - self.count, len(infos)))):
+            self.insertRow(0)
+            for col, value in enumerate(infos[i]):
+                self.setItem(0, col, QTableWidgetItem(value))
+        while self.rowCount() > self.size:
+            self.removeRow(self.rowCount() - 1)
+        self.count = count
 
 
 # ==============================================================================
@@ -338,29 +455,20 @@ class GuiDecision(QDialog):
         self.plot_layout = QGridLayout()
         layout.addLayout(self.plot_layout)
 
-        # extractions (indiv + group)
-        self.plot_extraction = PlotExtraction(
-            self.remote.le2mclt.uid, self.remote.extractions_indiv,
-            self.remote.extraction_group)
-        self.plot_layout.addWidget(self.plot_extraction, 0, 0)
-
-        # payoff indiv
-        self.plot_payoff = PlotPayoff(self.remote.payoff_part)
-        self.plot_layout.addWidget(self.plot_payoff, 0, 1)
-
-        # resource
-        self.plot_resource = PlotResource(self.remote.resource)
-        self.plot_layout.addWidget(self.plot_resource, 1, 0)
+        # extractions (indiv + group), payoff indiv and resource
+        self.part_figure = self.remote.get_figure()
+        self.plot_layout.addWidget(self.part_figure, 0, 0)
 
         # value in text mode
         widget_infos = QWidget()
         widget_infos.setLayout(QVBoxLayout())
-        self.textEdit_infos = QTextEdit()
-        self.textEdit_infos.setReadOnly(True)
-        self.textEdit_infos.setHtml(self.remote.text_infos)
-        widget_infos.layout().addWidget(self.textEdit_infos)
-        self.plot_layout.addWidget(widget_infos, 1, 1)
-        self.plot_layout.setColumnStretch(0, 1)
+        self.table_infos = InfosTable(self.remote.infos_head,
+                                      pms.INFOS_HISTORY)
+        self.table_infos.update_rows(self.remote.infos,
+                                     self.remote.infos_count)
+        widget_infos.layout().addWidget(self.table_infos)
+        self.plot_layout.addWidget(widget_infos, 0, 1)
+        self.plot_layout.setColumnStretch(0, 3)
         self.plot_layout.setColumnStretch(1, 1)
 
         # ----------------------------------------------------------------------
@@ -380,6 +488,13 @@ class GuiDecision(QDialog):
         self.setWindowTitle(trans_DYNCPR(u"Decision"))
 
         if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            # at most one extraction sent per NEW_EXTRACTION_WINDOW
+            self.extrac_to_send = None
+            self.timer_send = QTimer()
+            self.timer_send.setSingleShot(True)
+            self.timer_send.setInterval(
+                int(pms.NEW_EXTRACTION_WINDOW.total_seconds() * 1000))
+            self.timer_send.timeout.connect(self.send_pending_extrac)
             self.extract_dec.slider.sliderReleased.connect(self.send_extrac)
             if self.remote.le2mclt.automatique:
                 self.extract_dec.slider.valueChanged.connect(self.send_extrac)
@@ -399,12 +514,24 @@ class GuiDecision(QDialog):
     
     def send_extrac(self):
         dec = self.extract_dec.value()
-        logger.info("{} send {}".format(self.remote.le2mclt, dec))
         if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
-            self.remote.server_part.callRemote("new_extraction", dec)
+            # the value is sent now if nothing has been sent during the
+            # window, otherwise the last value is sent at the end of the window
+            self.extrac_to_send = dec
+            if not self.timer_send.isActive():
+                self.send_pending_extrac()
         elif pms.DYNAMIC_TYPE == pms.DISCRETE:
+            logger.info("{} send {}".format(self.remote.le2mclt, dec))
             self.defered.callback(dec)
 
+    def send_pending_extrac(self):
+        if self.extrac_to_send is None:
+            return
+        dec, self.extrac_to_send = self.extrac_to_send, None
+        logger.info("{} send {}".format(self.remote.le2mclt, dec))
+        self.remote.send_extraction(dec)
+        self.timer_send.start()
+
     def update_data_and_graphs(self):
         if self.remote.le2mclt.automatique:
             if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
@@ -416,10 +543,9 @@ class GuiDecision(QDialog):
                 self.extract_dec.slider.setValue(random.randint(
                     pms.DECISION_MIN,
                     pms.DECISION_MAX * int(1 / pms.DECISION_STEP)))
-        self.plot_extraction.canvas.draw()
-        self.plot_resource.canvas.draw()
-        self.plot_payoff.canvas.draw()
-        self.textEdit_infos.setHtml(self.remote.text_infos)
+        self.part_figure.update_plot()
+        self.table_infos.update_rows(self.remote.infos,
+                                     self.remote.infos_count)
         if pms.DYNAMIC_TYPE == pms.DISCRETE:
             self.label_period.setText(le2mtrans(u"Period") + u" {}".format(
                 self.remote.currentperiod))
@@ -428,6 +554,7 @@ class GuiDecision(QDialog):
     def end_of_time(self):
         try:
             self.timer_continuous.stop()
+            self.timer_send.stop()
         except AttributeError:  # if dynamic == discrete
             pass
         if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
@@ -439,39 +566,25 @@ class GuiDecision(QDialog):
 
 
 class GuiSummary(QDialog):
-    def __init__(self, remote, defered, the_text=""):
+    def __init__(self, remote, defered, the_text="", send_curves=True):
         super(GuiSummary, self).__init__(remote.le2mclt.screen)
 
         self.remote = remote
         self.defered = defered
+        self.send_curves = send_curves
 
         layout = QVBoxLayout(self)
 
         # ----------------------------------------------------------------------
         # GRAPHICAL AREA
         # ----------------------------------------------------------------------
-        for v in self.remote.extractions_indiv.values():
-            v.curve = None
-        self.remote.extraction_group.curve = None
-        self.remote.resource.curve = None
-        self.remote.payoff_part.curve = None
-
         self.plot_layout = QGridLayout()
         layout.addLayout(self.plot_layout)
 
-        # extractions (indiv + group)
-        self.plot_extraction = PlotExtraction(
-            self.remote.le2mclt.uid, self.remote.extractions_indiv,
-            self.remote.extraction_group)
-        self.plot_layout.addWidget(self.plot_extraction, 0, 0)
-
-        # payoff indiv
-        self.plot_payoff = PlotPayoff(self.remote.payoff_part)
-        self.plot_layout.addWidget(self.plot_payoff, 0, 1)
-
-        # resource
-        self.plot_resource = PlotResource(self.remote.resource)
-        self.plot_layout.addWidget(self.plot_resource, 1, 0)
+        # the figure of the decision screen, with all the curves
+        self.part_figure = self.remote.get_figure()
+        self.plot_layout.addWidget(self.part_figure, 0, 0)
+        self.part_figure.update_plot()
 
         # value in text mode
         widget_infos = QWidget()
@@ -480,8 +593,8 @@ class GuiSummary(QDialog):
         self.textEdit_infos.setReadOnly(True)
         self.textEdit_infos.setText(the_text)
         widget_infos.layout().addWidget(self.textEdit_infos)
-        self.plot_layout.addWidget(widget_infos, 1, 1)
-        self.plot_layout.setColumnStretch(0, 1)
+        self.plot_layout.addWidget(widget_infos, 0, 1)
+        self.plot_layout.setColumnStretch(0, 3)
         self.plot_layout.setColumnStretch(1, 1)
 
         # ----------------------------------------------------------------------
@@ -508,18 +621,15 @@ class GuiSummary(QDialog):
         except AttributeError:
             pass
         # ----------------------------------------------------------------------
-        # we send back the different individual curves
+        # we send back the different individual curves, if the server asks
         # ----------------------------------------------------------------------
-        extract_indiv = self.remote.extractions_indiv[self.remote.le2mclt.uid]
-        data_indiv = {
-            "extractions": zip(extract_indiv.xdata, extract_indiv.ydata),
-            "payoffs": zip(self.remote.payoff_part.xdata,
-                           np.array(self.remote.payoff_part.ydata).tolist()),
-            "cost": zip(self.remote.cost.xdata, self.remote.cost.ydata)
-        }
-        logger.debug("{} send curves".format(self.remote.le2mclt))
+        data_indiv = None
+        if self.send_curves:
+            data_indiv = self.remote.get_curves()
+            logger.debug("{} send curves".format(self.remote.le2mclt))
         self.defered.callback(data_indiv)
         self.accept()
+        self.remote.release_figure()
 
     def reject(self):
         pass
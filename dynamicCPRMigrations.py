@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the migrations of the database of the part, for the
+databases created by an older version of the part.
+The columns added to the existing tables are created by upgrade, that the
+server runs at the start of the part (see COLUMN_MIGRATIONS), the other
+migrations are run by hand.
+Usage, from the directory of the part with le2m in the path:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import dynamicCPRMigrations
+    engine = create_engine("sqlite:///path/to/the/database.sqlite")
+    session = sessionmaker(bind=engine)()
+    dynamicCPRMigrations.add_missing_columns(session)
+    dynamicCPRMigrations.create_indexes(session)
+    dynamicCPRMigrations.migrate_curves_to_blobs(session)
+"""
+
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from dynamicCPRPart import PartieDYNCPR, RepetitionsDYNCPR, \
+    ExtractionsDYNCPR, CurveDYNCPR, CurveBlobDYNCPR
+from dynamicCPRGroup import GroupDYNCPR, GroupExtractionDYNCPR
+from dynamicCPRStore import load_point_curves
+
+
+logger = logging.getLogger("le2m")
+
+
+MODELS = (GroupDYNCPR, GroupExtractionDYNCPR, PartieDYNCPR, RepetitionsDYNCPR,
+          ExtractionsDYNCPR, CurveDYNCPR, CurveBlobDYNCPR)
+
+
+def add_columns(session, model, names=None):
+    """
+    Add to the table of the model the columns that the database doesn't have
+    yet. The values of the existing rows are NULL.
+    Nothing is done if the table doesn't exist in the database (it will be
+    created with all its columns).
+    :param session: SQLAlchemy session on the database
+    :param model: the model (ExtractionsDYNCPR...)
+    :param names: the names of the columns, all the columns by default
+    :return: the names (table.column) of the added columns
+    """
+    connection = session.connection()
+    inspector = inspect(connection)
+    table = model.__table__
+    if table.name not in inspector.get_table_names():
+        return []
+    existing = set(c["name"] for c in inspector.get_columns(table.name))
+    added = []
+    for column in table.columns:
+        if column.name in existing or \
+                (names is not None and column.name not in names):
+            continue
+        connection.execute(text("ALTER TABLE {} ADD COLUMN {}".format(
+            table.name, CreateColumn(column).compile(
+                dialect=connection.dialect))))
+        added.append("{}.{}".format(table.name, column.name))
+        logger.info("Column {} added to {}".format(column.name, table.name))
+    session.commit()
+    return added
+
+
+def add_missing_columns(session):
+    """
+    Add to the tables of the part every column created after the database,
+    so that the models can read the older databases.
+    :param session: SQLAlchemy session on the database
+    :return: the names (table.column) of the added columns
+    """
+    added = []
+    for model in MODELS:
+        added += add_columns(session, model)
+    return added
+
+
+# ------------------------------------------------------------------------------
+# COLUMNS, by version of the part
+# ------------------------------------------------------------------------------
+
+
+def add_change_points_columns(session):
+    """
+    STORAGE_CHANGE_POINTS: the last instant each group extraction row and
+    each individual extraction is valid
+    :param session: SQLAlchemy session on the database
+    :return: the names (table.column) of the added columns
+    """
+    return add_columns(session, GroupExtractionDYNCPR,
+                       ["DYNCPR_time_end"]) + \
+        add_columns(session, ExtractionsDYNCPR,
+                    ["DYNCPR_extraction_time_end"])
+
+
+def add_dropped_extractions_column(session):
+    """
+    The number of extractions of each repetition replaced by a later one
+    before being used by the group
+    :param session: SQLAlchemy session on the database
+    :return: the names (table.column) of the added columns
+    """
+    return add_columns(session, RepetitionsDYNCPR,
+                       ["DYNCPR_dropped_extractions"])
+
+
+def add_timeouts_columns(session):
+    """
+    The deadlines of the remote calls missed in each repetition, and the
+    default extraction given instead of a missed decision
+    :param session: SQLAlchemy session on the database
+    :return: the names (table.column) of the added columns
+    """
+    return add_columns(session, RepetitionsDYNCPR,
+                       ["DYNCPR_timeouts", "DYNCPR_default_extraction"])
+
+
+# the column migrations, in the order of the versions of the part
+COLUMN_MIGRATIONS = [add_change_points_columns,
+                     add_dropped_extractions_column, add_timeouts_columns]
+
+
+def upgrade(session):
+    """
+    Run the column migrations, so that the part can write in a database
+    created by an older version. Run by the server at the start of the part,
+    it does nothing if the database is up to date.
+    :param session: SQLAlchemy session on the database
+    :return: the names (table.column) of the added columns
+    """
+    added = []
+    for migration in COLUMN_MIGRATIONS:
+        added += migration(session)
+    return added
+
+
+def create_indexes(session):
+    """
+    Create the indexes of the tables of the part (see the __table_args__ of
+    the tables) that the database doesn't have yet. The databases created
+    before the indexes only have the primary keys, so every query by group,
+    part or repetition is a scan of the whole table.
+    The tables that don't exist in the database are skipped.
+    :param session: SQLAlchemy session on the database
+    :return: the names of the created indexes
+    """
+    connection = session.connection()
+    inspector = inspect(connection)
+    tables = inspector.get_table_names()
+    created = []
+    for model in MODELS:
+        table = model.__table__
+        if table.name not in tables:
+            continue
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name in existing:
+                continue
+            index.create(connection)
+            created.append(index.name)
+            logger.info("Index {} created on {}".format(index.name,
+                                                        table.name))
+    session.commit()
+    return created
+
+
+def migrate_curves_to_blobs(session, delete=True):
+    """
+    Convert the curves stored with one row per point
+    (partie_dynamicCPR_curves) into one blob row per curve
+    (partie_dynamicCPR_curves_blob). The parts that already have blob curves
+    are skipped, so the migration can be run again. Each part is committed
+    on its own.
+    :param session: SQLAlchemy session on the database
+    :param delete: if True the point rows of the converted parts are deleted
+    :return: the number of curves created
+    """
+    CurveBlobDYNCPR.__table__.create(session.get_bind(), checkfirst=True)
+    converted = set(r[0] for r in session.query(
+        CurveBlobDYNCPR.partie_id).distinct())
+    partie_ids = [r[0] for r in session.query(
+        CurveDYNCPR.partie_id).distinct()]
+
+    count = 0
+    for partie_id in partie_ids:
+        if partie_id in converted:
+            continue
+        points = session.query(CurveDYNCPR).filter(
+            CurveDYNCPR.partie_id == partie_id)
+        curves = load_point_curves(points.all())
+        for c_type, (xdata, ydata) in sorted(curves.items()):
+            blob = CurveBlobDYNCPR(c_type, xdata, ydata)
+            blob.partie_id = partie_id
+            session.add(blob)
+            count += 1
+        if delete:
+            points.delete(synchronize_session=False)
+        session.commit()
+        logger.info("Curves of part {}: {} curves converted".format(
+            partie_id, len(curves)))
+    return count
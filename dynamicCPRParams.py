@@ -30,6 +30,15 @@ PAYOFF = 1
 RESOURCE = 2
 COST = 3
 
+# used to set STORAGE_MODE
+STORAGE_EVERY_TICK = 0  # one group extraction row per tick
+STORAGE_CHANGE_POINTS = 1  # one row each time the group extraction changes
+
+# used to set DECISION_DEFAULT
+DEFAULT_LAST_EXTRACTION = 0  # the last extraction of the player
+DEFAULT_ZERO = 1
+DEFAULT_POLICY = 2  # see get_policy_extraction
+
 # ------------------------------------------------------------------------------
 # PARAMETERS
 # ------------------------------------------------------------------------------
@@ -38,12 +47,20 @@ TREATMENT = BASELINE  # for future treatments
 TAUX_CONVERSION = 0.05
 NOMBRE_PERIODES = 1  # only for dynamic == discrete
 TAILLE_GROUPES = 2  # should not be changed without asking Dimitri
+# from this size the members receive only their own extraction and the
+# aggregates of the group (total, mean, min, max and histogram)
+LARGE_GROUP_SIZE = 5
+LARGE_GROUP_HISTOGRAM_BINS = 0  # 0 for no histogram
 MONNAIE = u"ecu"
 
 # DECISION
 DECISION_MIN = 0
 DECISION_MAX = 2.8
 DECISION_STEP = 0.01
+# continuous game: the remote sends at most one extraction (the last one) per
+# window. On the server the extractions received between two updates are
+# merged
+NEW_EXTRACTION_WINDOW = timedelta(milliseconds=500)
 
 PARTIE_ESSAI = False
 
@@ -52,8 +69,50 @@ DYNAMIC_TYPE = CONTINUOUS
 CONTINUOUS_TIME_DURATION = timedelta(seconds=60)  # can be changed in config screen
 # time for the player to take a decision
 DISCRETE_DECISION_TIME = timedelta(seconds=10)
+# DEADLINES: the server doesn't wait longer for the answer of a remote, the
+# missed deadlines are counted in DYNCPR_timeouts of the repetition. Each
+# deadline can be set to None to wait as long as needed
+# decisions: the time of the decision screen (DISCRETE_DECISION_TIME or
+# CONTINUOUS_TIME_DURATION) plus this margin
+DECISION_DEADLINE_MARGIN = timedelta(seconds=5)
+# initial extraction
+INITIAL_EXTRACTION_DEADLINE = timedelta(seconds=120)
+# the calls that don't wait for the subject: configure, newperiod,
+# end_update_data and set_payoffs
+REMOTE_DEADLINE = timedelta(seconds=30)
+# summary screen, the subjects read it at their own pace (everything is
+# already stored)
+SUMMARY_DEADLINE = timedelta(minutes=5)
+# the extraction given for a missed initial extraction and, in the discrete
+# game, for a missed decision (stored in DYNCPR_default_extraction). In the
+# continuous game a missed decision screen is only counted: the player keeps
+# his current extraction until the end of the part
+DECISION_DEFAULT = DEFAULT_LAST_EXTRACTION
+# discrete game: if True each group starts its next period as soon as its
+# members have decided, the groups only wait for each other at the end of the
+# part (see dynamicCPRScheduler.PeriodScheduler)
+DISCRETE_GROUPS_ASYNCHRONOUS = True
 # milliseconds
 TIMER_UPDATE = timedelta(seconds=1)  # refresh the group data and the graphs
+# the remotes receive only the values that changed, and the full data every
+# DELTA_KEYFRAME_INTERVAL updates
+DELTA_KEYFRAME_INTERVAL = 30
+# number of updates displayed in the information table of the decision screen
+INFOS_HISTORY = 20
+
+# DATABASE
+# the extractions are written by blocks, at this interval and at the end of
+# the period / part
+PERSISTENCE_FLUSH_INTERVAL = timedelta(seconds=10)
+# if True the rows are written by a separate process (see dynamicCPRWorker)
+PERSISTENCE_WORKER = False
+PERSISTENCE_WORKER_BATCH = 1000  # max number of rows per commit
+# only for dynamic == continuous, see dynamicCPRStore.expand_group_extractions
+# to get back one value per tick
+STORAGE_MODE = STORAGE_EVERY_TICK
+# the payoffs and the curves of the part are computed by the server. If True
+# the remotes also send their curves, only to check the server's ones
+CURVES_CROSS_CHECK = False
 
 # ------------------------------------------------------------------------------
 # RESOURCE
@@ -74,70 +133,78 @@ param_r = 0.005
 param_tau = 0.1
 
 
-def get_infinite_payoff(t, resource, extraction, extraction_group):
-    calcul = 0
-
-    if DYNAMIC_TYPE == CONTINUOUS:
-        constante = RESOURCE_GROWTH - extraction_group
-        try:
-            tm = ((param_c0 / param_c1) + constante * t - resource) / constante
-            t0 = (constante * t - resource) / constante
-        except ZeroDivisionError:
-            pass
-
-        if resource >= (param_c0 / param_c1):
-
-            if constante >= 0:  # cas 1.1
-                calcul = (param_a * extraction - (param_b / 2) * pow(extraction,
-                                                                     2)) * \
-                         (np.exp(- param_r * t) / param_r)
-
-            else:  # cas 1.2
-                calcul = (param_a * extraction - (param_b / 2) * pow(extraction,
-                                                                     2)) * \
-                         ((np.exp(- param_r * t) - np.exp(
-                             - param_r * t0)) / param_r) - \
-                         extraction * (
-                                     param_c0 - param_c1 * resource + constante * param_c1 * t) * \
-                         ((np.exp(- param_r * tm) - np.exp(
-                             - param_r * t0)) / param_r) + \
-                         (extraction * param_c1 * constante) * \
-                         ((1 + param_r * tm) * np.exp(-param_r * tm) - (
-                                     1 + param_r * t0) * np.exp(
-                             -param_r * t0)) / pow(param_r, 2)
-
-        else:
-
-            if constante > 0:  # cas 1.3
-                calcul = (param_a * extraction - (param_b / 2) * pow(extraction,
-                                                                     2)) * \
-                         (np.exp(- param_r * t) / param_r) - \
-                         extraction * (
-                                     param_c0 - param_c1 * resource + constante * param_c1 * t) * \
-                         ((np.exp(- param_r * t) - np.exp(
-                             - param_r * tm)) / param_r) + \
-                         (extraction * param_c1 * constante) * \
-                         ((1 + param_r * t) * np.exp(-param_r * t) - (
-                                     1 + param_r * tm) * np.exp(
-                             -param_r * tm)) / pow(param_r, 2)
-
-            elif constante < 0:  # cas 1.4
-                calcul = (param_a * extraction - (param_b / 2) * pow(extraction,
-                                                                     2) -
-                          extraction * (
-                                      param_c0 - param_c1 * resource + constante * param_c1 * t)) * \
-                         ((np.exp(- param_r * t) - np.exp(
-                             - param_r * t0)) / param_r) + \
-                         (extraction * param_c1 * constante) * \
-                         ((1 + param_r * t) * np.exp(-param_r * t) - (
-                                     1 + param_r * t0) * np.exp(
-                             -param_r * t0)) / pow(param_r, 2)
-
-            else:  # cas 1.5
-                calcul = (param_a * extraction - (param_b / 2) * pow(extraction,
-                                                                     2) -
-                          extraction * (param_c0 - param_c1 * resource)) * \
-                         (np.exp(- param_r * t) / param_r)
-
-    return calcul
+def get_policy_extraction(resource, group_size):
+    """
+    The extraction given to a player who missed the deadline of a decision,
+    if DECISION_DEFAULT == DEFAULT_POLICY: the player's share of the growth
+    of the resource, so that the stock stays the same if the other members
+    do the same, and never more than his share of the available stock.
+    :param resource: the current resource stock of the group
+    :param group_size: the number of members of the group
+    :return: the extraction
+    """
+    return max(0, min(RESOURCE_GROWTH, resource)) / float(group_size)
+
+
+def get_infinite_payoff_array(t, resource, extraction, extraction_group):
+    """
+    Infinite payoff for arrays of (t, resource, extraction, extraction_group)
+    (they are broadcast together). The five cases are computed for every
+    element with the same exponentials, and each element takes the value of
+    its case.
+    If the extraction of the group is equal to the growth of the resource
+    (constante == 0) tm and t0 don't exist, only the cases 1.1 and 1.5 are
+    possible and they don't use them.
+    :return: numpy array, 0 if dynamic != continuous
+    """
+    t, resource, extraction, extraction_group = [
+        np.asarray(a, dtype=float) for a in
+        (t, resource, extraction, extraction_group)]
+    if DYNAMIC_TYPE != CONTINUOUS:
+        return np.zeros(np.broadcast(
+            t, resource, extraction, extraction_group).shape)
+
+    constante = RESOURCE_GROWTH - extraction_group
+    divisor = np.where(constante == 0, 1., constante)
+    tm = ((param_c0 / param_c1) + constante * t - resource) / divisor
+    t0 = (constante * t - resource) / divisor
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        # the exponentials of the cases that are not used can overflow
+        exp_t = np.exp(- param_r * t)
+        exp_tm = np.exp(- param_r * tm)
+        exp_t0 = np.exp(- param_r * t0)
+        texp_t = (1 + param_r * t) * exp_t
+        texp_tm = (1 + param_r * tm) * exp_tm
+        texp_t0 = (1 + param_r * t0) * exp_t0
+
+        benefit = param_a * extraction - (param_b / 2) * pow(extraction, 2)
+        cost = extraction * (
+            param_c0 - param_c1 * resource + constante * param_c1 * t)
+        slope = extraction * param_c1 * constante
+
+        case_1_1 = benefit * (exp_t / param_r)
+        case_1_2 = benefit * ((exp_t - exp_t0) / param_r) - \
+            cost * ((exp_tm - exp_t0) / param_r) + \
+            slope * (texp_tm - texp_t0) / pow(param_r, 2)
+        case_1_3 = benefit * (exp_t / param_r) - \
+            cost * ((exp_t - exp_tm) / param_r) + \
+            slope * (texp_t - texp_tm) / pow(param_r, 2)
+        case_1_4 = (benefit - cost) * ((exp_t - exp_t0) / param_r) + \
+            slope * (texp_t - texp_t0) / pow(param_r, 2)
+        case_1_5 = (benefit - extraction * (
+            param_c0 - param_c1 * resource)) * (exp_t / param_r)
+
+    high = resource >= (param_c0 / param_c1)
+    return np.select(
+        [high & (constante >= 0), high, constante > 0, constante < 0],
+        [case_1_1, case_1_2, case_1_3, case_1_4], case_1_5)
 
+
+def get_infinite_payoff(t, resource, extraction, extraction_group):
+    """
+    Scalar version of get_infinite_payoff_array
+    :return: float
+    """
+    return float(get_infinite_payoff_array(
+        t, resource, extraction, extraction_group))
@@ -5,11 +5,16 @@ from datetime import datetime
 from twisted.internet import defer
 from twisted.spread import pb  # because some functions can be called remotely
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import (Column, Integer, Float, Boolean, ForeignKey, DateTime,
+                        String, LargeBinary, Index)
 from server.servbase import Base
 from server.servparties import Partie
 from util.utiltools import get_module_attributes
 import dynamicCPRParams as pms
+from dynamicCPRStore import (Record, pack_array, load_curves,
+                             load_point_curves, CURVE_DTYPE)
+import dynamicCPRWire as wire
+from dynamicCPRScheduler import call_remote
 
 
 logger = logging.getLogger("le2m")
@@ -18,10 +23,13 @@ logger = logging.getLogger("le2m")
 class PartieDYNCPR(Partie, pb.Referenceable):
     __tablename__ = "partie_dynamicCPR"
     __mapper_args__ = {'polymorphic_identity': 'dynamicCPR'}
+    # the parts of a group (see dynamicCPRQueries)
+    __table_args__ = (Index("ix_partie_dynamicCPR_group", "DYNCPR_group"), )
 
     partie_id = Column(Integer, ForeignKey('parties.id'), primary_key=True)
     repetitions = relationship('RepetitionsDYNCPR')
-    curves = relationship('CurveDYNCPR')
+    curves = relationship('CurveDYNCPR')  # before the blobs, see migrations
+    curves_blob = relationship('CurveBlobDYNCPR')
 
     DYNCPR_dynamic_type = Column(Integer)
     DYNCPR_trial = Column(Boolean)
@@ -39,18 +47,40 @@ class PartieDYNCPR(Partie, pb.Referenceable):
         self.DYNCPR_sequence = kwargs.get("current_sequence", 0)
         self.DYNCPR_gain_ecus = 0
         self.DYNCPR_gain_euros = 0
+        self.protocol = wire.PROTOCOL_DICT  # set by configure
 
     @defer.inlineCallbacks
-    def configure(self):
+    def configure(self, params=None):
+        """
+        Configure the remote
+        :param params: the parameters of the part, computed once by the server
+        for all the players (get_module_attributes(pms) if None)
+        :return:
+        """
         logger.debug(u"{} Configure".format(self.joueur))
         self.DYNCPR_dynamic_type = pms.DYNAMIC_TYPE
         self.DYNCPR_treatment = pms.TREATMENT
         self.DYNCPR_trial = pms.PARTIE_ESSAI
         # we send self because some methods are called remotely
         # we send also the group composition
-        yield (self.remote.callRemote(
-            "configure", get_module_attributes(pms), self,
-            self.joueur.group.players_uid))
+        # the remote returns the protocol it understands (None if old)
+        answered, protocol = yield (call_remote(
+            self.remote, "configure", (
+                params or get_module_attributes(pms), self,
+                self.joueur.group.players_uid), pms.REMOTE_DEADLINE))
+        if not answered:
+            self.count_timeout(u"configure")
+            return
+        self.protocol = min(wire.get_protocol(protocol), wire.PROTOCOL)
+        if self.protocol >= wire.PROTOCOL_COMPACT:
+            answered, _ = yield (call_remote(
+                self.remote, "set_protocol", (self.protocol, ),
+                pms.REMOTE_DEADLINE))
+            if not answered:
+                # the server keeps to the protocol every remote understands
+                self.count_timeout(u"set_protocol")
+                self.protocol = wire.PROTOCOL_DICT
+                return
         self.joueur.info(u"Ok")
 
     @defer.inlineCallbacks
@@ -65,7 +95,10 @@ class PartieDYNCPR(Partie, pb.Referenceable):
         self.currentperiod.DYNCPR_group = self.joueur.group.uid
         self.le2mserv.gestionnaire_base.ajouter(self.currentperiod)
         self.repetitions.append(self.currentperiod)
-        yield (self.remote.callRemote("newperiod", period))
+        answered, _ = yield (call_remote(
+            self.remote, "newperiod", (period, ), pms.REMOTE_DEADLINE))
+        if not answered:
+            self.count_timeout(u"newperiod")
         logger.info(u"{} Ready for period {}".format(self.joueur, period))
 
     @defer.inlineCallbacks
@@ -75,8 +108,12 @@ class PartieDYNCPR(Partie, pb.Referenceable):
         :return:
         """
         self.time_start = datetime.now()  # needed by remote_new_extraction
-        initial_extraction = yield (self.remote.callRemote(
-            "set_initial_extraction"))
+        answered, initial_extraction = yield (call_remote(
+            self.remote, "set_initial_extraction",
+            timeout=pms.INITIAL_EXTRACTION_DEADLINE))
+        if not answered:
+            self.count_timeout(u"set_initial_extraction")
+            initial_extraction = self.get_default_extraction()
         self.remote_new_extraction(initial_extraction)
         self.joueur.remove_waitmode()
 
@@ -90,31 +127,111 @@ class PartieDYNCPR(Partie, pb.Referenceable):
         """
         logger.debug(u"{} Decision".format(self.joueur))
         self.time_start = time_start
-        extraction = yield (self.remote.callRemote(
-            "display_decision", self.time_start))
+        answered, extraction = yield (call_remote(
+            self.remote, "display_decision", (self.time_start, ),
+            self.get_decision_deadline()))
         self.currentperiod.DYNCPR_decisiontime = \
             (datetime.now() - self.time_start).total_seconds()
+        if not answered:
+            # in the continuous game the current extraction is kept
+            self.count_timeout(u"display_decision")
         if pms.DYNAMIC_TYPE == pms.DISCRETE:
+            if not answered:
+                extraction = self.get_default_extraction()
             self.remote_new_extraction(extraction)
         self.joueur.remove_waitmode()
 
+    def get_decision_deadline(self):
+        """
+        :return: the time the server waits for the decision (timedelta), None
+        if no limit
+        """
+        if pms.DECISION_DEADLINE_MARGIN is None:
+            return None
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            return pms.CONTINUOUS_TIME_DURATION + pms.DECISION_DEADLINE_MARGIN
+        return pms.DISCRETE_DECISION_TIME + pms.DECISION_DEADLINE_MARGIN
+
+    def count_timeout(self, method):
+        """
+        The remote didn't answer before the deadline, the timeout is counted
+        in the current period (if any, configure comes before the first one)
+        :param method: the name of the remote method
+        :return:
+        """
+        currentperiod = getattr(self, "currentperiod", None)
+        if currentperiod is not None:
+            currentperiod.DYNCPR_timeouts += 1
+        logger.warning(u"{} no answer to {} before the deadline".format(
+            self.joueur, method))
+        self.joueur.info(u"Timeout")
+
+    def get_default_extraction(self):
+        """
+        The extraction given to the player who missed a decision
+        (DECISION_DEFAULT), stored in the current period
+        :return: the default extraction
+        """
+        current = getattr(self, "current_extraction", None)
+        if pms.DECISION_DEFAULT == pms.DEFAULT_POLICY:
+            group = self.joueur.group
+            extraction = pms.get_policy_extraction(
+                group.current_resource, len(group.players))
+        elif pms.DECISION_DEFAULT == pms.DEFAULT_LAST_EXTRACTION and \
+                current is not None:
+            extraction = current.DYNCPR_extraction
+        else:
+            extraction = 0
+        extraction = min(max(float(extraction), pms.DECISION_MIN),
+                         pms.DECISION_MAX)
+        self.currentperiod.DYNCPR_default_extraction = extraction
+        logger.info(u"{} default extraction {}".format(self.joueur,
+                                                       extraction))
+        return extraction
+
     def remote_new_extraction(self, extraction):
         """
         Called by the remote when the subject makes an extraction in the
-        continuous treatment
+        continuous treatment.
+        If the current extraction has not been used by the group yet (no
+        update since it was received) it is replaced by this one: there is
+        at most one effective extraction per update, the others are counted
+        as dropped
         :param extraction:
         :return:
         """
-        self.current_extraction = ExtractionsDYNCPR(
-            extraction, int((datetime.now() - self.time_start).total_seconds()))
+        current = getattr(self, "current_extraction", None)
+        if current is not None:  # not the first extraction
+            if current.DYNCPR_extraction_time_end is None:
+                current.DYNCPR_extraction = extraction
+                current.DYNCPR_extraction_time = \
+                    int((datetime.now() - self.time_start).total_seconds())
+                self.currentperiod.DYNCPR_dropped_extractions += 1
+                self.joueur.group.add_extraction(self.joueur, current,
+                                                 log=False)
+                return
+            current.sealed = True
+        self.current_extraction = ExtractionRecord(
+            self.currentperiod, extraction,
+            int((datetime.now() - self.time_start).total_seconds()))
         self.joueur.info(self.current_extraction)
-        self.le2mserv.gestionnaire_base.ajouter(self.current_extraction)
-        self.currentperiod.extractions.append(self.current_extraction)
+        self.joueur.group.writer.add(self.current_extraction)
         self.joueur.group.add_extraction(self.joueur, self.current_extraction)
 
+    def remote_new_extraction_code(self, code):
+        """
+        Called by the remotes that use PROTOCOL_COMPACT
+        :param code: the extraction in units of DECISION_STEP
+        :return:
+        """
+        self.remote_new_extraction(wire.decode_extraction(code))
+
     @defer.inlineCallbacks
     def end_update_data(self):
-        yield (self.remote.callRemote("end_update_data"))
+        answered, _ = yield (call_remote(
+            self.remote, "end_update_data", timeout=pms.REMOTE_DEADLINE))
+        if not answered:
+            self.count_timeout(u"end_update_data")
 
     def compute_periodpayoff(self):
         logger.debug(u"{} Period Payoff".format(self.joueur))
@@ -147,34 +264,67 @@ class PartieDYNCPR(Partie, pb.Referenceable):
         """
         logger.debug(u"{} Summary".format(self.joueur))
         # ----------------------------------------------------------------------
-        # we collect the x_data and y_data of the curves displayed on the
-        # remote
+        # the payoff and the curves have been computed by the server (see
+        # set_curves), the remote sends its own curves only if asked. The
+        # older remotes always send them
         # ----------------------------------------------------------------------
-        data_indiv = yield(self.remote.callRemote(
-            "display_summary", self.currentperiod.to_dict()))
+        args = (self.currentperiod.to_dict(), )
+        if self.protocol >= wire.PROTOCOL_SERVER_CURVES:
+            args += (pms.CURVES_CROSS_CHECK, )
+        answered, data_indiv = yield(call_remote(
+            self.remote, "display_summary", args, pms.SUMMARY_DEADLINE))
+        if not answered:
+            self.count_timeout(u"display_summary")
+        elif data_indiv is not None:
+            self.check_curves(wire.unpack_curves(data_indiv))
 
-        extrac_indiv = data_indiv["extractions"]
-        for x, y in extrac_indiv:
-            curve_data = CurveDYNCPR(pms.EXTRACTION, x, y)
-            self.le2mserv.gestionnaire_base.ajouter(curve_data)
-            self.curves.append(curve_data)
+        self.joueur.info("Ok")
+        self.joueur.remove_waitmode()
 
+    def set_curves(self, xdata, extractions, costs, part_payoffs):
+        """
+        Called by the server at the end of the part with the curves computed
+        from its own data (see TickEngine.compute_payoffs)
+        :param xdata: the x of the curves (time or period)
+        :param extractions: the player's extraction at each x
+        :param costs: the player's cost at each x
+        :param part_payoffs: the player's part payoff at each x
+        :return:
+        """
+        writer = self.joueur.group.writer
+        writer.add(CurveBlobRecord(self, pms.EXTRACTION, xdata, extractions))
+        writer.add(CurveBlobRecord(self, pms.PAYOFF, xdata, part_payoffs))
+        writer.add(CurveBlobRecord(self, pms.COST, xdata, costs))
+        self.DYNCPR_gain_ecus = float(part_payoffs[-1]) if \
+            len(part_payoffs) else 0
+
+    def check_curves(self, data_indiv):
+        """
+        Compare the curves sent by the remote with the ones of the server
+        :param data_indiv: see dynamicCPRWire.unpack_curves
+        :return: True if the part payoffs are the same
+        """
         payoff_indiv = data_indiv["payoffs"]
-        for x, y in payoff_indiv:
-            curve_data = CurveDYNCPR(pms.PAYOFF, x, y)
-            self.le2mserv.gestionnaire_base.ajouter(curve_data)
-            self.curves.append(curve_data)
-        # we collect the part payoff
-        self.DYNCPR_gain_ecus = payoff_indiv[-1][1]
-
-        cost = data_indiv["cost"]
-        for x, y in cost:
-            curve_data = CurveDYNCPR(pms.COST, x, y)
-            self.le2mserv.gestionnaire_base.ajouter(curve_data)
-            self.curves.append(curve_data)
+        remote_payoff = payoff_indiv[-1][1] if payoff_indiv else 0
+        same = abs(remote_payoff - self.DYNCPR_gain_ecus) <= \
+            1e-9 * max(1, abs(self.DYNCPR_gain_ecus))
+        if same:
+            logger.debug(u"{} curves checked".format(self.joueur))
+        else:
+            logger.warning(
+                u"{} part payoff of the remote {} instead of {}".format(
+                    self.joueur, remote_payoff, self.DYNCPR_gain_ecus))
+        return same
 
-        self.joueur.info("Ok")
-        self.joueur.remove_waitmode()
+    def get_curves(self):
+        """
+        The curves of the player, stored as blobs or, for the parts played
+        before, with one row per point
+        :return: dict {curve type (pms.EXTRACTION...): (xdata, ydata)}
+        """
+        if self.curves_blob:
+            return load_curves(self.curves_blob)
+        return load_point_curves(self.curves)
 
     @defer.inlineCallbacks
     def compute_partpayoff(self):
@@ -188,8 +338,12 @@ class PartieDYNCPR(Partie, pb.Referenceable):
 
         self.DYNCPR_gain_euros = float("{:.2f}".format(
             self.DYNCPR_gain_ecus * pms.TAUX_CONVERSION))
-        yield (self.remote.callRemote(
-            "set_payoffs", self.DYNCPR_gain_euros, self.DYNCPR_gain_ecus))
+        answered, _ = yield (call_remote(
+            self.remote, "set_payoffs", (
+                self.DYNCPR_gain_euros, self.DYNCPR_gain_ecus),
+            pms.REMOTE_DEADLINE))
+        if not answered:
+            self.count_timeout(u"set_payoffs")
 
         logger.info(u'{} Payoff ecus {} Payoff euros {:.2f}'.format(
             self.joueur, self.DYNCPR_gain_ecus, self.DYNCPR_gain_euros))
@@ -202,6 +356,8 @@ class PartieDYNCPR(Partie, pb.Referenceable):
 
 class RepetitionsDYNCPR(Base):
     __tablename__ = 'partie_dynamicCPR_repetitions'
+    __table_args__ = (Index("ix_partie_dynamicCPR_repetitions_partie_period",
+                            "partie_partie_id", "DYNCPR_period"), )
     id = Column(Integer, primary_key=True, autoincrement=True)
     partie_partie_id = Column(Integer, ForeignKey("partie_dynamicCPR.partie_id"))
     extractions = relationship('ExtractionsDYNCPR')
@@ -212,17 +368,25 @@ class RepetitionsDYNCPR(Base):
     DYNCPR_decisiontime = Column(Integer, default=0)
     DYNCPR_periodpayoff = Column(Float, default=0)
     DYNCPR_cumulativepayoff = Column(Float, default=0)
+    # extractions replaced by a later one before being used by the group
+    DYNCPR_dropped_extractions = Column(Integer, default=0)
+    # remote calls not answered before their deadline (see REMOTE_DEADLINE
+    # and the other deadlines of the parameters), and the extraction given
+    # for a missed decision (see PartieDYNCPR.get_default_extraction)
+    DYNCPR_timeouts = Column(Integer, default=0)
+    DYNCPR_default_extraction = Column(Float, default=None)
 
     def __init__(self, period):
         self.DYNCPR_period = period
+        self.DYNCPR_dropped_extractions = 0
+        self.DYNCPR_timeouts = 0
 
     @property
     def number(self):
         return self.DYNCPR_period
 
     def to_dict(self, joueur=None):
-        temp = {c.name: getattr(self, c.name) for c in self.__table__.columns
-                if "DYNCPR" in c.name}
+        temp = {c: getattr(self, c) for c in self.COLUMNS}
         if joueur:
             temp["joueur"] = joueur
         return temp
@@ -240,10 +404,14 @@ class ExtractionsDYNCPR(Base):
     treatment
     """
     __tablename__ = "partie_dynamicCPR_extractions"
+    __table_args__ = (Index("ix_partie_dynamicCPR_extractions_repetition_time",
+                            "repetitions_id", "DYNCPR_extraction_time"), )
     id = Column(Integer, primary_key=True, autoincrement=True)
     repetitions_id = Column(Integer, ForeignKey("partie_dynamicCPR_repetitions.id"))
     DYNCPR_extraction = Column(Float)
     DYNCPR_extraction_time = Column(Float)
+    # last instant the extraction has been used by the group
+    DYNCPR_extraction_time_end = Column(Float)
     DYNCPR_resource = Column(Float)
     DYNCPR_benefice = Column(Float)
     DYNCPR_cost = Column(Float)
@@ -257,7 +425,49 @@ class ExtractionsDYNCPR(Base):
         return "extraction: {}".format(self.DYNCPR_extraction)
 
     def to_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {c: getattr(self, c) for c in self.COLUMNS}
+
+
+# the layouts of to_dict are computed once
+RepetitionsDYNCPR.COLUMNS = tuple(
+    c.name for c in RepetitionsDYNCPR.__table__.columns if "DYNCPR" in c.name)
+ExtractionsDYNCPR.COLUMNS = tuple(
+    c.name for c in ExtractionsDYNCPR.__table__.columns)
+
+
+class ExtractionRecord(Record):
+    """
+    Lightweight version of ExtractionsDYNCPR used during the game, written
+    by the WriteBehind of the group
+    """
+    __slots__ = ("DYNCPR_extraction", "DYNCPR_extraction_time",
+                 "DYNCPR_extraction_time_end", "DYNCPR_resource",
+                 "DYNCPR_benefice", "DYNCPR_cost", "DYNCPR_payoff")
+    table = ExtractionsDYNCPR.__table__
+
+    def __init__(self, repetition, extraction, the_time):
+        self.parent = repetition
+        self.sealed = False
+        self.DYNCPR_extraction = extraction
+        self.DYNCPR_extraction_time = the_time
+        self.DYNCPR_extraction_time_end = None
+        self.DYNCPR_resource = None
+        self.DYNCPR_benefice = None
+        self.DYNCPR_cost = None
+        self.DYNCPR_payoff = None
+
+    def __repr__(self):
+        return "extraction: {}".format(self.DYNCPR_extraction)
+
+    def to_row(self):
+        return {"repetitions_id": self.parent.id,
+                "DYNCPR_extraction": self.DYNCPR_extraction,
+                "DYNCPR_extraction_time": self.DYNCPR_extraction_time,
+                "DYNCPR_extraction_time_end": self.DYNCPR_extraction_time_end,
+                "DYNCPR_resource": self.DYNCPR_resource,
+                "DYNCPR_benefice": self.DYNCPR_benefice,
+                "DYNCPR_cost": self.DYNCPR_cost,
+                "DYNCPR_payoff": self.DYNCPR_payoff}
 
 
 # ==============================================================================
@@ -268,6 +478,9 @@ class ExtractionsDYNCPR(Base):
 
 class CurveDYNCPR(Base):
     __tablename__ = "partie_dynamicCPR_curves"
+    __table_args__ = (Index("ix_partie_dynamicCPR_curves_partie_type_x",
+                            "partie_id", "DYNCPR_curve_type", "DYNCPR_curve_x"),
+                      )
     id = Column(Integer, primary_key=True, autoincrement=True)
     partie_id = Column(Integer, ForeignKey("partie_dynamicCPR.partie_id"))
     DYNCPR_curve_type = Column(Integer)
@@ -280,3 +493,55 @@ class CurveDYNCPR(Base):
         self.DYNCPR_curve_y = y
 
 
+class CurveBlobDYNCPR(Base):
+    """
+    One row per curve, the values are compressed arrays (see
+    dynamicCPRStore.pack_array and load_curve)
+    """
+    __tablename__ = "partie_dynamicCPR_curves_blob"
+    __table_args__ = (Index("ix_partie_dynamicCPR_curves_blob_partie_type",
+                            "partie_id", "DYNCPR_curve_type"), )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    partie_id = Column(Integer, ForeignKey("partie_dynamicCPR.partie_id"))
+    DYNCPR_curve_type = Column(Integer)
+    DYNCPR_curve_dtype = Column(String(8))
+    DYNCPR_curve_length = Column(Integer)
+    DYNCPR_curve_xdata = Column(LargeBinary)
+    DYNCPR_curve_ydata = Column(LargeBinary)
+
+    def __init__(self, c_type, xdata, ydata):
+        self.DYNCPR_curve_type = c_type
+        self.DYNCPR_curve_dtype = CURVE_DTYPE.str
+        self.DYNCPR_curve_length = len(xdata)
+        self.DYNCPR_curve_xdata = pack_array(xdata)
+        self.DYNCPR_curve_ydata = pack_array(ydata)
+
+
+class CurveBlobRecord(Record):
+    """
+    Lightweight version of CurveBlobDYNCPR, written by the WriteBehind
+    """
+    __slots__ = ("DYNCPR_curve_type", "xdata", "ydata")
+    table = CurveBlobDYNCPR.__table__
+
+    def __init__(self, partie, c_type, xdata, ydata):
+        """
+
+        :param partie: PartieDYNCPR
+        :param c_type: pms.EXTRACTION, pms.PAYOFF...
+        :param xdata: sequence of x
+        :param ydata: sequence of y, same length
+        """
+        self.parent = partie
+        self.sealed = True
+        self.DYNCPR_curve_type = c_type
+        self.xdata = xdata
+        self.ydata = ydata
+
+    def to_row(self):
+        return {"partie_id": self.parent.partie_id,
+                "DYNCPR_curve_type": self.DYNCPR_curve_type,
+                "DYNCPR_curve_dtype": CURVE_DTYPE.str,
+                "DYNCPR_curve_length": len(self.xdata),
+                "DYNCPR_curve_xdata": pack_array(self.xdata),
+                "DYNCPR_curve_ydata": pack_array(self.ydata)}
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the queries used to read the data of the part after the
+sessions. Each query follows one of the indexes of the tables (see the
+__table_args__ of the tables and dynamicCPRMigrations.create_indexes), so
+that it doesn't scan the whole table on a database with many sessions:
+    group_dynamicCPR: session_id, DYNCPR_sequence
+    group_dynamicCPR_extractions: group_uid, DYNCPR_period, DYNCPR_time
+    partie_dynamicCPR: DYNCPR_group
+    partie_dynamicCPR_repetitions: partie_partie_id, DYNCPR_period
+    partie_dynamicCPR_extractions: repetitions_id, DYNCPR_extraction_time
+    partie_dynamicCPR_curves: partie_id, DYNCPR_curve_type, DYNCPR_curve_x
+    partie_dynamicCPR_curves_blob: partie_id, DYNCPR_curve_type
+The queries only filter and sort on the first columns of an index.
+
+Usage, from the directory of the part with le2m in the path:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import dynamicCPRQueries as queries
+    engine = create_engine("sqlite:///path/to/the/database.sqlite")
+    session = sessionmaker(bind=engine)()
+    for group in queries.get_groups(session, session_id=3):
+        series = queries.get_group_series(session, group.uid, period=0)
+"""
+
+import dynamicCPRParams as pms
+from dynamicCPRGroup import GroupDYNCPR, GroupExtractionDYNCPR
+from dynamicCPRPart import PartieDYNCPR, RepetitionsDYNCPR, \
+    ExtractionsDYNCPR, CurveDYNCPR, CurveBlobDYNCPR
+from dynamicCPRStore import expand_group_extractions, load_curves, \
+    load_point_curves
+
+
+# ==============================================================================
+# GROUPS
+# ==============================================================================
+
+
+def get_groups(session, session_id, sequence=None):
+    """
+    :param session: SQLAlchemy session on the database
+    :param session_id: the id of the le2m session
+    :param sequence: only the groups of this sequence (all by default)
+    :return: list of GroupDYNCPR, by sequence
+    """
+    query = session.query(GroupDYNCPR).filter(
+        GroupDYNCPR.session_id == session_id)
+    if sequence is not None:
+        query = query.filter(GroupDYNCPR.DYNCPR_sequence == sequence)
+    return query.order_by(GroupDYNCPR.DYNCPR_sequence, GroupDYNCPR.uid).all()
+
+
+def get_group_extractions(session, group_uid, period=None, start=None,
+                          end=None):
+    """
+    :param session: SQLAlchemy session on the database
+    :param group_uid: the uid of the group
+    :param period: only the rows of this period (all by default)
+    :param start: only the rows from this time (needs the period)
+    :param end: only the rows until this time (needs the period)
+    :return: list of GroupExtractionDYNCPR, by period and time
+    """
+    query = session.query(GroupExtractionDYNCPR).filter(
+        GroupExtractionDYNCPR.group_uid == group_uid)
+    if period is not None:
+        query = query.filter(GroupExtractionDYNCPR.DYNCPR_period == period)
+        if start is not None:
+            query = query.filter(GroupExtractionDYNCPR.DYNCPR_time >= start)
+        if end is not None:
+            query = query.filter(GroupExtractionDYNCPR.DYNCPR_time <= end)
+    elif start is not None or end is not None:
+        raise ValueError("The time range needs the period")
+    return query.order_by(GroupExtractionDYNCPR.DYNCPR_period,
+                          GroupExtractionDYNCPR.DYNCPR_time).all()
+
+
+def get_group_series(session, group_uid, period, step=None):
+    """
+    The group extraction and the resource stock of one period at each tick,
+    whatever the storage mode (see dynamicCPRStore.expand_group_extractions)
+    :param session: SQLAlchemy session on the database
+    :param group_uid: the uid of the group
+    :param period: the period
+    :param step: the time between two ticks in seconds, TIMER_UPDATE by
+    default
+    :return: dict of numpy arrays: time, group_extraction, resource_stock
+    """
+    if step is None:
+        step = pms.TIMER_UPDATE.total_seconds()
+    return expand_group_extractions(
+        get_group_extractions(session, group_uid, period), step)
+
+
+# ==============================================================================
+# PARTS
+# ==============================================================================
+
+
+def get_parts(session, group_uid):
+    """
+    :param session: SQLAlchemy session on the database
+    :param group_uid: the uid of the group
+    :return: list of PartieDYNCPR, the parts of the members of the group
+    """
+    return session.query(PartieDYNCPR).filter(
+        PartieDYNCPR.DYNCPR_group == group_uid).order_by(
+        PartieDYNCPR.partie_id).all()
+
+
+def get_repetitions(session, partie_id, period=None):
+    """
+    :param session: SQLAlchemy session on the database
+    :param partie_id: the id of the part of the player
+    :param period: only this period (all by default)
+    :return: list of RepetitionsDYNCPR, by period
+    """
+    query = session.query(RepetitionsDYNCPR).filter(
+        RepetitionsDYNCPR.partie_partie_id == partie_id)
+    if period is not None:
+        query = query.filter(RepetitionsDYNCPR.DYNCPR_period == period)
+    return query.order_by(RepetitionsDYNCPR.DYNCPR_period).all()
+
+
+def get_extractions(session, repetitions_ids):
+    """
+    :param session: SQLAlchemy session on the database
+    :param repetitions_ids: the id of a repetition, or a list of ids
+    :return: list of ExtractionsDYNCPR, by repetition and time
+    """
+    if not isinstance(repetitions_ids, (list, tuple, set)):
+        repetitions_ids = [repetitions_ids]
+    return session.query(ExtractionsDYNCPR).filter(
+        ExtractionsDYNCPR.repetitions_id.in_(list(repetitions_ids))).order_by(
+        ExtractionsDYNCPR.repetitions_id,
+        ExtractionsDYNCPR.DYNCPR_extraction_time).all()
+
+
+def get_curves(session, partie_id, c_type=None):
+    """
+    The curves of a part, without loading the part, stored as blobs or, for
+    the parts played before, with one row per point
+    :param session: SQLAlchemy session on the database
+    :param partie_id: the id of the part of the player
+    :param c_type: only this curve (pms.EXTRACTION...), all by default
+    :return: dict {curve type: (xdata, ydata)}
+    """
+    query = session.query(CurveBlobDYNCPR).filter(
+        CurveBlobDYNCPR.partie_id == partie_id)
+    if c_type is not None:
+        query = query.filter(CurveBlobDYNCPR.DYNCPR_curve_type == c_type)
+    blobs = query.all()
+    if blobs:
+        return load_curves(blobs)
+    query = session.query(CurveDYNCPR).filter(
+        CurveDYNCPR.partie_id == partie_id)
+    if c_type is not None:
+        query = query.filter(CurveDYNCPR.DYNCPR_curve_type == c_type)
+    return load_point_curves(query.order_by(
+        CurveDYNCPR.DYNCPR_curve_type, CurveDYNCPR.DYNCPR_curve_x).all())
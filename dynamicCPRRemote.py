@@ -3,6 +3,7 @@
 # built-in
 import logging
 import random
+from collections import deque
 from twisted.internet import defer
 import numpy as np
 from PyQt4.QtCore import QTimer, pyqtSignal, QObject
@@ -12,8 +13,11 @@ from client.cltremote import IRemote
 
 # dynamicCPR
 import dynamicCPRParams as pms
-from dynamicCPRGui import GuiDecision, GuiInitialExtraction, GuiSummary
+from dynamicCPREngine import DiscountedAccumulator, decimate
+from dynamicCPRGui import (GuiDecision, GuiInitialExtraction, GuiSummary,
+                           PartFigure)
 import dynamicCPRTexts as texts_DYNCPR
+import dynamicCPRWire as wire
 
 
 logger = logging.getLogger("le2m")
@@ -26,33 +30,113 @@ class RemoteDYNCPR(IRemote, QObject):
     def __init__(self, le2mclt):
         IRemote.__init__(self, le2mclt)
         QObject.__init__(self)
+        self.protocol = wire.PROTOCOL_DICT  # set by the server
+        self.part_figure = None
 
     def __init_vars(self):
+        self.release_figure()
         self.start_time = None
-        self.extractions_indiv = dict()  # the players + the other group members
         self.extraction_group = PlotData()
         self.cost = PlotData()
         self.resource = PlotData()
         self.payoff_instant = PlotData()
         self.payoff_instant_discounted = PlotData()
         self.payoff_part = PlotData()
-        self.text_infos = u""
-        for j in self.group_members:
-            self.extractions_indiv[j] = PlotData()
+        self.payoff_accumulator = DiscountedAccumulator(
+            interval=pms.TIMER_UPDATE.total_seconds(),
+            ticks=int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                      pms.TIMER_UPDATE.total_seconds()))
+        # the last rows of the information table, the newest first
+        self.infos_head = texts_DYNCPR.get_infos_head()
+        self.infos = deque(maxlen=pms.INFOS_HISTORY)
+        self.infos_count = 0  # number of rows added since the beginning
+        self.delta_decoder = wire.DeltaDecoder(
+            self.protocol >= wire.PROTOCOL_COMPACT)
+        self.__init_members_vars()
         self.decision_screen = None
 
+    def __init_members_vars(self):
+        """
+        In large-group mode only the player's extraction is kept, with the
+        aggregates of the group (mean, min, max)
+        :return:
+        """
+        self.large_group = self.protocol >= wire.PROTOCOL_LARGE_GROUP and \
+            wire.is_large_group(len(self.group_members))
+        self.extractions_indiv = dict()  # the players + the other group members
+        for j in [self.le2mclt.uid] if self.large_group else \
+                self.group_members:
+            self.extractions_indiv[j] = PlotData()
+        self.extraction_aggregates = None
+        self.extraction_histogram = None
+        if self.large_group:
+            self.extraction_aggregates = (PlotData(), PlotData(), PlotData())
+
     def remote_configure(self, params, server_part, group_members):
         """
         Set the same parameters as in the server side
         :param params:
-        :return:
+        :return: the protocol understood by this remote
         """
         logger.info(u"{} configure".format(self.le2mclt))
         self.server_part = server_part
         self.group_members = group_members
         for k, v in params.items():
             setattr(pms, k, v)
+        self.protocol = wire.PROTOCOL_DICT
         self.__init_vars()
+        return wire.PROTOCOL
+
+    def remote_set_protocol(self, protocol):
+        """
+        Called by the server after configure if both understand a protocol
+        newer than PROTOCOL_DELTA
+        :param protocol: the protocol to use
+        :return:
+        """
+        logger.info(u"{} protocol {}".format(self.le2mclt, protocol))
+        self.protocol = protocol
+        self.delta_decoder = wire.DeltaDecoder(
+            self.protocol >= wire.PROTOCOL_COMPACT)
+        self.__init_members_vars()
+
+    def get_figure(self):
+        """
+        The figure of the part, shared by the decision and summary screens
+        :return: PartFigure
+        """
+        if self.part_figure is None:
+            self.part_figure = PartFigure(self)
+        return self.part_figure
+
+    def release_figure(self):
+        """
+        Free the figure of the part (called at the end of the part)
+        :return:
+        """
+        if self.part_figure is not None:
+            self.part_figure.release()
+            self.part_figure = None
+
+    def send_extraction(self, extraction):
+        """
+        Send an extraction to the server (continuous treatment)
+        :param extraction: the extraction (float)
+        :return: deferred
+        """
+        if self.protocol >= wire.PROTOCOL_COMPACT:
+            return self.server_part.callRemote(
+                "new_extraction_code", wire.encode_extraction(extraction))
+        return self.server_part.callRemote("new_extraction", extraction)
+
+    def get_curves(self):
+        """
+        The curves sent back to the server at the end of the part
+        :return: see dynamicCPRWire.pack_curves
+        """
+        return wire.pack_curves(
+            self.protocol, self.extractions_indiv[self.le2mclt.uid],
+            self.payoff_part, self.cost)
 
     def remote_newperiod(self, period):
         """
@@ -111,8 +195,7 @@ class RemoteDYNCPR(IRemote, QObject):
                                   pms.DECISION_STEP)))
                     logger.info(u"{} Send {}".format(self._le2mclt.uid,
                                                      extraction))
-                    self.server_part.callRemote("new_extraction",
-                                                extraction)
+                    self.send_extraction(extraction)
 
                 self.continuous_simulation_defered = defer.Deferred()
                 self.continuous_simulation_timer = QTimer()
@@ -149,6 +232,13 @@ class RemoteDYNCPR(IRemote, QObject):
                 self.decision_screen.update_data_and_graphs()
             return defered
 
+    def _get_xdata(self, the_time):
+        if self.currentperiod == 0:
+            return 0
+        if pms.DYNAMIC_TYPE == pms.DISCRETE:
+            return self.currentperiod
+        return the_time
+
     def remote_update_data(self, group_members_extractions, group_extraction,
                            the_time):
         """
@@ -165,13 +255,7 @@ class RemoteDYNCPR(IRemote, QObject):
         # ----------------------------------------------------------------------
         # we set the same time for every player in the group
         # ----------------------------------------------------------------------
-        if self.currentperiod == 0:
-            xdata = 0
-        else:
-            if pms.DYNAMIC_TYPE == pms.DISCRETE:
-                xdata = self.currentperiod
-            elif pms.DYNAMIC_TYPE == pms.CONTINUOUS:
-                xdata = the_time
+        xdata = self._get_xdata(the_time)
 
         # ----------------------------------------------------------------------
         # group extraction
@@ -219,11 +303,13 @@ class RemoteDYNCPR(IRemote, QObject):
                                   ["DYNCPR_payoff"])
         self.payoff_instant_discounted.add_x(xdata)
         if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
-            self.payoff_instant_discounted.add_y(
-                np.exp(-pms.param_r * xdata) * self.payoff_instant.ydata[-1])
+            discounted_payoff = self.payoff_accumulator.add(
+                xdata, self.payoff_instant.ydata[-1])
+            self.payoff_instant_discounted.add_y(discounted_payoff)
         else:  # discrete
-            pass  # todo: discounted payoff for discrete dynamic
-        cumulative_payoff = np.sum(self.payoff_instant_discounted.ydata)
+            # todo: discounted payoff for discrete dynamic
+            discounted_payoff = 0
+        cumulative_payoff = self.payoff_accumulator.cumulative
         infinite_payoff = pms.get_infinite_payoff(
             xdata, group_extraction["DYNCPR_resource_stock"],
             group_members_extractions[self.le2mclt.uid]["DYNCPR_extraction"],
@@ -238,26 +324,12 @@ class RemoteDYNCPR(IRemote, QObject):
         # ----------------------------------------------------------------------
         # text information
         # ----------------------------------------------------------------------
-        old = self.text_infos
-        the_time_str = texts_DYNCPR.trans_DYNCPR(u"Instant") if \
-            pms.DYNAMIC_TYPE == pms.CONTINUOUS else \
-            texts_DYNCPR.trans_DYNCPR(u"Period")
-        self.text_infos = the_time_str + u": {}".format(int(xdata)) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Your extraction") + \
-            u": {:.2f}".format(self.extractions_indiv[self.le2mclt.uid].ydata[-1]) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Pair extraction") + \
-            u": {:.2f}".format(self.extraction_group.ydata[-1]) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Available resource") + \
-            u": {:.2f}".format(self.resource.ydata[-1]) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Instant payoff") + \
-            u": {:.2f}".format(self.payoff_instant.ydata[-1]) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Discounted payoff") + \
-            u": {:.4f}".format(self.payoff_instant_discounted.ydata[-1]) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Cumulative payoff") + \
-            u": {:.2f}".format(cumulative_payoff) + \
-            u"<br>" + texts_DYNCPR.trans_DYNCPR(u"Part payoff") + \
-            u": {:.2f}".format(self.payoff_part.ydata[-1])
-        self.text_infos += u"<br>{}<br>{}".format(20*"-", old)
+        self.infos.appendleft(texts_DYNCPR.get_infos_row(
+            xdata, self.extractions_indiv[self.le2mclt.uid].ydata[-1],
+            self.extraction_group.ydata[-1], self.resource.ydata[-1],
+            self.payoff_instant.ydata[-1], discounted_payoff,
+            cumulative_payoff, self.payoff_part.ydata[-1]))
+        self.infos_count += 1
 
         # ----------------------------------------------------------------------
         # log
@@ -266,6 +338,65 @@ class RemoteDYNCPR(IRemote, QObject):
             self.le2mclt, self.extraction_group.ydata[-1],
             self.resource.ydata[-1], self.payoff_part.ydata[-1]))
 
+    def remote_update_data_delta(self, update, the_time):
+        """
+        called by the server instead of remote_update_data: update contains
+        only the values that changed, the full state is rebuilt here
+        :param update: see dynamicCPRWire.DeltaEncoder.encode
+        :param the_time: the time of the update
+        :return: the sequence number of the update, None if it couldn't be
+        applied (the server then sends the full state)
+        """
+        state = self.delta_decoder.decode(update)
+        if state is None:
+            logger.warning("{} update {} ignored, waiting for a keyframe".format(
+                self.le2mclt, update[1]))
+            return None
+        if self.protocol >= wire.PROTOCOL_COMPACT:
+            group_members_extractions, group_extraction = \
+                wire.unflatten_compact(self.group_members, state)
+        else:
+            group_members_extractions, group_extraction = \
+                wire.unflatten(state)
+        self.remote_update_data(
+            group_members_extractions, group_extraction, the_time)
+        return update[1]
+
+    def remote_update_data_packed(self, packed):
+        """
+        called by the server with PROTOCOL_PACKED: the arguments of
+        remote_update_data_delta serialized once for the whole group
+        :param packed: bytes, see dynamicCPRWire.pack
+        :return: see remote_update_data_delta
+        """
+        return self.remote_update_data_delta(*wire.unpack(packed))
+
+    def remote_update_data_large(self, shared, own, the_time):
+        """
+        called by the server in large-group mode
+        :param shared: the group values and the aggregates of the group,
+        serialized once for the whole group (see dynamicCPRWire.pack)
+        :param own: the player's extraction (see dynamicCPRWire.member_values)
+        :param the_time: the time of the update
+        :return:
+        """
+        group_values, (mean, minimum, maximum, histogram) = \
+            wire.unpack(shared)
+        xdata = self._get_xdata(the_time)
+        for plot_data, value in zip(self.extraction_aggregates,
+                                    (mean, minimum, maximum)):
+            plot_data.add_x(xdata)
+            plot_data.add_y(value)
+            try:
+                plot_data.update_curve()
+            except AttributeError:
+                pass
+        self.extraction_histogram = histogram
+        group_members_extractions, group_extraction = \
+            wire.decode_large_group(self.le2mclt.uid, own, group_values)
+        self.remote_update_data(
+            group_members_extractions, group_extraction, the_time)
+
     def remote_end_update_data(self):
         logger.debug("{}: call of remote_end_update_data".format(self.le2mclt))
 
@@ -276,27 +407,26 @@ class RemoteDYNCPR(IRemote, QObject):
 
         self.end_of_time.emit()
 
-    def remote_display_summary(self, period_content):
+    def remote_display_summary(self, period_content, send_curves=True):
         """
         Display the summary screen
         :param period_content: dictionary with the content of the current period
-        :return: deferred
+        :param send_curves: if False the curves are not sent back (the server
+        computes them)
+        :return: deferred, the curves (see get_curves) or None
         """
         logger.info(u"{} Summary".format(self._le2mclt.uid))
         # self.histo.append([period_content.get(k) for k in self.histo_vars])
         if self._le2mclt.simulation:
+            if not send_curves:
+                return None
             logger.info("{} send curves".format(self.le2mclt))
-            extrac_indiv = self.extractions_indiv[self.le2mclt.uid]
-            return {
-                "extractions": zip(extrac_indiv.xdata, extrac_indiv.ydata),
-                "payoffs": zip(self.payoff_part.xdata, self.payoff_part.ydata),
-                "cost": zip(self.remote.cost.xdata, self.remote.cost.ydata)
-            }
+            return self.get_curves()
         else:
             defered = defer.Deferred()
             summary_screen = GuiSummary(
                 self, defered, texts_DYNCPR.get_text_summary(
-                    float(self.payoff_part.ydata[-1])))
+                    float(self.payoff_part.ydata[-1])), send_curves)
             summary_screen.showFullScreen()
             return defered
 
@@ -306,19 +436,68 @@ class RemoteDYNCPR(IRemote, QObject):
 # ==============================================================================
 
 
-class PlotData():
-    def __init__(self):
-        self.xdata = []
-        self.ydata = []
+class PlotData(object):
+    """
+    A curve of the remote. The values are stored in numpy arrays allocated
+    for the whole part (see get_capacity) and doubled if needed. xdata and
+    ydata are views on the values added so far, given as is to matplotlib.
+    """
+
+    def __init__(self, capacity=None):
+        if capacity is None:
+            capacity = PlotData.get_capacity()
+        self._xdata = np.empty(capacity)
+        self._ydata = np.empty(capacity)
+        self._xsize = 0
+        self._ysize = 0
         self.curve = None
+        self.max_points = None  # set by the figure from its width in pixels
+
+    @staticmethod
+    def get_capacity():
+        """
+        :return: the number of values of a curve for the whole part (the
+        instant 0 plus one value per update)
+        """
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            return int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                       pms.TIMER_UPDATE.total_seconds()) + 1
+        return pms.NOMBRE_PERIODES + 1
+
+    @property
+    def xdata(self):
+        return self._xdata[:self._xsize]
+
+    @property
+    def ydata(self):
+        return self._ydata[:self._ysize]
+
+    @staticmethod
+    def _grow(values):
+        temp = np.empty(max(2 * len(values), 1))
+        temp[:len(values)] = values
+        return temp
 
     def add_x(self, val):
-        self.xdata.append(val)
+        if self._xsize == len(self._xdata):
+            self._xdata = self._grow(self._xdata)
+        self._xdata[self._xsize] = val
+        self._xsize += 1
 
     def add_y(self, val):
-        self.ydata.append(val)
+        if self._ysize == len(self._ydata):
+            self._ydata = self._grow(self._ydata)
+        self._ydata[self._ysize] = val
+        self._ysize += 1
 
     def update_curve(self):
-        self.curve.set_data(self.xdata, self.ydata)
-
-
+        """
+        Give the values to the curve, decimated if there are more values than
+        max_points (xdata and ydata keep all the values)
+        :return:
+        """
+        size = min(self._xsize, self._ysize)
+        xdata, ydata = self._xdata[:size], self._ydata[:size]
+        if self.max_points and size > self.max_points:
+            xdata, ydata = decimate(xdata, ydata, self.max_points // 2)
+        self.curve.set_data(xdata, ydata)
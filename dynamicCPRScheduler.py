@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the schedulers of the session.
+In the continuous treatment one monotonic tick counter drives all the groups
+(SessionScheduler). It only needs an object that provides seconds() and
+callLater() (twisted's IReactorTime), so it runs on the twisted reactor on
+the server and on a twisted.internet.task.Clock (or any equivalent) when used
+headless.
+In the discrete treatment each group plays its periods at its own pace
+(PeriodScheduler).
+with_deadline and call_remote bound the time the server waits for the
+answer of a remote.
+The schedulers don't depend on Qt.
+"""
+
+import logging
+from twisted.internet import defer
+from twisted.spread import pb
+
+
+logger = logging.getLogger("le2m")
+
+
+class SessionScheduler(object):
+    """
+    Tick n is due at start + n * interval. Each wakeup is computed from the
+    start time and not from the previous wakeup, so the delays don't
+    accumulate (drift correction). If the process was too busy and several
+    ticks are overdue they are run in a row, so that the time series has
+    neither repeated nor skipped instants.
+    """
+
+    def __init__(self, interval, on_tick, ticks=None, on_finished=None,
+                 clock=None):
+        """
+
+        :param interval: the duration between two ticks (timedelta)
+        :param on_tick: called at each tick with the tick number and the time
+        of the tick (tick * interval, in seconds)
+        :param ticks: the number of ticks to run, None to run until stop
+        :param on_finished: called after the last tick
+        :param clock: an IReactorTime provider, the twisted reactor by default
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.interval = interval.total_seconds()
+        self.on_tick = on_tick
+        self.ticks = ticks
+        self.on_finished = on_finished
+        self.tick = 0
+        self.start_time = None
+        self.late_ticks = 0  # number of ticks run after their due time
+        self.running = False
+        self._call = None
+
+    @property
+    def the_time(self):
+        return self.tick * self.interval
+
+    def start(self):
+        self.tick = 0
+        self.late_ticks = 0
+        self.start_time = self.clock.seconds()
+        self.running = True
+        self._schedule()
+
+    def stop(self):
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        due = self.start_time + (self.tick + 1) * self.interval
+        self._call = self.clock.callLater(
+            max(0, due - self.clock.seconds()), self._wakeup)
+
+    def _wakeup(self):
+        self._call = None
+        now = self.clock.seconds()
+        first = True
+        while self.running and \
+                self.start_time + (self.tick + 1) * self.interval <= now:
+            if not first:
+                self.late_ticks += 1
+            first = False
+            self.tick += 1
+            try:
+                self.on_tick(self.tick, self.the_time)
+            except Exception:
+                # the next ticks must run whatever happened in this one
+                logger.exception("Scheduler: tick {} failed".format(
+                    self.tick))
+            if self.ticks is not None and self.tick >= self.ticks:
+                self.stop()
+                if self.late_ticks:
+                    logger.warning(
+                        "Scheduler: {} tick(s) run late".format(
+                            self.late_ticks))
+                if self.on_finished is not None:
+                    self.on_finished()
+                return
+        if self.running:
+            self._schedule()
+
+
+class PeriodScheduler(object):
+    """
+    Discrete treatment: each group starts its next period as soon as the
+    previous one is over, so a group never waits for the slowest subject of
+    the other groups. The only barrier is the end of the part: the Deferred
+    returned by run fires when every group has played its periods.
+    A period that fails is logged and the group goes on with the next one,
+    the other groups are not affected.
+    """
+
+    def __init__(self, groups, periods, on_period=None, stop=None):
+        """
+
+        :param groups: the groups, each one provides play_period(period) that
+        returns a Deferred fired at the end of the period (see
+        GroupDYNCPR.play_period)
+        :param periods: the number of periods
+        :param on_period: called with (group, period) when a group has
+        finished a period
+        :param stop: callable, if it returns True the groups don't start any
+        new period
+        """
+        self.groups = list(groups)
+        self.periods = periods
+        self.on_period = on_period
+        self.stop = stop
+        # the last period finished by each group
+        self.progress = {g: 0 for g in self.groups}
+
+    @property
+    def finished(self):
+        return sum(1 for g in self.groups if
+                   self.progress[g] >= self.periods)
+
+    def run(self):
+        """
+        :return: Deferred fired when all the groups are over, with the
+        progress
+        """
+        d = defer.gatherResults([self._run_group(g) for g in self.groups],
+                                consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(lambda _: self.progress)
+        return d
+
+    @defer.inlineCallbacks
+    def _run_group(self, group):
+        for period in range(self.progress[group] + 1, self.periods + 1):
+            if self.stop is not None and self.stop():
+                logger.info("{} stopped after period {}".format(
+                    group, self.progress[group]))
+                break
+            try:
+                yield (defer.maybeDeferred(group.play_period, period))
+            except Exception:
+                logger.exception("{} period {} failed".format(group, period))
+            self.progress[group] = period
+            if self.on_period is not None:
+                try:
+                    self.on_period(group, period)
+                except Exception:
+                    logger.exception("{} on_period {} failed".format(
+                        group, period))
+
+
+def with_deadline(d, timeout, clock=None):
+    """
+    Wait for the answer of a remote at most timeout. A remote that is
+    disconnected is considered as not answering. The answer (or the failure)
+    that arrives after the deadline is only logged.
+    :param d: the Deferred of the answer (callRemote)
+    :param timeout: timedelta, None to wait as long as needed
+    :param clock: an IReactorTime provider, the twisted reactor by default
+    :return: Deferred fired with (True, answer), or with (False, None) at the
+    deadline. The other failures are passed on
+    """
+    connection_errors = (pb.PBConnectionLost, pb.DeadReferenceError)
+
+    def disconnected(failure):
+        failure.trap(*connection_errors)
+        logger.warning("Remote disconnected: {}".format(
+            failure.getErrorMessage()))
+        return False, None
+
+    if timeout is None:
+        d.addCallbacks(lambda answer: (True, answer), disconnected)
+        return d
+
+    if clock is None:
+        from twisted.internet import reactor as clock
+    result = defer.Deferred()
+    call = clock.callLater(timeout.total_seconds(), result.callback,
+                           (False, None))
+
+    def answered(answer):
+        if call.active():
+            call.cancel()
+            result.callback((True, answer))
+        else:
+            logger.info("Answer after the deadline ignored: {}".format(
+                answer))
+
+    def failed(failure):
+        if not call.active():
+            logger.info("Failure after the deadline ignored: {}".format(
+                failure.getErrorMessage()))
+        else:
+            call.cancel()
+            if failure.check(*connection_errors):
+                result.callback(disconnected(failure))
+            else:
+                result.errback(failure)
+
+    d.addCallbacks(answered, failed)
+    return result
+
+
+def call_remote(remote, method, args=(), timeout=None, clock=None):
+    """
+    callRemote with a deadline (see with_deadline). callRemote raises
+    DeadReferenceError at once if the remote is disconnected, the exception
+    is turned into a failure so that it is handled as the others.
+    :param remote: the remote reference
+    :param method: the name of the remote method
+    :param args: the arguments of the remote method
+    :param timeout: timedelta, None to wait as long as needed
+    :param clock: an IReactorTime provider, the twisted reactor by default
+    :return: see with_deadline
+    """
+    return with_deadline(
+        defer.maybeDeferred(remote.callRemote, method, *args), timeout, clock)
@@ -5,7 +5,8 @@ import logging
 from collections import OrderedDict
 from twisted.internet import defer
 from datetime import datetime
-from PyQt4.QtCore import QTimer, QObject, pyqtSlot
+from sqlalchemy.orm import object_session
+from PyQt4.QtCore import QObject, pyqtSlot
 from PyQt4.QtGui import QMessageBox
 
 # le2m
@@ -19,6 +20,10 @@ import dynamicCPRParams as pms
 from dynamicCPRGui import DConfigure
 from dynamicCPRTexts import trans_DYNCPR
 from dynamicCPRGroup import GroupDYNCPR
+from dynamicCPREngine import TickEngine
+from dynamicCPRScheduler import SessionScheduler, PeriodScheduler
+from dynamicCPRStore import WriteBehind
+from dynamicCPRMigrations import upgrade
 
 
 logger = logging.getLogger("le2m")
@@ -33,6 +38,9 @@ class Serveur(QObject):
         self.current_period = 0
         self.all = []
         self.groups = []
+        self.engine = None
+        self.scheduler = None
+        self.writer = None
 
         # __ MENU __
         actions = OrderedDict()
@@ -87,9 +95,17 @@ class Serveur(QObject):
             current_sequence=self.current_sequence))
         self.all = self.le2mserv.gestionnaire_joueurs.get_players(
             'dynamicCPR')
+        # the columns added by the new versions of the part
+        added = upgrade(object_session(self.all[0]))
+        if added:
+            self.le2mserv.gestionnaire_graphique.infoserv(
+                "Database upgraded: {}".format(", ".join(added)))
 
         # __ form groups __
         del self.groups[:]
+        self.writer = WriteBehind(
+            pms.PERSISTENCE_FLUSH_INTERVAL, pms.PERSISTENCE_WORKER,
+            pms.PERSISTENCE_WORKER_BATCH)
         try:
             gps = utiltools.form_groups(
                 self.le2mserv.gestionnaire_joueurs.get_players(),
@@ -102,17 +118,27 @@ class Serveur(QObject):
         self.le2mserv.gestionnaire_graphique.infoserv(
             "Groups", bg="gray", fg="white")
         for g, m in sorted(gps.items()):
-            group = GroupDYNCPR(self.le2mserv, g, m, self.current_sequence)
+            group = GroupDYNCPR(self.le2mserv, g, m, self.current_sequence,
+                                self.writer)
             self.le2mserv.gestionnaire_base.ajouter(group)
             self.groups.append(group)
             self.le2mserv.gestionnaire_graphique.infoserv("__ {} __".format(group))
             for j in m:
                 j.group = group
                 self.le2mserv.gestionnaire_graphique.infoserv("{}".format(j))
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            steps = int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                        pms.TIMER_UPDATE.total_seconds()) + 1
+        else:
+            steps = pms.NOMBRE_PERIODES + 1
+        self.engine = TickEngine(self.groups, steps)
+        self.writer.bind(self.groups[0])
 
         # __ set parameters on remotes (has to be after group formation) __
+        # the parameters are collected once for all the players
         yield (self.le2mserv.gestionnaire_experience.run_step(
-            le2mtrans(u"Configure"), self.all, "configure"))
+            le2mtrans(u"Configure"), self.all, "configure",
+            get_module_attributes(pms)))
 
         # ----------------------------------------------------------------------
         # SELECT THE INITIAL EXTRACTION
@@ -125,8 +151,8 @@ class Serveur(QObject):
         yield (self.le2mserv.gestionnaire_experience.run_step(
             trans_DYNCPR(u"Initial extraction"), self.all,
             "set_initial_extraction"))
-        self.le2mserv.gestionnaire_experience.run_func(
-            self.groups, "update_data")
+        self.writer.commit_parents()
+        self.engine.update_data()
 
         # ----------------------------------------------------------------------
         # DEPENDS ON TREATMENT
@@ -141,22 +167,42 @@ class Serveur(QObject):
                 txt, fg="white", bg="gray")
             yield (self.le2mserv.gestionnaire_experience.run_func(
                 self.all, "newperiod", 1))
+            self.writer.commit_parents()
 
-            # __ timer continuous part __
-            QTimer.singleShot(
-                pms.CONTINUOUS_TIME_DURATION.total_seconds()*1000 + 1000,
-                self.slot_time_elapsed)
+            # __ scheduler continuous part: one tick for all the groups __
+            self.scheduler = SessionScheduler(
+                pms.TIMER_UPDATE, self.slot_update_data,
+                ticks=int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                          pms.TIMER_UPDATE.total_seconds()),
+                on_finished=self.slot_time_elapsed)
 
             time_start = datetime.now()
             self.le2mserv.gestionnaire_graphique.infoserv(
                 "Start time: {}".format(time_start.strftime("%H:%M:%S")))
-            for g in self.groups:
-                g.time_start = time_start
-                g.timer_update.start()
+            self.scheduler.start()
             yield(self.le2mserv.gestionnaire_experience.run_step(
                 trans_DYNCPR("Decision"), self.all, "display_decision",
                 time_start))
 
+        elif pms.DYNAMIC_TYPE == pms.DISCRETE and \
+                pms.DISCRETE_GROUPS_ASYNCHRONOUS:
+
+            # __ each group plays its periods at its own pace __
+            self.scheduler = PeriodScheduler(
+                self.groups, pms.NOMBRE_PERIODES,
+                on_period=self.slot_period_over,
+                stop=lambda: self.le2mserv.gestionnaire_experience.
+                stop_repetitions)
+            txt = le2mtrans(u"Period") + u" 1-{}".format(pms.NOMBRE_PERIODES)
+            self.le2mserv.gestionnaire_graphique.infoserv(
+                [txt], fg="white", bg="gray")
+            self.le2mserv.gestionnaire_graphique.infoclt(
+                [txt], fg="white", bg="gray")
+            yield (self.scheduler.run())
+            self.scheduler = None
+
+            self.slot_time_elapsed()
+
         elif pms.DYNAMIC_TYPE == pms.DISCRETE:
 
             for period in range(1, pms.NOMBRE_PERIODES + 1):
@@ -172,6 +218,7 @@ class Serveur(QObject):
                     [txt], fg="white", bg="gray")
                 yield (self.le2mserv.gestionnaire_experience.run_func(
                     self.all, "newperiod", period))
+                self.writer.commit_parents()
                 for g in self.groups:
                     g.current_period = period
 
@@ -180,8 +227,10 @@ class Serveur(QObject):
                 yield(self.le2mserv.gestionnaire_experience.run_step(
                     "Decision", self.all, "display_decision", time_start))
 
-                self.le2mserv.gestionnaire_experience.run_func(
-                    self.groups, "update_data")
+                self.engine.update_data()
+                for g in self.groups:
+                    g.end_period()
+                self.writer.flush()
 
             self.slot_time_elapsed()
 
@@ -196,18 +245,68 @@ class Serveur(QObject):
         # End of part
         # ----------------------------------------------------------------------
 
+        yield (self.writer.close())
+        for g in self.groups:
+            logger.info("{} {}".format(g, g.broadcaster.get_report()))
         yield (self.le2mserv.gestionnaire_experience.finalize_part("dynamicCPR"))
 
+    def slot_update_data(self, tick, the_time):
+        """
+        called by the scheduler, all the groups are updated in one step
+        :param tick: the tick number
+        :param the_time: the time of the tick, in seconds
+        :return:
+        """
+        self.engine.update_data(the_time)
+        self.writer.flush_if_due(the_time)
+
+    def slot_period_over(self, group, period):
+        """
+        called by the period scheduler when a group has finished a period
+        :param group: the group
+        :param period: the period
+        :return:
+        """
+        progress = self.scheduler.progress
+        self.le2mserv.gestionnaire_graphique.infoserv(
+            u"{}: {} {}/{} - {}/{} groups over, slowest period {}".format(
+                group, le2mtrans(u"Period"), period, pms.NOMBRE_PERIODES,
+                self.scheduler.finished, len(self.groups),
+                min(progress.values())))
+
     @defer.inlineCallbacks
     @pyqtSlot()
     def slot_time_elapsed(self):
         self.le2mserv.gestionnaire_graphique.infoserv("End time: {}".format(
             datetime.now().strftime("%H:%M:%S")))
-        for g in self.groups:
-            g.timer_update.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.set_curves()
+        self.writer.flush(final=True)
         yield (self.le2mserv.gestionnaire_experience.run_func(
             self.all, "end_update_data"))
 
+    def set_curves(self):
+        """
+        Compute the payoffs and the curves of every player from the history
+        of the engine, in one pass, and give them to the parts
+        :return:
+        """
+        interval = pms.TIMER_UPDATE.total_seconds()
+        data = self.engine.compute_payoffs(
+            interval, int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                          interval))
+        for g in self.groups:
+            row, steps = g.engine_index, self.engine.history_count[
+                g.engine_index]
+            for col, part in enumerate(g.players_part):
+                part.set_curves(
+                    data["time"][:steps, row],
+                    data["extraction"][:steps, row, col],
+                    data["cost"][:steps, row, col],
+                    data["part_payoff"][:steps, row, col])
+        logger.info("Payoffs and curves computed by the server")
+
     def display_payoffs(self):
         sequence_screen = DSequence(self.current_sequence)
         if sequence_screen.exec_():
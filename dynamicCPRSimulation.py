@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the headless simulation of the game: no Qt, no twisted,
+no le2m. It uses the same tick kernel as the server (dynamicCPREngine) and
+computes the payoffs as the remotes do, so the numbers are the same as the
+ones of a live session with the same extractions (the infinite payoff is
+computed for all the players at once, it can differ from the one of the
+remotes by the rounding of the exponentials, about 1e-15).
+
+Example:
+    sim = Simulation([lambda state, g, p: 0.5, lambda state, g, p: 1.2],
+                     groups=40, params={"CONTINUOUS_TIME_DURATION":
+                                        timedelta(minutes=20)})
+    result = sim.run()
+    result["part_payoff"][-1]  # the part payoff of every player
+
+steps() is a generator that makes one tick at each iteration, so the
+simulation can be driven by an event loop: task.cooperate(sim.steps()) with
+twisted, or "for _ in sim.steps(): await asyncio.sleep(0)" in a coroutine.
+The parameters of a simulation are only set in dynamicCPRParams while it
+works (see use_params), so several simulations can run in the same process.
+"""
+
+from contextlib import contextmanager
+import numpy as np
+
+import dynamicCPRParams as pms
+from dynamicCPREngine import compute_tick, DiscountedAccumulator
+
+
+class SimulationState(object):
+    """
+    What the strategies can see when they decide
+    """
+
+    def __init__(self, groups, players):
+        self.tick = 0
+        self.time = 0
+        self.resources = np.empty(groups)  # the stock of each group
+        self.extractions = np.zeros((groups, players))  # current extractions
+        self.payoffs = np.zeros((groups, players))  # last instant payoffs
+
+
+class Simulation(object):
+
+    def __init__(self, strategies, groups=1, params=None):
+        """
+
+        :param strategies: one callable per player of a group, called before
+        each tick with (state, group index, player index). It returns the
+        extraction of the player, or None to keep the current one
+        :param groups: the number of groups
+        :param params: dict of parameters, set in dynamicCPRParams as the
+        remotes do at configure, during the simulation only
+        """
+        self.params = dict(params or dict())
+        with self.use_params():
+            self._init(strategies, groups)
+
+    @contextmanager
+    def use_params(self):
+        """
+        Set the parameters of the simulation in dynamicCPRParams, and put the
+        previous values back at the end
+        """
+        missing = object()
+        previous = {k: getattr(pms, k, missing) for k in self.params}
+        for k, v in self.params.items():
+            setattr(pms, k, v)
+        try:
+            yield
+        finally:
+            for k, v in previous.items():
+                if v is missing:
+                    delattr(pms, k)
+                else:
+                    setattr(pms, k, v)
+
+    def _init(self, strategies, groups):
+        self.strategies = list(strategies)
+        self.groups = groups
+        self.players = len(self.strategies)
+        self.state = SimulationState(self.groups, self.players)
+        self.state.resources[:] = pms.RESOURCE_INITIAL_STOCK
+
+        # the instant 0 (initial extraction) then the ticks
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            self.interval = pms.TIMER_UPDATE.total_seconds()
+            self.ticks = int(pms.CONTINUOUS_TIME_DURATION.total_seconds() /
+                             self.interval)
+        else:
+            self.interval = 1
+            self.ticks = pms.NOMBRE_PERIODES
+        size = self.ticks + 1
+        shape = (self.groups, self.players)
+        self.time = np.zeros(size)
+        self.resource = np.zeros((size, self.groups))
+        self.group_extraction = np.zeros((size, self.groups))
+        self.forced = np.zeros((size, self.groups), dtype=bool)
+        self.extraction = np.zeros((size, ) + shape)
+        self.benefit = np.zeros((size, ) + shape)
+        self.cost = np.zeros((size, ) + shape)
+        self.payoff = np.zeros((size, ) + shape)
+        self.accumulator = DiscountedAccumulator(shape, self.interval,
+                                                 self.ticks)
+        self.discounted = np.zeros((size, ) + shape)
+        self.cumulative = np.zeros((size, ) + shape)
+        self.infinite = np.zeros((size, ) + shape)
+        self.part_payoff = np.zeros((size, ) + shape)
+
+    @property
+    def finished(self):
+        return self.state.tick > self.ticks
+
+    def _decide(self):
+        state = self.state
+        for g in range(self.groups):
+            for p, strategy in enumerate(self.strategies):
+                extraction = strategy(state, g, p)
+                if extraction is not None:
+                    state.extractions[g, p] = min(
+                        max(float(extraction), pms.DECISION_MIN),
+                        pms.DECISION_MAX)
+
+    def step(self):
+        """
+        Make one tick for all the groups (the first one is the instant 0,
+        after the initial extraction)
+        :return: the index of the tick
+        """
+        with self.use_params():
+            return self._step()
+
+    def _step(self):
+        state = self.state
+        k = state.tick
+        if k > self.ticks:
+            raise StopIteration("The simulation is over")
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            state.time = k * self.interval
+        else:
+            state.time = k
+        self._decide()
+
+        forced, group_extractions, benefits, costs, payoffs, resources = \
+            compute_tick(state.extractions, state.resources)
+        state.extractions[forced] = 0
+        state.resources = resources
+        state.payoffs = payoffs
+
+        self.time[k] = state.time
+        self.forced[k] = forced
+        self.group_extraction[k] = group_extractions
+        self.resource[k] = resources
+        self.extraction[k] = state.extractions
+        self.benefit[k] = benefits
+        self.cost[k] = costs
+        self.payoff[k] = payoffs
+
+        # payoffs, as in RemoteDYNCPR.remote_update_data
+        if pms.DYNAMIC_TYPE == pms.CONTINUOUS:
+            self.discounted[k] = self.accumulator.add(state.time, payoffs)
+            self.cumulative[k] = self.accumulator.cumulative
+        self.infinite[k] = pms.get_infinite_payoff_array(
+            state.time, resources[:, np.newaxis], state.extractions,
+            group_extractions[:, np.newaxis])
+        self.part_payoff[k] = self.cumulative[k] + self.infinite[k]
+
+        state.tick += 1
+        return k
+
+    def steps(self):
+        """
+        Generator, one tick per iteration
+        """
+        while not self.finished:
+            yield self.step()
+
+    def run(self):
+        """
+        Make all the ticks
+        :return: see get_result
+        """
+        for _ in self.steps():
+            pass
+        return self.get_result()
+
+    def get_result(self):
+        """
+        :return: dict of numpy arrays, the first dimension is the tick
+        """
+        return {"time": self.time, "resource": self.resource,
+                "group_extraction": self.group_extraction,
+                "forced": self.forced, "extraction": self.extraction,
+                "benefit": self.benefit, "cost": self.cost,
+                "payoff": self.payoff, "discounted": self.discounted,
+                "cumulative": self.cumulative, "infinite": self.infinite,
+                "part_payoff": self.part_payoff}
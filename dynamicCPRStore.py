@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the write-behind layer of the part.
+During the game the extractions are stored in lightweight records (see
+ExtractionRecord and GroupExtractionRecord) instead of SQLAlchemy instances.
+The records are kept in memory and written as bulk inserts, either regularly
+(PERSISTENCE_FLUSH_INTERVAL) or when the server asks for it (end of the
+period, end of the part), in the server process or by the persistence worker
+(PERSISTENCE_WORKER).
+It also contains the reader functions that expand the rows stored in
+STORAGE_CHANGE_POINTS mode into one value per tick, and the functions that
+store the curves as compressed arrays (see CurveBlobDYNCPR).
+"""
+
+import logging
+import zlib
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy.orm import object_session
+
+import dynamicCPRParams as pms
+
+
+logger = logging.getLogger("le2m")
+
+
+class Record(object):
+    """
+    Base class of the records.
+    table is the SQLAlchemy table of the record and parent the ORM instance
+    that owns the record (the foreign key is read from the parent when the
+    record is written, so the parent doesn't need an id before the flush).
+    A record that will not change anymore is sealed, only sealed records are
+    written by the regular flushes.
+    """
+    __slots__ = ("parent", "sealed")
+    table = None
+
+    def to_row(self):
+        raise NotImplementedError
+
+    def to_dict(self):
+        temp = self.to_row()
+        temp["id"] = None
+        return temp
+
+
+class WriteBehind(object):
+    def __init__(self, interval=None, use_worker=False, worker_batch=1000):
+        """
+
+        :param interval: the time between two regular flushes (timedelta),
+        None to only flush when asked
+        :param use_worker: if True the rows are written by a persistence
+        worker process (see dynamicCPRWorker), started by bind
+        :param worker_batch: max number of rows per commit of the worker
+        """
+        self.interval = None if interval is None else \
+            interval.total_seconds()
+        self._pending = []
+        self._last_flush = 0
+        self.session = None
+        self.rows_written = 0
+        self.use_worker = use_worker
+        self.worker_batch = worker_batch
+        self.worker = None
+
+    def bind(self, instance):
+        """
+        Use the SQLAlchemy session of instance, and start the persistence
+        worker if needed
+        :param instance: an ORM instance already added to the session
+        :return:
+        """
+        self.session = object_session(instance)
+        if self.use_worker and self.worker is None:
+            from dynamicCPRWorker import PersistenceWorker
+            self.worker = PersistenceWorker(
+                str(self.session.bind.url), self.worker_batch)
+            self.worker.start()
+
+    def close(self):
+        """
+        Write everything and stop the worker, without blocking
+        :return: None, or with the worker a Deferred fired when the worker is
+        over and the rows it returned are written
+        """
+        self.flush(final=True)
+        if self.worker is None:
+            return None
+        worker, self.worker = self.worker, None
+
+        return worker.stop().addCallback(
+            lambda _: self._write_returned(worker))
+
+    def commit_parents(self):
+        """
+        With the worker, commit the new parents (repetitions, groups) so that
+        they have an id and the worker's connection can write (sqlite only
+        allows one writer at a time). To be called by the server out of the
+        game loop, e.g. after the new period
+        :return:
+        """
+        if self.worker is not None and self.session is not None and \
+                self.session.new:
+            self.session.commit()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def add(self, record):
+        self._pending.append(record)
+
+    def flush_if_due(self, the_time):
+        """
+        Flush the sealed records if the interval is elapsed
+        :param the_time: the current time of the part, in seconds
+        :return:
+        """
+        if self.interval is not None and \
+                the_time - self._last_flush >= self.interval:
+            self._last_flush = the_time
+            self.flush()
+
+    def flush(self, final=False):
+        """
+        Write the pending records with one insert per table.
+        :param final: if True every record is written, sealed or not. Must be
+        used at the end of the period / part
+        :return: the number of rows written
+        """
+        if not self._pending:
+            return 0
+        if final:
+            to_write, self._pending = self._pending, []
+        else:
+            to_write = [r for r in self._pending if r.sealed]
+            if not to_write:
+                return 0
+            self._pending = [r for r in self._pending if not r.sealed]
+
+        if self.session is None:
+            self.session = object_session(to_write[0].parent)
+        # the parents (repetitions, groups) need an id
+        if self.worker is not None:
+            # the worker writes with its own connection, so the new parents
+            # must have been committed (see commit_parents)
+            if self.session.new:
+                logger.warning("WriteBehind: new parents committed during "
+                               "the game")
+                self.session.commit()
+        else:
+            self.session.flush()
+
+        rows = OrderedDict()
+        for r in to_write:
+            rows.setdefault(r.table, []).append(r.to_row())
+        for table, table_rows in rows.items():
+            if self.worker is not None:
+                self.worker.send(table, table_rows)
+            else:
+                self.session.execute(table.insert(), table_rows)
+        self.rows_written += len(to_write)
+        if self.worker is not None:
+            self.worker.poll()
+            self._write_returned(self.worker)
+            logger.debug(
+                "WriteBehind: {} rows sent to the worker, {} pending, worker "
+                "queue {}".format(len(to_write), len(self._pending),
+                                  self.worker.queue_depth))
+        else:
+            logger.debug("WriteBehind: {} rows written, {} pending".format(
+                len(to_write), len(self._pending)))
+        return len(to_write)
+
+    def _write_returned(self, worker):
+        """
+        Write in the server's session the rows the worker couldn't write
+        (database locked), so that they are not lost. They are committed at
+        once to release the lock
+        :param worker: the PersistenceWorker
+        :return:
+        """
+        returned = worker.take_returned()
+        for table, rows in returned:
+            self.session.execute(table.insert(), rows)
+            logger.info("WriteBehind: {} rows of {} written by the "
+                        "server".format(len(rows), table.name))
+        if returned:
+            self.session.commit()
+
+
+# ==============================================================================
+# READERS
+# ==============================================================================
+
+
+def _get(row, name):
+    """
+    the rows can be ORM instances, records or mappings (dict, sql rows)
+    """
+    try:
+        return getattr(row, name)
+    except AttributeError:
+        return row[name]
+
+
+def expand_group_extractions(rows, step=1, growth=None):
+    """
+    Expand the group extraction rows into one value per tick.
+    Each row is valid from DYNCPR_time to DYNCPR_time_end and its resource
+    stock is the stock at DYNCPR_time. The stock of the following ticks is
+    computed as the server does, so the values are exactly the same as the ones
+    of the game.
+    Works with both storage modes (in STORAGE_EVERY_TICK mode each row is
+    valid for one tick only).
+    :param rows: the rows of one group and one period
+    :param step: the time between two ticks (TIMER_UPDATE, in seconds)
+    :param growth: the growth of the resource, RESOURCE_GROWTH by default
+    :return: a dict of numpy arrays: time, group_extraction, resource_stock
+    """
+    if growth is None:
+        growth = pms.RESOURCE_GROWTH
+    rows = sorted(rows, key=lambda r: _get(r, "DYNCPR_time"))
+    times, extractions, resources = [], [], []
+    for r in rows:
+        start = _get(r, "DYNCPR_time")
+        end = _get(r, "DYNCPR_time_end")
+        if end is None:
+            end = start
+        count = int(round((end - start) / float(step))) + 1
+        extraction = _get(r, "DYNCPR_group_extraction")
+        # [R0, g, -E, g, -E, ...]: the cumulative sum gives R0, R0 + g,
+        # (R0 + g) - E... so one resource value every two elements
+        increments = np.empty(2 * count - 1)
+        increments[0] = _get(r, "DYNCPR_resource_stock")
+        increments[1::2] = growth
+        increments[2::2] = -extraction
+        times.append(start + step * np.arange(count))
+        extractions.append(np.repeat(float(extraction), count))
+        resources.append(np.cumsum(increments)[::2])
+    if not rows:
+        return {"time": np.empty(0), "group_extraction": np.empty(0),
+                "resource_stock": np.empty(0)}
+    return {"time": np.concatenate(times),
+            "group_extraction": np.concatenate(extractions),
+            "resource_stock": np.concatenate(resources)}
+
+
+def expand_extractions(rows, times):
+    """
+    Give the individual extraction used by the group at each time.
+    An extraction is used from the tick following the end of the previous
+    one until its DYNCPR_extraction_time_end. The rows that have never been
+    used by a tick (replaced before the tick) are ignored.
+    :param rows: the extraction rows of one player and one period
+    :param times: the times of the ticks (see expand_group_extractions)
+    :return: numpy array with the extraction at each time
+    """
+    used = sorted([r for r in rows if
+                   _get(r, "DYNCPR_extraction_time_end") is not None],
+                  key=lambda r: _get(r, "DYNCPR_extraction_time_end"))
+    ends = np.array([_get(r, "DYNCPR_extraction_time_end") for r in used])
+    values = np.array([_get(r, "DYNCPR_extraction") for r in used],
+                      dtype=float)
+    positions = np.searchsorted(ends, np.asarray(times), side="left")
+    positions = np.minimum(positions, len(used) - 1)
+    return values[positions]
+
+
+# ==============================================================================
+# CURVES
+# ==============================================================================
+
+CURVE_DTYPE = np.dtype("<f8")
+
+
+def pack_array(values, dtype=CURVE_DTYPE):
+    """
+    :param values: sequence of numbers
+    :param dtype: the type of the stored values
+    :return: the values as compressed bytes
+    """
+    return zlib.compress(np.asarray(values, dtype=dtype).tobytes())
+
+
+def unpack_array(blob, dtype=CURVE_DTYPE, length=None):
+    """
+    :param blob: see pack_array
+    :param dtype: the type of the stored values (numpy dtype or its str)
+    :param length: the number of values, checked if given
+    :return: numpy array
+    """
+    values = np.frombuffer(zlib.decompress(blob), dtype=np.dtype(dtype))
+    if length is not None and len(values) != length:
+        raise ValueError("The curve has {} values instead of {}".format(
+            len(values), length))
+    return values
+
+
+def load_curve(row):
+    """
+    :param row: a row of the curve blob table (ORM instance or mapping)
+    :return: xdata, ydata (numpy arrays)
+    """
+    dtype = _get(row, "DYNCPR_curve_dtype")
+    length = _get(row, "DYNCPR_curve_length")
+    return (unpack_array(_get(row, "DYNCPR_curve_xdata"), dtype, length),
+            unpack_array(_get(row, "DYNCPR_curve_ydata"), dtype, length))
+
+
+def load_curves(rows):
+    """
+    :param rows: the curve blob rows of one part
+    :return: dict {curve type: (xdata, ydata)}
+    """
+    return {_get(r, "DYNCPR_curve_type"): load_curve(r) for r in rows}
+
+
+def load_point_curves(rows):
+    """
+    Read the curves stored with one row per point (partie_dynamicCPR_curves)
+    :param rows: the point rows of one part
+    :return: dict {curve type: (xdata, ydata)}, the points in the order of
+    their id
+    """
+    points = OrderedDict()
+    for r in sorted(rows, key=lambda r: _get(r, "id")):
+        points.setdefault(_get(r, "DYNCPR_curve_type"), []).append(
+            (_get(r, "DYNCPR_curve_x"), _get(r, "DYNCPR_curve_y")))
+    return {k: (np.array([p[0] for p in v], dtype=CURVE_DTYPE),
+                np.array([p[1] for p in v], dtype=CURVE_DTYPE))
+            for k, v in points.items()}
@@ -57,3 +57,34 @@ def get_text_summary(part_payoff):
 
 
 
+
+
+# ==============================================================================
+# INFORMATION TABLE (decision screen)
+# ==============================================================================
+
+
+def get_infos_head():
+    """
+    The headers of the information table, translated once per part
+    """
+    the_time = trans_DYNCPR(u"Instant") if \
+        pms.DYNAMIC_TYPE == pms.CONTINUOUS else trans_DYNCPR(u"Period")
+    return [the_time, trans_DYNCPR(u"Your extraction"),
+            trans_DYNCPR(u"Pair extraction"),
+            trans_DYNCPR(u"Available resource"),
+            trans_DYNCPR(u"Instant payoff"),
+            trans_DYNCPR(u"Discounted payoff"),
+            trans_DYNCPR(u"Cumulative payoff"), trans_DYNCPR(u"Part payoff")]
+
+
+def get_infos_row(the_time, extraction, group_extraction, resource, payoff,
+                  discounted, cumulative, part_payoff):
+    """
+    One row of the information table, in the order of get_infos_head
+    :return: tuple of unicode
+    """
+    return (u"{}".format(int(the_time)), u"{:.2f}".format(extraction),
+            u"{:.2f}".format(group_extraction), u"{:.2f}".format(resource),
+            u"{:.2f}".format(payoff), u"{:.4f}".format(discounted),
+            u"{:.2f}".format(cumulative), u"{:.2f}".format(part_payoff))
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the protocol used to send the data of the group to the
+remotes (server and remote sides).
+The remote tells the server which protocol it understands when it is
+configured (the return value of remote_configure). The remotes that don't
+return anything (old versions) receive the full dictionaries. The server then
+tells the remote the protocol to use (remote_set_protocol).
+"""
+
+from __future__ import division
+
+import logging
+import time
+import numpy as np
+from twisted.internet import defer
+from twisted.spread import banana, jelly
+
+import dynamicCPRParams as pms
+
+
+logger = logging.getLogger("le2m")
+
+# protocols
+PROTOCOL_DICT = 0  # the full to_dict() of every extraction
+PROTOCOL_DELTA = 1  # only the values that changed (see DeltaEncoder)
+# the values are identified by their position (see flatten_compact), the
+# individual extractions are integers in units of DECISION_STEP, the curves of
+# the summary are sent as tuples
+PROTOCOL_COMPACT = 2
+# PROTOCOL_COMPACT, and the updates of the group are serialized once and sent
+# as bytes to every member (see Broadcaster)
+PROTOCOL_PACKED = 3
+# PROTOCOL_PACKED, and in the large groups (see is_large_group) each member
+# receives only its own extraction and the aggregates of the group
+PROTOCOL_LARGE_GROUP = 4
+# PROTOCOL_LARGE_GROUP, and display_summary tells the remote whether to send
+# its curves back (the server computes them, see CURVES_CROSS_CHECK)
+PROTOCOL_SERVER_CURVES = 5
+PROTOCOL = PROTOCOL_SERVER_CURVES  # the protocol of this version
+
+# the fields sent to the remotes
+MEMBER_FIELDS = ("DYNCPR_extraction", "DYNCPR_extraction_time",
+                 "DYNCPR_resource", "DYNCPR_benefice", "DYNCPR_cost",
+                 "DYNCPR_payoff")
+GROUP_FIELDS = ("DYNCPR_period", "DYNCPR_time", "DYNCPR_group_extraction",
+                "DYNCPR_resource_stock")
+
+# kinds of update
+KEYFRAME = 0
+DELTA = 1
+
+
+def get_protocol(answer):
+    """
+    :param answer: the value returned by remote_configure
+    :return: the protocol to use with this remote
+    """
+    try:
+        return int(answer)
+    except (TypeError, ValueError):
+        return PROTOCOL_DICT
+
+
+def _extraction_factor():
+    return int(round(1 / pms.DECISION_STEP))
+
+
+def encode_extraction(value):
+    """
+    :param value: an extraction (float)
+    :return: the extraction in units of DECISION_STEP (int)
+    """
+    return int(round(value * _extraction_factor()))
+
+
+def decode_extraction(code):
+    """
+    :param code: an extraction in units of DECISION_STEP
+    :return: the extraction (float), the same value as the one of the slider
+    """
+    return code / _extraction_factor()
+
+
+def is_large_group(size):
+    """
+    :param size: the number of members of the group
+    :return: True if the group is managed in large-group mode
+    """
+    return size >= pms.LARGE_GROUP_SIZE
+
+
+def member_values(extraction):
+    """
+    :param extraction: the extraction of a member (record)
+    :return: tuple with the MEMBER_FIELDS, the extraction in units of
+    DECISION_STEP
+    """
+    return (encode_extraction(extraction.DYNCPR_extraction), ) + \
+        tuple(getattr(extraction, f) for f in MEMBER_FIELDS[1:])
+
+
+def group_values(group_extraction):
+    """
+    :param group_extraction: the group extraction (record)
+    :return: tuple with the GROUP_FIELDS
+    """
+    return tuple(getattr(group_extraction, f) for f in GROUP_FIELDS)
+
+
+def aggregate(extractions, bins=0):
+    """
+    The aggregates of the individual extractions sent in large-group mode
+    (the total is the group extraction)
+    :param extractions: the individual extractions of the group
+    :param bins: number of bins of the histogram, 0 for no histogram
+    :return: tuple (mean, min, max, histogram), histogram is a list of counts
+    between DECISION_MIN and DECISION_MAX or None
+    """
+    extractions = np.asarray(extractions, dtype=float)
+    histogram = None
+    if bins:
+        histogram = np.histogram(
+            extractions, bins=bins,
+            range=(pms.DECISION_MIN, pms.DECISION_MAX))[0].tolist()
+    return (float(extractions.mean()), float(extractions.min()),
+            float(extractions.max()), histogram)
+
+
+def decode_large_group(uid, own, group):
+    """
+    Remote side, large-group mode
+    :param uid: the uid of the player
+    :param own: see member_values
+    :param group: see group_values
+    :return: the same arguments as remote_update_data
+    """
+    extraction = dict(zip(MEMBER_FIELDS, own))
+    extraction["DYNCPR_extraction"] = decode_extraction(
+        extraction["DYNCPR_extraction"])
+    return {uid: extraction}, dict(zip(GROUP_FIELDS, group))
+
+
+def flatten(members_extractions, group_extraction):
+    """
+    :param members_extractions: dict player uid: extraction (record)
+    :param group_extraction: the group extraction (record)
+    :return: dict (uid, field): value, the group fields have uid None
+    """
+    state = dict()
+    for uid, extraction in members_extractions.items():
+        for f in MEMBER_FIELDS:
+            state[(uid, f)] = getattr(extraction, f)
+    for f in GROUP_FIELDS:
+        state[(None, f)] = getattr(group_extraction, f)
+    return state
+
+
+def unflatten(state):
+    """
+    :param state: see flatten
+    :return: the same arguments as remote_update_data:
+    dict uid: dict field: value, dict field: value
+    """
+    members, group = dict(), dict()
+    for (uid, f), v in state.items():
+        if uid is None:
+            group[f] = v
+        else:
+            members.setdefault(uid, dict())[f] = v
+    return members, group
+
+
+def flatten_compact(members, members_extractions, group_extraction):
+    """
+    :param members: the uid of the group members, in the group order
+    :param members_extractions: dict player uid: extraction (record)
+    :param group_extraction: the group extraction (record)
+    :return: dict position: value. MEMBER_FIELDS for each member then
+    GROUP_FIELDS
+    """
+    values = []
+    for uid in members:
+        extraction = members_extractions[uid]
+        for f in MEMBER_FIELDS:
+            values.append(getattr(extraction, f))
+        values[-len(MEMBER_FIELDS)] = encode_extraction(
+            extraction.DYNCPR_extraction)
+    for f in GROUP_FIELDS:
+        values.append(getattr(group_extraction, f))
+    return dict(enumerate(values))
+
+
+def unflatten_compact(members, state):
+    """
+    :param members: the uid of the group members, in the group order
+    :param state: see flatten_compact
+    :return: the same arguments as remote_update_data
+    """
+    size = len(MEMBER_FIELDS)
+    group_members_extractions = dict()
+    for i, uid in enumerate(members):
+        extraction = dict(zip(
+            MEMBER_FIELDS, [state[k] for k in range(i * size, (i + 1) * size)]))
+        extraction["DYNCPR_extraction"] = decode_extraction(
+            extraction["DYNCPR_extraction"])
+        group_members_extractions[uid] = extraction
+    start = len(members) * size
+    group_extraction = dict(zip(
+        GROUP_FIELDS,
+        [state[k] for k in range(start, start + len(GROUP_FIELDS))]))
+    return group_members_extractions, group_extraction
+
+
+def pack_curves(protocol, extractions, payoffs, cost):
+    """
+    Remote side, the curves sent back at the end of the part
+    :param protocol: the protocol used with the server
+    :param extractions: PlotData
+    :param payoffs: PlotData
+    :param cost: PlotData
+    :return: dict of (x, y) lists, or for PROTOCOL_COMPACT a tuple
+    (protocol, (x, extraction codes), (x, y), (x, y)). The values are python
+    floats (jelly doesn't serialize numpy values)
+    """
+    if protocol >= PROTOCOL_COMPACT:
+        return (PROTOCOL_COMPACT,
+                (extractions.xdata.tolist(),
+                 [encode_extraction(e) for e in extractions.ydata.tolist()]),
+                (payoffs.xdata.tolist(), payoffs.ydata.tolist()),
+                (cost.xdata.tolist(), cost.ydata.tolist()))
+    return {
+        "extractions": zip(extractions.xdata.tolist(),
+                           extractions.ydata.tolist()),
+        "payoffs": zip(payoffs.xdata.tolist(), payoffs.ydata.tolist()),
+        "cost": zip(cost.xdata.tolist(), cost.ydata.tolist())
+    }
+
+
+def unpack_curves(data):
+    """
+    Server side
+    :param data: see pack_curves, both forms are accepted
+    :return: dict of (x, y) lists
+    """
+    if isinstance(data, dict):
+        return data
+    protocol, extractions, payoffs, cost = data
+    return {
+        "extractions": zip(extractions[0],
+                           [decode_extraction(c) for c in extractions[1]]),
+        "payoffs": zip(*payoffs),
+        "cost": zip(*cost)
+    }
+
+
+class DeltaEncoder(object):
+    """
+    Server side, one per group.
+    An update contains the values that changed since the last state
+    acknowledged by every member of the group, so every member receives the
+    same update. A keyframe (the full state) is sent every
+    DELTA_KEYFRAME_INTERVAL updates and after a member failed to apply an
+    update.
+    """
+
+    def __init__(self, members, keyframe_interval, group_members=None):
+        """
+
+        :param members: the uid of the players that receive the updates
+        :param keyframe_interval: number of updates between two keyframes
+        :param group_members: the uid of all the group members, in the group
+        order. If given the compact form is used (PROTOCOL_COMPACT)
+        """
+        self.group_members = group_members
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.acknowledged = {uid: None for uid in members}
+        self._states = dict()
+
+    def _base(self):
+        acknowledged = self.acknowledged.values()
+        if not acknowledged or None in acknowledged:
+            return None
+        return min(acknowledged)
+
+    def encode(self, members_extractions, group_extraction):
+        """
+        :return: the update (kind, seq, base, changes)
+        """
+        if self.group_members is None:
+            state = flatten(members_extractions, group_extraction)
+        else:
+            state = flatten_compact(
+                self.group_members, members_extractions, group_extraction)
+        self.seq += 1
+        base = self._base()
+        if base is None or base not in self._states or \
+                self.seq % self.keyframe_interval == 0:
+            if self.group_members is None:
+                update = (KEYFRAME, self.seq, None, state.items())
+            else:
+                update = (KEYFRAME, self.seq, None,
+                          [state[k] for k in range(len(state))])
+        else:
+            base_state = self._states[base]
+            update = (DELTA, self.seq, base,
+                      [(k, v) for k, v in state.items()
+                       if k not in base_state or base_state[k] != v])
+        self._states[self.seq] = state
+        # the states older than the base, or than a keyframe, will not be a
+        # base anymore: at most keyframe_interval states are kept, even while
+        # a member doesn't acknowledge
+        oldest = self.seq if update[0] == KEYFRAME else base
+        for seq in [s for s in self._states if s < oldest]:
+            del self._states[seq]
+        return update
+
+    def acknowledge(self, seq, uid):
+        """
+        Callback of the remote call, seq is the value returned by the remote
+        (None if it couldn't apply the update)
+        """
+        if seq is None:
+            self.reject(uid)
+        elif self.acknowledged.get(uid) is None or \
+                seq > self.acknowledged[uid]:
+            self.acknowledged[uid] = seq
+        return seq
+
+    def reject(self, uid):
+        """
+        The next update will be a keyframe
+        """
+        self.acknowledged[uid] = None
+
+
+class DeltaDecoder(object):
+    """
+    Remote side: rebuild the full state from the updates
+    """
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        self._states = dict()
+
+    def decode(self, update):
+        """
+        :param update: (kind, seq, base, changes), see DeltaEncoder.encode
+        :return: the full state (see flatten), None if the base state is
+        unknown (the server will send a keyframe)
+        """
+        kind, seq, base, changes = update
+        if kind == KEYFRAME:
+            state = dict(enumerate(changes)) if self.compact else dict(changes)
+        else:
+            try:
+                state = dict(self._states[base])
+            except KeyError:
+                return None
+            state.update(changes)
+        self._states[seq] = state
+        # the server will never refer to a state older than base, or than a
+        # keyframe
+        oldest = seq if kind == KEYFRAME else base
+        for s in [s for s in self._states if s < oldest]:
+            del self._states[s]
+        return state
+
+
+# ==============================================================================
+# SERIALIZE ONCE
+# ==============================================================================
+
+
+def pack(*args):
+    """
+    Serialize the arguments of a remote call
+    :return: bytes
+    """
+    return banana.encode(jelly.jelly(args))
+
+
+def unpack(packed):
+    """
+    :param packed: see pack
+    :return: the tuple of the arguments. Only the basic types are accepted
+    """
+    return jelly.unjelly(banana.decode(packed), jelly.globalSecurity)
+
+
+class Broadcaster(object):
+    """
+    Make the same remote call on several remotes with the arguments
+    serialized once. The remote method receives the bytes (see unpack).
+    The time saved is estimated as the serialization time multiplied by the
+    number of serializations avoided.
+    """
+
+    def __init__(self):
+        self.fanouts = 0
+        self.calls = 0
+        self.time_serialize = 0.
+        self.time_saved = 0.
+
+    def broadcast(self, remotes, method, *args):
+        """
+        :param remotes: the pb.RemoteReference of the members
+        :param method: the name of the remote method
+        :param args: the arguments of the call
+        :return: the list of the deferreds, in the remotes order. A remote
+        that is disconnected gets a failed deferred, the call to the others
+        is made anyway
+        """
+        start = time.time()
+        packed = pack(*args)
+        elapsed = time.time() - start
+        saved = elapsed * (len(remotes) - 1)
+        self.fanouts += 1
+        self.calls += len(remotes)
+        self.time_serialize += elapsed
+        self.time_saved += saved
+        logger.debug("{}: {} bytes to {} remotes, {:.1f} us saved".format(
+            method, len(packed), len(remotes), saved * 1e6))
+        return [defer.maybeDeferred(r.callRemote, method, packed)
+                for r in remotes]
+
+    def get_report(self):
+        if not self.fanouts:
+            return "Broadcaster: no fan-out"
+        return "Broadcaster: {} fan-outs, {} calls, {:.1f} us saved per " \
+               "fan-out ({:.3f} s in total)".format(
+                self.fanouts, self.calls, self.time_saved / self.fanouts * 1e6,
+                self.time_saved)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the persistence worker: a separate process that writes
+the records of the part in the database, so that the game loop never waits
+for the disk.
+The server sends the rows to the worker through a multiprocessing queue (see
+WriteBehind.flush), the worker commits them by batches and sends back an
+acknowledgement for each batch with its own queue depth.
+When the database stays locked the worker retries with a growing delay. If it
+still can't write, the rows come back with the acknowledgement and the server
+writes them itself (see WriteBehind.flush), so no row is lost.
+This module only depends on sqlalchemy, so that it is cheap to import in the
+worker process (twisted is imported by the server side only).
+"""
+
+import logging
+import multiprocessing
+import time
+from Queue import Empty
+from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+
+logger = logging.getLogger("le2m")
+
+
+def _run_worker(url, requests, replies, batch_size, retries=8,
+                max_delay=5.):
+    """
+    The loop of the worker process.
+    :param url: the url of the database
+    :param requests: queue of (batch_id, table_name, rows), None to stop
+    :param replies: queue of acknowledgements (batch_id, table_name, rows
+    count, backlog, error, rows). rows is None if the batch is written, the
+    rows to write otherwise
+    :param batch_size: max number of rows committed in one transaction
+    :param retries: number of attempts while the database is locked
+    :param max_delay: max delay between two attempts, in seconds
+    :return:
+    """
+    engine = create_engine(url)
+    metadata = MetaData()
+    tables = dict()
+    stop = False
+
+    while not stop:
+        # wait for a batch, then take the following ones until batch_size
+        batches = [requests.get()]
+        rows_count = 0
+        while batches[-1] is not None and rows_count < batch_size:
+            rows_count += len(batches[-1][2])
+            try:
+                batches.append(requests.get_nowait())
+            except Empty:
+                break
+        if batches[-1] is None:
+            stop = True
+            batches.pop()
+        if not batches:
+            continue
+
+        error = None
+        for attempt in range(retries):
+            try:
+                with engine.begin() as connection:
+                    for batch_id, table_name, rows in batches:
+                        if table_name not in tables:
+                            tables[table_name] = Table(
+                                table_name, metadata, autoload_with=engine)
+                        connection.execute(tables[table_name].insert(), rows)
+                error = None
+                break
+            except OperationalError as e:
+                # the database is locked by the server, we try again later
+                error = str(e)
+                time.sleep(min(0.1 * 2 ** attempt, max_delay))
+            except SQLAlchemyError as e:
+                error = str(e)
+                break
+
+        try:
+            backlog = requests.qsize()
+        except NotImplementedError:  # mac os
+            backlog = None
+        for batch_id, table_name, rows in batches:
+            # the rows not written go back to the server
+            replies.put((batch_id, table_name, len(rows), backlog, error,
+                         None if error is None else rows))
+
+    engine.dispose()
+
+
+class PersistenceWorker(object):
+    """
+    The server side of the worker
+    """
+
+    def __init__(self, url, batch_size=1000):
+        self.url = url
+        self._requests = multiprocessing.Queue()
+        self._replies = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_run_worker,
+            args=(url, self._requests, self._replies, batch_size))
+        self._process.daemon = True
+        self.batches_sent = 0
+        self.batches_acknowledged = 0
+        self.rows_sent = 0
+        self.rows_acknowledged = 0
+        self.worker_backlog = 0
+        self.errors = []
+        self.returned = []  # (table, rows) not written by the worker
+        self._tables = dict()
+
+    @property
+    def queue_depth(self):
+        """
+        the number of batches sent but not acknowledged yet
+        """
+        return self.batches_sent - self.batches_acknowledged
+
+    def start(self):
+        self._process.start()
+        logger.info("Persistence worker started (pid {})".format(
+            self._process.pid))
+
+    def send(self, table, rows):
+        """
+        Send rows to the worker. Doesn't block: the queue is fed by a thread
+        :param table: the SQLAlchemy table
+        :param rows: list of dict
+        :return: the id of the batch
+        """
+        self.batches_sent += 1
+        self.rows_sent += len(rows)
+        self._tables[table.name] = table
+        self._requests.put((self.batches_sent, table.name, rows))
+        return self.batches_sent
+
+    def poll(self):
+        """
+        Read the acknowledgements received so far, without waiting. The rows
+        the worker couldn't write are added to returned
+        :return: the number of acknowledgements read
+        """
+        count = 0
+        while True:
+            try:
+                batch_id, table_name, rows_count, backlog, error, rows = \
+                    self._replies.get_nowait()
+            except Empty:
+                break
+            count += 1
+            self.batches_acknowledged += 1
+            if error is None:
+                self.rows_acknowledged += rows_count
+            else:
+                self.errors.append((batch_id, error))
+                self.returned.append((self._tables[table_name], rows))
+                logger.warning(
+                    "Persistence worker, batch {} returned to the server: "
+                    "{}".format(batch_id, error))
+            if backlog is not None:
+                self.worker_backlog = backlog
+        return count
+
+    def take_returned(self):
+        """
+        :return: the list of (table, rows) returned by the worker since the
+        last call
+        """
+        returned, self.returned = self.returned, []
+        return returned
+
+    def stop(self, timeout=30, clock=None):
+        """
+        Ask the worker to write what remains. Doesn't block: the process is
+        checked regularly on the reactor
+        :param timeout: max number of seconds to wait
+        :param clock: an IReactorTime provider, the twisted reactor by default
+        :return: Deferred fired when the worker is over (or at the timeout)
+        """
+        from twisted.internet import defer
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._requests.put(None)
+        deadline = clock.seconds() + timeout
+        done = defer.Deferred()
+
+        def check():
+            self.poll()
+            if self._process.is_alive() and clock.seconds() < deadline:
+                clock.callLater(0.1, check)
+                return
+            self.poll()
+            if self._process.is_alive():
+                logger.error(
+                    "Persistence worker still running after {} s, {} "
+                    "batch(es) not acknowledged".format(
+                        timeout, self.queue_depth))
+            logger.info(
+                "Persistence worker stopped: {} rows sent, {} written by the "
+                "worker".format(self.rows_sent, self.rows_acknowledged))
+            done.callback(None)
+
+        check()
+        return done
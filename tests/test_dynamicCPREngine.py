@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the tick engine: each step gives the same values as the step of the
+first version of the part (GroupDYNCPR.update_data, one group at a time with
+python floats), transcribed in baseline_tick.
+Run from the directory of the part: python -m pytest tests
+"""
+
+import unittest
+import numpy as np
+
+import dynamicCPRParams as pms
+from dynamicCPREngine import compute_tick, TickEngine, decimate
+
+
+def baseline_tick(extractions, resource):
+    """
+    The step of one group as GroupDYNCPR.update_data made it
+    :param extractions: list of the extractions of the members
+    :param resource: the resource stock before the step
+    :return: forced, group extraction, extractions, benefits, costs, payoffs,
+    new resource
+    """
+    group_extrac = sum(extractions)
+    forced = group_extrac > resource
+    if forced:
+        extractions = [0] * len(extractions)
+        group_extrac = sum(extractions)
+    benefits, costs, payoffs = [], [], []
+    for j_extrac in extractions:
+        benefice = pms.param_a * j_extrac - (pms.param_b / 2) * \
+            pow(j_extrac, 2)
+        cost = j_extrac * (pms.param_c0 - pms.param_c1 * resource)
+        if cost < 0:
+            cost = 0
+        benefits.append(benefice)
+        costs.append(cost)
+        payoffs.append(benefice - cost)
+    resource += pms.RESOURCE_GROWTH
+    resource -= group_extrac
+    return forced, group_extrac, extractions, benefits, costs, payoffs, \
+        resource
+
+
+class FakeGroup(object):
+    """
+    Take the place of GroupDYNCPR: keep the results of the last step
+    """
+
+    def __init__(self, players, resource=pms.RESOURCE_INITIAL_STOCK):
+        self.players = list(range(players))
+        self.current_resource = resource
+        self.ticks = []
+
+    def attach_engine(self, engine, index):
+        self.engine_index = index
+
+    def apply_tick(self, the_time, forced, group_extrac, benefits, costs,
+                   payoffs, resource):
+        self.current_resource = resource
+        self.ticks.append((the_time, forced, group_extrac, benefits, costs,
+                           payoffs, resource))
+
+
+class TestComputeTick(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+
+    def check(self, extractions, resources):
+        forced, group, benefits, costs, payoffs, new = compute_tick(
+            np.array(extractions, dtype=float),
+            np.array(resources, dtype=float))
+        for g, (e, r) in enumerate(zip(extractions, resources)):
+            b_forced, b_group, b_extrac, b_benefits, b_costs, b_payoffs, \
+                b_new = baseline_tick(e, r)
+            self.assertEqual(bool(forced[g]), b_forced)
+            self.assertAlmostEqual(group[g], b_group, places=12)
+            self.assertEqual(benefits[g].tolist(), b_benefits)
+            self.assertEqual(costs[g].tolist(), b_costs)
+            self.assertEqual(payoffs[g].tolist(), b_payoffs)
+            self.assertAlmostEqual(new[g], b_new, places=12)
+
+    def test_random(self):
+        for players in (1, 2, 5):
+            extractions = self.rng.uniform(
+                pms.DECISION_MIN, pms.DECISION_MAX, (20, players)).tolist()
+            resources = self.rng.uniform(0, 40, 20).tolist()
+            self.check(extractions, resources)
+
+    def test_forced(self):
+        # only the groups that extract more than the resource are set to 0
+        self.check([[1., 2.], [0.5, 0.2], [3., 0.]], [2., 2., 3.])
+        forced = compute_tick(np.array([[1., 2.], [0.5, 0.2]]),
+                              np.array([2., 2.]))[0]
+        self.assertEqual(forced.tolist(), [True, False])
+
+    def test_negative_cost(self):
+        # large stock: c0 - c1 * resource < 0, the cost is 0
+        resource = 2 * pms.param_c0 / pms.param_c1
+        self.check([[0.4, 0.7]], [resource])
+        costs = compute_tick(np.array([[0.4, 0.7]]), np.array([resource]))[3]
+        self.assertEqual(costs.tolist(), [[0., 0.]])
+
+
+class TestTickEngine(unittest.TestCase):
+
+    def test_part_as_baseline(self):
+        # a whole part: each group is updated tick after tick as the
+        # baseline did, the stock is carried from one tick to the next
+        rng = np.random.RandomState(2)
+        groups = [FakeGroup(2), FakeGroup(2, 5.), FakeGroup(2, 0.5)]
+        engine = TickEngine(groups, history=3)
+        resources = [g.current_resource for g in groups]
+        for tick in range(30):
+            extractions = rng.uniform(0, 1.5, (len(groups), 2))
+            engine.extractions[:] = extractions
+            engine.update_data(tick)
+            for index, g in enumerate(groups):
+                b_forced, b_group, _, b_benefits, b_costs, b_payoffs, \
+                    resources[index] = baseline_tick(
+                        extractions[index].tolist(), resources[index])
+                the_time, forced, group, benefits, costs, payoffs, \
+                    resource = g.ticks[-1]
+                self.assertEqual(the_time, tick)
+                self.assertEqual(forced, b_forced)
+                self.assertAlmostEqual(group, b_group, places=12)
+                self.assertEqual(benefits, b_benefits)
+                self.assertEqual(costs, b_costs)
+                self.assertEqual(payoffs, b_payoffs)
+                self.assertAlmostEqual(resource, resources[index], places=9)
+        # the history grew past its initial size
+        self.assertEqual(engine.history_count.tolist(), [30] * 3)
+        self.assertEqual(engine.history_time[:30, 0].tolist(),
+                         list(range(30)))
+
+    def test_forced_extractions_stay_zero(self):
+        group = FakeGroup(2, 1.)
+        engine = TickEngine([group])
+        engine.extractions[:] = [[1., 1.]]
+        engine.update_data(1)
+        self.assertTrue(group.ticks[-1][1])
+        self.assertEqual(engine.extractions.tolist(), [[0., 0.]])
+
+    def test_rows(self):
+        # discrete treatment: one group makes its step alone
+        groups = [FakeGroup(2), FakeGroup(2)]
+        engine = TickEngine(groups)
+        engine.extractions[:] = 0.3
+        engine.update_data(1, [1])
+        self.assertEqual(len(groups[0].ticks), 0)
+        self.assertEqual(len(groups[1].ticks), 1)
+        self.assertEqual(engine.resources[0], pms.RESOURCE_INITIAL_STOCK)
+        self.assertEqual(engine.history_count.tolist(), [0, 1])
+
+    def test_group_of_another_size(self):
+        # the buffers have the size of the largest group, the missing
+        # members extract 0
+        small, large = FakeGroup(2), FakeGroup(3)
+        engine = TickEngine([small, large])
+        engine.extractions[:] = [[0.2, 0.3, 0.], [0.2, 0.3, 0.4]]
+        engine.update_data(1)
+        self.assertAlmostEqual(small.ticks[-1][2], 0.5)
+        self.assertAlmostEqual(large.ticks[-1][2], 0.9)
+
+    def test_failing_group(self):
+        class Failing(FakeGroup):
+            def apply_tick(self, *args):
+                raise ValueError("apply_tick")
+
+        ok = FakeGroup(2)
+        engine = TickEngine([Failing(2), ok])
+        engine.update_data(1)
+        self.assertEqual(len(ok.ticks), 1)
+
+
+class TestDecimate(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.xdata = np.arange(10001) * 0.5
+        self.ydata = np.cumsum(rng.normal(size=10001))
+        self.ydata[4321] = 1000.  # a peak of one point
+
+    def test_short(self):
+        xdata, ydata = decimate(self.xdata[:10], self.ydata[:10], 100)
+        np.testing.assert_array_equal(xdata, self.xdata[:10])
+        np.testing.assert_array_equal(ydata, self.ydata[:10])
+
+    def test_shape_kept(self):
+        buckets = 300
+        xdata, ydata = decimate(self.xdata, self.ydata, buckets)
+        self.assertLessEqual(len(xdata), 2 * buckets + 2)
+        self.assertTrue(np.all(np.diff(xdata) > 0))
+        self.assertEqual((xdata[0], xdata[-1]),
+                         (self.xdata[0], self.xdata[-1]))
+        self.assertEqual(ydata.max(), 1000.)
+        self.assertEqual(ydata.min(), self.ydata.min())
+        # the points are points of the curve
+        indexes = np.searchsorted(self.xdata, xdata)
+        np.testing.assert_array_equal(self.ydata[indexes], ydata)
+
+    def test_buckets(self):
+        # the min and the max of each bucket are kept
+        buckets = 7
+        values = self.ydata[:100]
+        xdata, ydata = decimate(self.xdata[:100], values, buckets)
+        width = -(-100 // buckets)
+        for start in range(0, 100, width):
+            bucket = values[start:start + width]
+            self.assertIn(bucket.min(), ydata)
+            self.assertIn(bucket.max(), ydata)
+
+
+if __name__ == "__main__":
+    unittest.main()
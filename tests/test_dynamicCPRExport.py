@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the incremental export: the watermark, the partitions and the
+reading of the exported files.
+The database is built with the tables of the part (same names and columns),
+without le2m.
+Run from the directory of the part: python -m pytest tests (skipped with
+sqlalchemy 2, the exporter uses the 0.9 - 1.x API of le2m)
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pytest
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+if int(sqlalchemy.__version__.split(".")[0]) >= 2:
+    pytest.skip("the exporter uses the sqlalchemy 0.9 - 1.x API",
+                allow_module_level=True)
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, \
+    Float, String, LargeBinary
+
+import dynamicCPRExport as export
+from dynamicCPRStore import pack_array
+
+
+def create_tables(engine):
+    metadata = MetaData()
+    tables = dict()
+    tables["groups"] = Table(
+        "group_dynamicCPR", metadata,
+        Column("uid", String, primary_key=True),
+        Column("session_id", Integer),
+        Column("DYNCPR_sequence", Integer),
+        Column("DYNCPR_trial", Integer))
+    tables["group_extractions"] = Table(
+        "group_dynamicCPR_extractions", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("group_uid", String),
+        Column("DYNCPR_time", Float),
+        Column("DYNCPR_time_end", Float),
+        Column("DYNCPR_group_extraction", Float),
+        Column("DYNCPR_resource_stock", Float))
+    tables["parts"] = Table(
+        "partie_dynamicCPR", metadata,
+        Column("partie_id", Integer, primary_key=True),
+        Column("DYNCPR_group", String),
+        Column("DYNCPR_sequence", Integer),
+        Column("DYNCPR_gain_ecus", Float))
+    tables["repetitions"] = Table(
+        "partie_dynamicCPR_repetitions", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("partie_partie_id", Integer),
+        Column("DYNCPR_period", Integer))
+    tables["extractions"] = Table(
+        "partie_dynamicCPR_extractions", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("repetitions_id", Integer),
+        Column("DYNCPR_extraction", Float),
+        Column("DYNCPR_extraction_time", Float),
+        Column("DYNCPR_extraction_time_end", Float))
+    tables["curves_blob"] = Table(
+        "partie_dynamicCPR_curves_blob", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("partie_id", Integer),
+        Column("DYNCPR_curve_type", Integer),
+        Column("DYNCPR_curve_dtype", String),
+        Column("DYNCPR_curve_length", Integer),
+        Column("DYNCPR_curve_xdata", LargeBinary),
+        Column("DYNCPR_curve_ydata", LargeBinary))
+    metadata.create_all(engine)
+    return tables
+
+
+def add_session(engine, tables, session_id, sequences=(0,), players=2):
+    """
+    One group per sequence, one repetition and two extractions per player,
+    one curve per player
+    """
+    with engine.begin() as connection:
+        for sequence in sequences:
+            uid = "g_{}_{}".format(session_id, sequence)
+            connection.execute(tables["groups"].insert(), uid=uid,
+                               session_id=session_id,
+                               DYNCPR_sequence=sequence, DYNCPR_trial=0)
+            connection.execute(tables["group_extractions"].insert(), [
+                {"group_uid": uid, "DYNCPR_time": t, "DYNCPR_time_end": t,
+                 "DYNCPR_group_extraction": 0.5 * t,
+                 "DYNCPR_resource_stock": 20. - t} for t in range(3)])
+            for p in range(players):
+                partie_id = session_id * 100 + sequence * 10 + p
+                connection.execute(tables["parts"].insert(),
+                                   partie_id=partie_id, DYNCPR_group=uid,
+                                   DYNCPR_sequence=sequence,
+                                   DYNCPR_gain_ecus=float(p))
+                rep_id = connection.execute(
+                    tables["repetitions"].insert(),
+                    partie_partie_id=partie_id,
+                    DYNCPR_period=0).inserted_primary_key[0]
+                connection.execute(tables["extractions"].insert(), [
+                    {"repetitions_id": rep_id, "DYNCPR_extraction": e,
+                     "DYNCPR_extraction_time": t,
+                     "DYNCPR_extraction_time_end": t + 1}
+                    for t, e in enumerate([0.1, 0.2])])
+                xdata, ydata = np.arange(4.), np.arange(4.) * partie_id
+                connection.execute(
+                    tables["curves_blob"].insert(), partie_id=partie_id,
+                    DYNCPR_curve_type=0, DYNCPR_curve_dtype="<f8",
+                    DYNCPR_curve_length=4,
+                    DYNCPR_curve_xdata=pack_array(xdata),
+                    DYNCPR_curve_ydata=pack_array(ydata))
+
+
+class TestExporter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        url = "sqlite:///{}".format(os.path.join(self.tmp, "db.sqlite"))
+        self.engine = create_engine(url)
+        self.tables = create_tables(self.engine)
+        self.directory = os.path.join(self.tmp, "export")
+        self.exporter = export.Exporter(url, self.directory,
+                                        export.FORMAT_NPY)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.exporter.engine.dispose()
+        shutil.rmtree(self.tmp)
+
+    def test_watermark(self):
+        self.assertIsNone(self.exporter.get_watermark())
+        add_session(self.engine, self.tables, 1, sequences=(0, 1))
+        self.assertEqual(self.exporter.export(), [1])
+        self.assertEqual(self.exporter.get_watermark(), 1)
+        for sequence in (0, 1):
+            directory = os.path.join(self.directory, "session_1",
+                                     "sequence_{}".format(sequence))
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(export.Exporter.TABLES))
+
+    def test_incremental(self):
+        add_session(self.engine, self.tables, 1)
+        self.exporter.export()
+        # nothing new
+        self.assertEqual(self.exporter.export(), [])
+        add_session(self.engine, self.tables, 2)
+        add_session(self.engine, self.tables, 3)
+        # the sessions already exported are not written again
+        os.remove(os.path.join(self.directory, "session_1", "sequence_0",
+                               "groups", "uid.npy"))
+        self.assertEqual(self.exporter.export(), [2, 3])
+        self.assertEqual(self.exporter.get_watermark(), 3)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.directory, "session_1", "sequence_0", "groups", "uid.npy")))
+
+    def test_full(self):
+        add_session(self.engine, self.tables, 1)
+        add_session(self.engine, self.tables, 2)
+        self.exporter.export()
+        self.assertEqual(self.exporter.export(full=True), [1, 2])
+        self.assertEqual(self.exporter.get_watermark(), 2)
+
+    def test_load(self):
+        add_session(self.engine, self.tables, 1, sequences=(0, 1))
+        self.exporter.export()
+        add_session(self.engine, self.tables, 2)
+        self.exporter.export()
+
+        groups = export.load(self.directory, "groups")
+        self.assertEqual(list(groups["session_id"]), [1, 1, 2])
+        self.assertEqual(list(groups["DYNCPR_sequence"]), [0, 1, 0])
+
+        extractions = export.load(self.directory, "extractions", mmap=False)
+        self.assertEqual(len(extractions["DYNCPR_extraction"]), 3 * 2 * 2)
+        self.assertEqual(list(extractions["session_id"]), [1] * 8 + [2] * 4)
+        np.testing.assert_allclose(extractions["DYNCPR_extraction"],
+                                   [0.1, 0.2] * 6)
+
+        curves = export.load(self.directory, "curves")
+        self.assertEqual(len(curves["DYNCPR_curve_x"]), 3 * 2 * 4)
+        np.testing.assert_allclose(curves["DYNCPR_curve_y"][4:8],
+                                   np.arange(4.) * 101)
+        self.assertEqual(list(np.unique(curves["partie_id"])),
+                         [100, 101, 110, 111, 200, 201])
+
+
+if __name__ == "__main__":
+    unittest.main()
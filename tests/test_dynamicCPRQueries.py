@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the queries of the data of the part, on an in-memory database with
+the tables of the part.
+Run from the directory of the part with le2m in the path:
+python -m pytest tests (skipped without le2m or twisted)
+"""
+
+import unittest
+import numpy as np
+import pytest
+
+pytest.importorskip("twisted")
+pytest.importorskip("server.servbase")
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from server.servbase import Base
+from server.servparties import Partie
+
+import dynamicCPRParams as pms
+import dynamicCPRQueries as queries
+from dynamicCPRGroup import GroupDYNCPR, GroupExtractionDYNCPR
+from dynamicCPRPart import PartieDYNCPR, RepetitionsDYNCPR, \
+    ExtractionsDYNCPR, CurveDYNCPR, CurveBlobDYNCPR
+from dynamicCPRStore import pack_array, CURVE_DTYPE
+
+
+def insert(session, model, rows):
+    session.execute(model.__table__.insert(), rows)
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        s = self.session
+        # two sessions, the first one with two sequences
+        insert(s, GroupDYNCPR, [
+            {"uid": "g3_1", "session_id": 1, "DYNCPR_sequence": 1},
+            {"uid": "g1_0", "session_id": 1, "DYNCPR_sequence": 0},
+            {"uid": "g2_0", "session_id": 1, "DYNCPR_sequence": 0},
+            {"uid": "g4_0", "session_id": 2, "DYNCPR_sequence": 0}])
+        # change points of g1_0: extraction 1 from 0 to 2, then 3 until 4
+        insert(s, GroupExtractionDYNCPR, [
+            {"group_uid": "g1_0", "DYNCPR_period": 0, "DYNCPR_time": 3,
+             "DYNCPR_time_end": 4, "DYNCPR_group_extraction": 3.,
+             "DYNCPR_resource_stock": 17.},
+            {"group_uid": "g1_0", "DYNCPR_period": 0, "DYNCPR_time": 0,
+             "DYNCPR_time_end": 2, "DYNCPR_group_extraction": 1.,
+             "DYNCPR_resource_stock": 15.},
+            {"group_uid": "g1_0", "DYNCPR_period": 1, "DYNCPR_time": 0,
+             "DYNCPR_time_end": 0, "DYNCPR_group_extraction": 0.,
+             "DYNCPR_resource_stock": 15.},
+            {"group_uid": "g2_0", "DYNCPR_period": 0, "DYNCPR_time": 0,
+             "DYNCPR_time_end": 0, "DYNCPR_group_extraction": 0.,
+             "DYNCPR_resource_stock": 15.}])
+        insert(s, Partie, [{"id": i, "nom": "dynamicCPR"} for i in
+                           (1, 2, 3)])
+        insert(s, PartieDYNCPR, [
+            {"partie_id": 2, "DYNCPR_group": "g1_0"},
+            {"partie_id": 1, "DYNCPR_group": "g1_0"},
+            {"partie_id": 3, "DYNCPR_group": "g2_0"}])
+        insert(s, RepetitionsDYNCPR, [
+            {"id": 10, "partie_partie_id": 1, "DYNCPR_period": 1},
+            {"id": 11, "partie_partie_id": 1, "DYNCPR_period": 0},
+            {"id": 12, "partie_partie_id": 2, "DYNCPR_period": 0}])
+        insert(s, ExtractionsDYNCPR, [
+            {"repetitions_id": 11, "DYNCPR_extraction": 0.5,
+             "DYNCPR_extraction_time": 2.},
+            {"repetitions_id": 11, "DYNCPR_extraction": 0.2,
+             "DYNCPR_extraction_time": 1.},
+            {"repetitions_id": 12, "DYNCPR_extraction": 0.3,
+             "DYNCPR_extraction_time": 0.},
+            {"repetitions_id": 10, "DYNCPR_extraction": 0.1,
+             "DYNCPR_extraction_time": 0.}])
+        # part 1 stored with blobs, part 2 with one row per point
+        insert(s, CurveBlobDYNCPR, [
+            {"partie_id": 1, "DYNCPR_curve_type": c_type,
+             "DYNCPR_curve_dtype": CURVE_DTYPE.str, "DYNCPR_curve_length": 3,
+             "DYNCPR_curve_xdata": pack_array([0, 1, 2]),
+             "DYNCPR_curve_ydata": pack_array([c_type, c_type + 1, 0.5])}
+            for c_type in (pms.EXTRACTION, pms.PAYOFF)])
+        insert(s, CurveDYNCPR, [
+            {"partie_id": 2, "DYNCPR_curve_type": pms.EXTRACTION,
+             "DYNCPR_curve_x": x, "DYNCPR_curve_y": y}
+            for x, y in [(0, 0.1), (1, 0.2), (2, 0.4)]])
+        s.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_groups(self):
+        self.assertEqual([g.uid for g in queries.get_groups(self.session, 1)],
+                         ["g1_0", "g2_0", "g3_1"])
+        self.assertEqual([g.uid for g in queries.get_groups(
+            self.session, 1, sequence=1)], ["g3_1"])
+        self.assertEqual([g.uid for g in queries.get_groups(self.session, 3)],
+                         [])
+
+    def test_group_extractions(self):
+        rows = queries.get_group_extractions(self.session, "g1_0")
+        self.assertEqual([(r.DYNCPR_period, r.DYNCPR_time) for r in rows],
+                         [(0, 0), (0, 3), (1, 0)])
+        rows = queries.get_group_extractions(self.session, "g1_0", period=0,
+                                             start=1, end=3)
+        self.assertEqual([r.DYNCPR_time for r in rows], [3])
+        with self.assertRaises(ValueError):
+            queries.get_group_extractions(self.session, "g1_0", start=1)
+
+    def test_group_series(self):
+        series = queries.get_group_series(self.session, "g1_0", 0, step=1)
+        np.testing.assert_allclose(series["time"], range(5))
+        np.testing.assert_allclose(series["group_extraction"],
+                                   [1, 1, 1, 3, 3])
+        growth = pms.RESOURCE_GROWTH
+        np.testing.assert_allclose(
+            series["resource_stock"][:3],
+            [15, 15 + growth - 1, 15 + 2 * (growth - 1)])
+        self.assertEqual(series["resource_stock"][3], 17)
+
+    def test_parts(self):
+        self.assertEqual([p.partie_id for p in queries.get_parts(
+            self.session, "g1_0")], [1, 2])
+        self.assertEqual([r.id for r in queries.get_repetitions(
+            self.session, 1)], [11, 10])
+        self.assertEqual([r.id for r in queries.get_repetitions(
+            self.session, 1, period=1)], [10])
+
+    def test_extractions(self):
+        rows = queries.get_extractions(self.session, 11)
+        self.assertEqual([r.DYNCPR_extraction for r in rows], [0.2, 0.5])
+        rows = queries.get_extractions(self.session, [12, 11])
+        self.assertEqual([r.repetitions_id for r in rows], [11, 11, 12])
+
+    def test_curves(self):
+        curves = queries.get_curves(self.session, 1)
+        self.assertEqual(sorted(curves), sorted([pms.EXTRACTION, pms.PAYOFF]))
+        x, y = curves[pms.PAYOFF]
+        np.testing.assert_allclose(x, [0, 1, 2])
+        np.testing.assert_allclose(y, [pms.PAYOFF, pms.PAYOFF + 1, 0.5])
+        self.assertEqual(list(queries.get_curves(
+            self.session, 1, c_type=pms.EXTRACTION)), [pms.EXTRACTION])
+        # the parts played before the blobs
+        x, y = queries.get_curves(self.session, 2)[pms.EXTRACTION]
+        np.testing.assert_allclose(x, [0, 1, 2])
+        np.testing.assert_allclose(y, [0.1, 0.2, 0.4])
+        self.assertEqual(queries.get_curves(self.session, 3), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the schedulers and of the deadlines of the remote calls.
+Run from the directory of the part: python -m pytest tests (skipped without
+twisted)
+"""
+
+import unittest
+from datetime import timedelta
+import pytest
+
+pytest.importorskip("twisted")
+from twisted.internet import defer, task
+from twisted.spread import pb
+
+from dynamicCPRScheduler import SessionScheduler, PeriodScheduler, \
+    call_remote
+
+
+class TestSessionScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.ticks = []
+        self.finished = []
+
+    def make(self, on_tick=None, ticks=5):
+        scheduler = SessionScheduler(
+            timedelta(seconds=1), on_tick or self.on_tick, ticks,
+            lambda: self.finished.append(self.clock.seconds()), self.clock)
+        scheduler.start()
+        return scheduler
+
+    def on_tick(self, tick, the_time):
+        self.ticks.append((tick, the_time))
+
+    def test_ticks_on_time(self):
+        scheduler = self.make()
+        self.clock.pump([1] * 5)
+        self.assertEqual(self.ticks, [(n, float(n)) for n in range(1, 6)])
+        self.assertEqual(self.finished, [5])
+        self.assertEqual(scheduler.late_ticks, 0)
+        self.assertFalse(scheduler.running)
+
+    def test_no_drift(self):
+        # each wakeup comes a bit late, the next one is not delayed by it
+        self.make(ticks=3)
+        self.clock.advance(1.4)
+        self.clock.advance(0.7)
+        self.assertEqual([t for t, _ in self.ticks], [1, 2])
+        self.assertEqual([c.getTime() for c in self.clock.getDelayedCalls()],
+                         [3])
+
+    def test_late_ticks_run_in_a_row(self):
+        scheduler = self.make()
+        self.clock.advance(3.5)
+        self.assertEqual(self.ticks, [(1, 1.), (2, 2.), (3, 3.)])
+        self.assertEqual(scheduler.late_ticks, 2)
+
+    def test_stop(self):
+        scheduler = self.make()
+        self.clock.advance(2)
+        scheduler.stop()
+        self.clock.advance(10)
+        self.assertEqual(len(self.ticks), 2)
+        self.assertEqual(self.finished, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failing_tick(self):
+        def on_tick(tick, the_time):
+            self.on_tick(tick, the_time)
+            if tick == 2:
+                raise pb.DeadReferenceError("Calling Stale Broker")
+
+        self.make(on_tick)
+        self.clock.pump([1] * 5)
+        self.assertEqual(len(self.ticks), 5)
+        self.assertEqual(self.finished, [5])
+
+
+class FakeGroup(object):
+    """
+    Take the place of a GroupDYNCPR: a period lasts duration seconds, and
+    fails in the periods of fail
+    """
+
+    def __init__(self, name, clock, duration, fail=()):
+        self.name = name
+        self.clock = clock
+        self.duration = duration
+        self.fail = fail
+        self.played = []
+
+    def play_period(self, period):
+        self.played.append(period)
+        if period in self.fail:
+            # as a remote disconnected at once
+            raise pb.DeadReferenceError("Calling Stale Broker")
+        return task.deferLater(self.clock, self.duration, lambda: None)
+
+    def __repr__(self):
+        return self.name
+
+
+class TestPeriodScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.periods = []
+
+    def run_groups(self, groups, periods=3, stop=None):
+        results = []
+        scheduler = PeriodScheduler(
+            groups, periods, lambda g, p: self.periods.append((g.name, p)),
+            stop)
+        scheduler.run().addBoth(results.append)
+        return scheduler, results
+
+    def test_own_pace(self):
+        fast = FakeGroup("fast", self.clock, 1)
+        slow = FakeGroup("slow", self.clock, 5)
+        scheduler, results = self.run_groups([fast, slow])
+        self.clock.pump([1] * 3)
+        self.assertEqual(scheduler.progress, {fast: 3, slow: 0})
+        self.assertEqual(scheduler.finished, 1)
+        self.assertEqual(results, [])
+        self.clock.pump([1] * 12)
+        self.assertEqual(results, [{fast: 3, slow: 3}])
+
+    def test_failing_group(self):
+        ok = FakeGroup("ok", self.clock, 1)
+        failing = FakeGroup("failing", self.clock, 1, fail=(2, ))
+        scheduler, results = self.run_groups([ok, failing])
+        self.clock.pump([1] * 3)
+        self.assertEqual(results, [{ok: 3, failing: 3}])
+        self.assertEqual(failing.played, [1, 2, 3])
+        self.assertIn(("failing", 2), self.periods)
+
+    def test_stop(self):
+        group = FakeGroup("g", self.clock, 1)
+        scheduler, results = self.run_groups(
+            [group], stop=lambda: len(group.played) >= 2)
+        self.clock.pump([1] * 3)
+        self.assertEqual(results, [{group: 2}])
+
+
+class FakeRemote(object):
+    """
+    Take the place of a RemoteReference: answer is a Deferred returned by
+    callRemote, or an exception raised at once
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        self.calls.append((method, args))
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class TestCallRemote(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.results = []
+
+    def call(self, remote, args=()):
+        d = call_remote(remote, "display_decision", args,
+                        timedelta(seconds=15), self.clock)
+        d.addBoth(self.results.append)
+
+    def test_answer_before_deadline(self):
+        answer = defer.Deferred()
+        remote = FakeRemote(answer)
+        self.call(remote, (1, ))
+        self.clock.advance(10)
+        answer.callback(1.2)
+        self.assertEqual(self.results, [(True, 1.2)])
+        self.assertEqual(remote.calls, [("display_decision", (1, ))])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_deadline_and_late_answer(self):
+        answer = defer.Deferred()
+        self.call(FakeRemote(answer))
+        self.clock.advance(15)
+        self.assertEqual(self.results, [(False, None)])
+        answer.callback(1.2)  # ignored
+        self.assertEqual(self.results, [(False, None)])
+
+    def test_late_failure(self):
+        answer = defer.Deferred()
+        self.call(FakeRemote(answer))
+        self.clock.advance(15)
+        answer.errback(ValueError("late"))  # ignored
+        self.assertEqual(self.results, [(False, None)])
+
+    def test_disconnected_synchronously(self):
+        # callRemote on a disconnected remote raises DeadReferenceError
+        self.call(FakeRemote(pb.DeadReferenceError("Calling Stale Broker")))
+        self.assertEqual(self.results, [(False, None)])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connection_lost(self):
+        answer = defer.Deferred()
+        self.call(FakeRemote(answer))
+        answer.errback(pb.PBConnectionLost("lost"))
+        self.assertEqual(self.results, [(False, None)])
+
+    def test_other_failure_is_passed_on(self):
+        self.call(FakeRemote(ValueError("bug")))
+        self.assertEqual(len(self.results), 1)
+        self.assertTrue(self.results[0].check(ValueError))
+
+    def test_no_deadline(self):
+        remote = FakeRemote(pb.DeadReferenceError("Calling Stale Broker"))
+        call_remote(remote, "newperiod", (2, )).addBoth(self.results.append)
+        call_remote(FakeRemote(defer.succeed(None)), "newperiod", (2, )).\
+            addBoth(self.results.append)
+        self.assertEqual(self.results, [(False, None), (True, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the headless simulation.
+Run from the directory of the part: python -m pytest tests
+"""
+
+import unittest
+from datetime import timedelta
+import numpy as np
+
+import dynamicCPRParams as pms
+from dynamicCPRSimulation import Simulation
+
+
+def constant(value):
+    return lambda state, group, player: value
+
+
+class TestSimulationParams(unittest.TestCase):
+
+    def test_params_restored(self):
+        duration, timer = pms.CONTINUOUS_TIME_DURATION, pms.TIMER_UPDATE
+        sim = Simulation([constant(0.2)] * 2, params={
+            "DYNAMIC_TYPE": pms.CONTINUOUS,
+            "CONTINUOUS_TIME_DURATION": timedelta(seconds=10),
+            "TIMER_UPDATE": timedelta(seconds=0.5)})
+        self.assertEqual(sim.ticks, 20)
+        self.assertEqual(pms.CONTINUOUS_TIME_DURATION, duration)
+        self.assertEqual(pms.TIMER_UPDATE, timer)
+        sim.run()
+        self.assertEqual(sim.time[-1], 10)
+        self.assertEqual(pms.TIMER_UPDATE, timer)
+
+    def test_new_param_removed(self):
+        Simulation([constant(0.2)], params={"BENCH_ONLY": 1}).run()
+        self.assertFalse(hasattr(pms, "BENCH_ONLY"))
+
+    def test_interleaved(self):
+        # two simulations driven step by step, each one with its own params
+        slow = Simulation([constant(0.2)] * 2, params={
+            "DYNAMIC_TYPE": pms.CONTINUOUS,
+            "CONTINUOUS_TIME_DURATION": timedelta(seconds=4),
+            "TIMER_UPDATE": timedelta(seconds=1), "param_a": 3.})
+        fast = Simulation([constant(0.2)] * 2, params={
+            "DYNAMIC_TYPE": pms.CONTINUOUS,
+            "CONTINUOUS_TIME_DURATION": timedelta(seconds=4),
+            "TIMER_UPDATE": timedelta(seconds=1)})
+        for _ in zip(slow.steps(), fast.steps()):
+            pass
+        self.assertTrue(slow.finished and fast.finished)
+        alone = Simulation([constant(0.2)] * 2, params=fast.params).run()
+        np.testing.assert_array_equal(fast.payoff, alone["payoff"])
+        self.assertFalse(np.array_equal(slow.benefit, fast.benefit))
+
+    def test_over(self):
+        previous = pms.DYNAMIC_TYPE, pms.NOMBRE_PERIODES
+        sim = Simulation([constant(0.2)], params={
+            "DYNAMIC_TYPE": pms.DISCRETE, "NOMBRE_PERIODES": 2})
+        sim.run()
+        self.assertEqual(sim.ticks, 2)
+        self.assertRaises(StopIteration, sim.step)
+        self.assertEqual((pms.DYNAMIC_TYPE, pms.NOMBRE_PERIODES), previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
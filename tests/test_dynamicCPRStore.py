@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the readers of the stored rows: the rows stored in
+STORAGE_CHANGE_POINTS mode give back one value per tick, the same as the
+ones of the game.
+Run from the directory of the part: python -m pytest tests
+"""
+
+import unittest
+from datetime import timedelta
+import numpy as np
+
+import dynamicCPRParams as pms
+from dynamicCPRSimulation import Simulation
+from dynamicCPRStore import expand_group_extractions, expand_extractions
+
+
+def steps_strategy(changes):
+    """
+    :param changes: {tick: extraction}, the extraction is kept between two
+    changes
+    """
+    def strategy(state, group, player):
+        return changes.get(state.tick)
+    return strategy
+
+
+def group_rows(sim, group, change_points=True):
+    """
+    The group extraction rows, as GroupDYNCPR.apply_tick stores them
+    """
+    rows = []
+    for k in range(sim.ticks + 1):
+        extraction = float(sim.group_extraction[k, group])
+        the_time = float(sim.time[k])
+        if change_points and rows and \
+                rows[-1]["DYNCPR_group_extraction"] == extraction:
+            rows[-1]["DYNCPR_time_end"] = the_time
+        else:
+            rows.append({"DYNCPR_time": the_time, "DYNCPR_time_end": the_time,
+                         "DYNCPR_group_extraction": extraction,
+                         "DYNCPR_resource_stock":
+                             float(sim.resource[k, group])})
+    return rows
+
+
+def player_rows(sim, group, player):
+    """
+    The extraction rows of a player: a new row when the extraction changes,
+    DYNCPR_extraction_time_end is the time of the last tick that used it
+    """
+    rows = []
+    for k in range(sim.ticks + 1):
+        extraction = float(sim.extraction[k, group, player])
+        if not rows or rows[-1]["DYNCPR_extraction"] != extraction:
+            rows.append({"DYNCPR_extraction": extraction,
+                         "DYNCPR_extraction_time": float(sim.time[k])})
+        rows[-1]["DYNCPR_extraction_time_end"] = float(sim.time[k])
+    return rows
+
+
+class TestChangePoints(unittest.TestCase):
+
+    def setUp(self):
+        self.step = 0.5
+        self.sim = Simulation(
+            [steps_strategy({0: 0.2, 7: 0.5, 30: 0.1}),
+             steps_strategy({0: 0.3, 7: 0.2, 12: 0.4})],
+            groups=2, params={
+                "DYNAMIC_TYPE": pms.CONTINUOUS,
+                "CONTINUOUS_TIME_DURATION": timedelta(seconds=20),
+                "TIMER_UPDATE": timedelta(seconds=self.step)})
+        self.sim.run()
+
+    def test_group_series(self):
+        for group in range(2):
+            rows = group_rows(self.sim, group)
+            self.assertLess(len(rows), self.sim.ticks + 1)
+            series = expand_group_extractions(rows, self.step)
+            np.testing.assert_array_equal(series["time"], self.sim.time)
+            np.testing.assert_array_equal(
+                series["group_extraction"], self.sim.group_extraction[:, group])
+            np.testing.assert_allclose(
+                series["resource_stock"], self.sim.resource[:, group],
+                rtol=0, atol=1e-12)
+
+    def test_every_tick(self):
+        rows = group_rows(self.sim, 0, change_points=False)
+        self.assertEqual(len(rows), self.sim.ticks + 1)
+        series = expand_group_extractions(rows, self.step)
+        np.testing.assert_array_equal(series["resource_stock"],
+                                      self.sim.resource[:, 0])
+
+    def test_unordered_rows(self):
+        rows = group_rows(self.sim, 1)
+        series = expand_group_extractions(rows[::-1], self.step)
+        np.testing.assert_array_equal(series["time"], self.sim.time)
+
+    def test_no_rows(self):
+        series = expand_group_extractions([], self.step)
+        self.assertEqual(len(series["time"]), 0)
+
+    def test_extractions(self):
+        for player in range(2):
+            rows = player_rows(self.sim, 1, player)
+            # an extraction replaced before any tick used it
+            rows.insert(1, {"DYNCPR_extraction": 1.5,
+                            "DYNCPR_extraction_time": 2,
+                            "DYNCPR_extraction_time_end": None})
+            np.testing.assert_array_equal(
+                expand_extractions(rows, self.sim.time),
+                self.sim.extraction[:, 1, player])
+
+
+if __name__ == "__main__":
+    unittest.main()
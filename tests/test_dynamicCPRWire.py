@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the wire formats of the group updates.
+Run from the directory of the part: python -m pytest tests (skipped without
+twisted)
+"""
+
+import unittest
+import numpy as np
+import pytest
+
+pytest.importorskip("twisted")
+from twisted.internet import defer
+from twisted.spread import pb
+
+import dynamicCPRWire as wire
+
+
+class Values(object):
+    """
+    Take the place of the extraction records
+    """
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+MEMBERS = ["j1", "j2", "j3"]
+
+
+def make_state(rng, tick):
+    members = {
+        uid: Values(
+            DYNCPR_extraction=round(rng.uniform(0, 1), 2),
+            DYNCPR_extraction_time=tick, DYNCPR_resource=rng.uniform(0, 20),
+            DYNCPR_benefice=rng.uniform(), DYNCPR_cost=rng.uniform(),
+            DYNCPR_payoff=rng.uniform()) for uid in MEMBERS}
+    group = Values(DYNCPR_period=1, DYNCPR_time=tick,
+                   DYNCPR_group_extraction=rng.uniform(0, 3),
+                   DYNCPR_resource_stock=rng.uniform(0, 20))
+    return members, group
+
+
+def expected(members, group):
+    return {uid: {f: getattr(e, f) for f in wire.MEMBER_FIELDS}
+            for uid, e in members.items()}, \
+        {f: getattr(group, f) for f in wire.GROUP_FIELDS}
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(3)
+
+    def run_part(self, compact, ticks=50, interval=7, lost=()):
+        """
+        Encode the updates of a part and decode them on each member. The
+        updates of the ticks in lost don't reach the first member
+        :return: the encoder, the decoders
+        """
+        encoder = wire.DeltaEncoder(MEMBERS, interval,
+                                    MEMBERS if compact else None)
+        decoders = {uid: wire.DeltaDecoder(compact) for uid in MEMBERS}
+        members, group = make_state(self.rng, 0)
+        for tick in range(ticks):
+            # only some values change from one tick to the next
+            if tick % 3 == 0:
+                members, group = make_state(self.rng, tick)
+            group.DYNCPR_time = tick
+            update = encoder.encode(members, group)
+            for uid, decoder in decoders.items():
+                if uid == MEMBERS[0] and tick in lost:
+                    encoder.reject(uid)
+                    continue
+                state = decoder.decode(update)
+                if state is None:
+                    encoder.acknowledge(None, uid)
+                    continue
+                encoder.acknowledge(update[1], uid)
+                if compact:
+                    decoded = wire.unflatten_compact(MEMBERS, state)
+                else:
+                    decoded = wire.unflatten(state)
+                extraction = expected(members, group)
+                if compact:
+                    # the extractions are sent in units of DECISION_STEP
+                    for e in extraction[0].values():
+                        e["DYNCPR_extraction"] = wire.decode_extraction(
+                            wire.encode_extraction(e["DYNCPR_extraction"]))
+                self.assertEqual(decoded, extraction)
+        return encoder, decoders
+
+    def test_round_trip(self):
+        self.run_part(compact=False)
+
+    def test_round_trip_compact(self):
+        self.run_part(compact=True)
+
+    def test_deltas_and_keyframes(self):
+        encoder = wire.DeltaEncoder(MEMBERS, 5)
+        members, group = make_state(self.rng, 0)
+        kinds = []
+        for tick in range(11):
+            update = encoder.encode(members, group)
+            kinds.append(update[0])
+            for uid in MEMBERS:
+                encoder.acknowledge(update[1], uid)
+        # the first update, then every 5 updates
+        self.assertEqual([i for i, k in enumerate(kinds)
+                          if k == wire.KEYFRAME], [0, 4, 9])
+        # nothing changed: the deltas are empty
+        self.assertEqual(encoder.encode(members, group)[3], [])
+
+    def test_recovery(self):
+        # the first member misses updates, it gets keyframes until it
+        # acknowledges again, then deltas
+        encoder, decoders = self.run_part(compact=True, lost=(10, 11, 20))
+        members, group = make_state(self.rng, 100)
+        update = encoder.encode(members, group)
+        self.assertEqual(update[0], wire.DELTA)
+
+    def test_unknown_base(self):
+        decoder = wire.DeltaDecoder()
+        self.assertIsNone(decoder.decode((wire.DELTA, 5, 4, [])))
+
+    def test_history_bounded(self):
+        # a member that never acknowledges: only the states since the last
+        # keyframe are kept, on both sides
+        encoder = wire.DeltaEncoder(MEMBERS, 10)
+        decoder = wire.DeltaDecoder()
+        for tick in range(500):
+            members, group = make_state(self.rng, tick)
+            update = encoder.encode(members, group)
+            decoder.decode(update)
+            for uid in MEMBERS[1:]:
+                encoder.acknowledge(update[1], uid)
+            self.assertLessEqual(len(encoder._states), 10)
+            self.assertLessEqual(len(decoder._states), 10)
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_extraction_codes(self):
+        for value in np.arange(0, 2, 0.01):
+            code = wire.encode_extraction(value)
+            self.assertIsInstance(code, int)
+            self.assertAlmostEqual(wire.decode_extraction(code), value)
+
+    def test_protocol(self):
+        self.assertEqual(wire.get_protocol(None), wire.PROTOCOL_DICT)
+        self.assertEqual(wire.get_protocol("x"), wire.PROTOCOL_DICT)
+        self.assertEqual(wire.get_protocol(3), 3)
+
+    def test_curves(self):
+        class Curve(object):
+            def __init__(self, xdata, ydata):
+                self.xdata, self.ydata = np.array(xdata), np.array(ydata)
+
+        curves = (Curve([0, 1, 2], [0.1, 0.5, 0.5]),
+                  Curve([0, 1, 2], [1.5, 2.5, 3.]),
+                  Curve([0, 1, 2], [0., 0.2, 0.1]))
+        full, compact = [
+            {k: list(v) for k, v in wire.unpack_curves(
+                wire.pack_curves(protocol, *curves)).items()}
+            for protocol in (wire.PROTOCOL_DICT, wire.PROTOCOL)]
+        self.assertEqual(full, compact)
+        self.assertEqual(compact["extractions"],
+                         [(0, 0.1), (1, 0.5), (2, 0.5)])
+
+    def test_large_group(self):
+        own = wire.member_values(Values(
+            DYNCPR_extraction=0.3, DYNCPR_extraction_time=2,
+            DYNCPR_resource=10., DYNCPR_benefice=1., DYNCPR_cost=0.5,
+            DYNCPR_payoff=0.5))
+        group = wire.group_values(Values(
+            DYNCPR_period=1, DYNCPR_time=3, DYNCPR_group_extraction=1.2,
+            DYNCPR_resource_stock=9.))
+        members, group = wire.decode_large_group(
+            "j1", *wire.unpack(wire.pack(own, group)))
+        self.assertEqual(members["j1"]["DYNCPR_extraction"], 0.3)
+        self.assertEqual(group["DYNCPR_group_extraction"], 1.2)
+        mean, low, high, histogram = wire.aggregate([0.1, 0.2, 0.6], 4)
+        self.assertAlmostEqual(mean, 0.3)
+        self.assertEqual((low, high), (0.1, 0.6))
+        self.assertEqual(sum(histogram), 3)
+
+
+class FakeRemote(object):
+    """
+    Take the place of a RemoteReference, raise DeadReferenceError at once if
+    disconnected
+    """
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        if not self.connected:
+            raise pb.DeadReferenceError("Calling Stale Broker")
+        self.calls.append((method, args))
+        return defer.succeed(True)
+
+
+class TestBroadcaster(unittest.TestCase):
+
+    def test_serialized_once(self):
+        remotes = [FakeRemote(), FakeRemote()]
+        broadcaster = wire.Broadcaster()
+        deferreds = broadcaster.broadcast(remotes, "update_data_packed",
+                                          {"a": 1.5}, 3)
+        self.assertEqual(len(deferreds), 2)
+        packed = remotes[0].calls[0][1][0]
+        self.assertIs(remotes[1].calls[0][1][0], packed)
+        self.assertEqual(wire.unpack(packed), ({"a": 1.5}, 3))
+        self.assertEqual((broadcaster.fanouts, broadcaster.calls), (1, 2))
+
+    def test_disconnected_remote(self):
+        remotes = [FakeRemote(), FakeRemote(False), FakeRemote()]
+        results = []
+        for d in wire.Broadcaster().broadcast(remotes, "update_data_packed",
+                                              1):
+            d.addCallbacks(results.append,
+                           lambda f: results.append(f.type))
+        self.assertEqual(results, [True, pb.DeadReferenceError, True])
+        self.assertEqual(len(remotes[2].calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()